@@ -0,0 +1,125 @@
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+from logger import Logger, SingletonType
+log = Logger.getInstance().getLogger()
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_STATUS_FORCELIST = [502, 503, 504]
+DEFAULT_TIMEOUT = 10.0  # seconds
+
+
+class HttpTransport(object, metaclass=SingletonType):
+    """
+    Shared HTTP transport with a keep-alive session pool per host.
+
+    Configure once with HttpTransport.getInstance(config=...) before
+    any other module uses it.
+    """
+    def __init__(self, config=None):
+        """
+        Args:
+            config (dict, optional): The http section of the config
+                file. Defaults to None (all defaults).
+        """
+        config = config or {}
+        self.pool_size = int(config.get('poolSize', DEFAULT_POOL_SIZE))
+        self.timeout = float(config.get('timeout', DEFAULT_TIMEOUT))
+        self.retry = Retry(
+            total=int(config.get('retries', DEFAULT_RETRIES)),
+            backoff_factor=float(config.get('backoffFactor',
+                                            DEFAULT_BACKOFF_FACTOR)),
+            status_forcelist=config.get('statusForcelist',
+                                        DEFAULT_STATUS_FORCELIST),
+            # Read errors and retry statuses only for idempotent
+            # methods, a POST (token, API, influx db write) may have
+            # been applied. Connect errors are retried for all.
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False)
+
+        self.sessions = {}
+        self.request_counts = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, url: str) -> requests.Session:
+        """
+        Get (or create) the keep-alive session for the url's host.
+
+        Args:
+            url (str): Request url.
+
+        Returns:
+            requests.Session: Session bound to scheme://host:port.
+        """
+        parts = urlsplit(url)
+        host = "{0}://{1}".format(parts.scheme, parts.netloc)
+
+        with self.lock:
+            self.request_counts[host] = \
+                self.request_counts.get(host, 0) + 1
+            session = self.sessions.get(host)
+            if session is None:
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size,
+                                      max_retries=self.retry)
+                session = requests.Session()
+                session.mount(host, adapter)
+                self.sessions[host] = session
+                log.debug("Created HTTP session pool for %s", host)
+
+        return session
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """
+        requests.post over the pooled session for the url's host.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.get_session(url).post(url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        requests.get over the pooled session for the url's host.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.get_session(url).get(url, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Connection reuse statistics per host.
+
+        Returns:
+            dict: host -> {requests, connections, reused}.
+        """
+        stats = dict()
+        with self.lock:
+            for host, session in self.sessions.items():
+                connections = 0
+                pools = session.get_adapter(host).poolmanager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is not None:
+                        connections += pool.num_connections
+
+                num_requests = self.request_counts.get(host, 0)
+                stats[host] = {
+                    'requests': num_requests,
+                    'connections': connections,
+                    'reused': max(0, num_requests - connections)
+                }
+
+        return stats
+
+    def close(self):
+        """
+        Close every session and its pooled connections.
+        """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
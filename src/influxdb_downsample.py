@@ -0,0 +1,311 @@
+import array
+import threading
+import time
+
+from influxdb_line_protocol import encode_line
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_WINDOW = 300  # seconds
+DEFAULT_LATENESS = 30  # seconds
+# Written as <field>_<aggregate>.
+AGGREGATES = ('min', 'max', 'mean', 'last')
+
+
+class InfluxDbDownsampler(object):
+    """
+    Windowed aggregation of numeric influx db fields.
+
+    Samples are buffered in flat typed arrays (series, field, window,
+    time, value). Once a window plus the allowed lateness has passed,
+    all closed windows of all devices are reduced in one vectorized
+    NumPy pass (a pure Python loop without NumPy) and only min, max,
+    mean and last per field are written, stamped with the window start.
+    Samples for a window that was already written are dropped and
+    counted as late.
+    """
+    def __init__(self, window=DEFAULT_WINDOW, lateness=DEFAULT_LATENESS,
+                 vectorized=True):
+        """
+        Args:
+            window (float, optional): Window length in seconds.
+            lateness (float, optional): Seconds a window stays open
+                after its end for late samples.
+            vectorized (bool, optional): Use NumPy if installed.
+        """
+        self.window_ms = max(1, int(float(window) * 1000))
+        self.lateness_ms = max(0, int(float(lateness) * 1000))
+        self.vectorized = vectorized and numpy is not None
+        self.lock = threading.Lock()
+
+        # Line prefix (one per device) and field name ids.
+        self.series = dict()
+        self.prefixes = []
+        self.field_ids = dict()
+        self.field_names = []
+        # Windows before this one were written.
+        self.closed = None
+        # End of the oldest buffered window, in ms.
+        self.due = None
+        self.samples = 0
+        self.points = 0
+        self.late = 0
+        self.reset()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Args:
+            config (dict): The influxdb.downsample section of the
+                config.
+
+        Returns:
+            InfluxDbDownsampler: The downsampler.
+        """
+        return cls(window=config.get('window', DEFAULT_WINDOW),
+                   lateness=config.get('lateness', DEFAULT_LATENESS),
+                   vectorized=config.get('vectorized', True))
+
+    def reset(self):
+        self.sids = array.array('q')
+        self.fids = array.array('q')
+        self.windows = array.array('q')
+        self.times = array.array('q')
+        self.values = array.array('d')
+
+    def add(self, prefix: str, fields: dict, timestamp=None) -> dict:
+        """
+        Buffer the numeric fields of a point.
+
+        Args:
+            prefix (str): The device's measurement,tag_set prefix.
+            fields (dict): Field key -> value.
+            timestamp (int, optional): Event time in ms since the
+                epoch, defaults to now.
+
+        Returns:
+            dict: The fields that cannot be aggregated (strings,
+            booleans), to be written as is.
+        """
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        timestamp = int(timestamp)
+        window = timestamp // self.window_ms
+
+        rest = dict()
+        with self.lock:
+            buffered = len(self.values)
+            if self.closed is not None and window < self.closed:
+                self.late += 1
+                return {key: value for key, value in fields.items()
+                        if isinstance(value, (bool, str))}
+
+            sid = self.series.get(prefix)
+            if sid is None:
+                sid = self.series[prefix] = len(self.prefixes)
+                self.prefixes.append(prefix)
+
+            for key, value in fields.items():
+                if value is None:
+                    continue
+                if isinstance(value, bool) or \
+                        not isinstance(value, (int, float)):
+                    rest[key] = value
+                    continue
+
+                fid = self.field_ids.get(key)
+                if fid is None:
+                    fid = self.field_ids[key] = len(self.field_names)
+                    self.field_names.append(key)
+
+                self.sids.append(sid)
+                self.fids.append(fid)
+                self.windows.append(window)
+                self.times.append(timestamp)
+                self.values.append(value)
+
+            self.samples += 1
+            end = (window + 1) * self.window_ms
+            if len(self.values) > buffered and \
+                    (self.due is None or end < self.due):
+                self.due = end
+
+        return rest
+
+    def buffered(self) -> int:
+        return len(self.values)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Buffered values, points added, aggregated points
+            written and late points dropped.
+        """
+        return {
+            'buffered': self.buffered(),
+            'samples': self.samples,
+            'points': self.points,
+            'late': self.late,
+            'vectorized': self.vectorized
+        }
+
+    def flush(self, force=False, now=None) -> list:
+        """
+        Aggregate every closed window.
+
+        Args:
+            force (bool, optional): Aggregate all windows, e.g. on
+                shutdown.
+            now (int, optional): Current time in ms, for tests and
+                replays.
+
+        Returns:
+            list: Line protocol points, one per device and window.
+        """
+        if now is None:
+            now = int(time.time() * 1000)
+
+        with self.lock:
+            if self.due is None or \
+                    (not force and self.due + self.lateness_ms > now):
+                return []
+
+            if force:
+                cutoff = max(self.windows) + 1
+            else:
+                cutoff = (now - self.lateness_ms) // self.window_ms
+            self.closed = max(cutoff, self.closed or cutoff)
+            columns = (self.sids, self.fids, self.windows, self.times,
+                       self.values)
+            self.reset()
+            self.due = None
+
+        # Reduce outside of the lock, adding samples is not blocked.
+        if self.vectorized:
+            groups, kept = self.reduce_numpy(columns, cutoff)
+        else:
+            groups, kept = self.reduce_python(columns, cutoff)
+
+        if kept:
+            with self.lock:
+                for sid, fid, window, timestamp, value in kept:
+                    self.sids.append(sid)
+                    self.fids.append(fid)
+                    self.windows.append(window)
+                    self.times.append(timestamp)
+                    self.values.append(value)
+                    end = (window + 1) * self.window_ms
+                    if self.due is None or end < self.due:
+                        self.due = end
+
+        lines = []
+        point = None
+        key = None
+        for sid, window, fid, aggregates in groups:
+            if (sid, window) != key:
+                if point:
+                    lines.append(encode_line(self.prefixes[key[0]], point,
+                                             key[1] * self.window_ms))
+                key = (sid, window)
+                point = dict()
+            name = self.field_names[fid]
+            for aggregate, value in zip(AGGREGATES, aggregates):
+                point['{0}_{1}'.format(name, aggregate)] = value
+
+        if point:
+            lines.append(encode_line(self.prefixes[key[0]], point,
+                                     key[1] * self.window_ms))
+
+        self.points += len(lines)
+        log.debug("Downsampled %s windows into %s points, %s values kept",
+                  len(groups), len(lines), len(kept))
+        return lines
+
+    @staticmethod
+    def reduce_numpy(columns, cutoff):
+        """
+        Args:
+            columns (tuple): series, field, window, time and value
+                arrays.
+            cutoff (int): First window that is still open.
+
+        Returns:
+            tuple: (series, window, field, (min, max, mean, last))
+            groups sorted by series, window and field, and the samples
+            of open windows.
+        """
+        sids, fids, windows, times, values = (
+            numpy.frombuffer(column, dtype=numpy.float64
+                             if column.typecode == 'd' else numpy.int64)
+            for column in columns)
+        closed = windows < cutoff
+        kept = []
+        if not closed.all():
+            is_open = ~closed
+            kept = list(zip(sids[is_open].tolist(), fids[is_open].tolist(),
+                            windows[is_open].tolist(),
+                            times[is_open].tolist(),
+                            values[is_open].tolist()))
+            sids, fids, windows, times, values = \
+                sids[closed], fids[closed], windows[closed], \
+                times[closed], values[closed]
+        if not len(values):
+            return [], kept
+
+        # Stable sort: by series, window, field and time, ties keep
+        # their arrival order so the last sample is the latest one.
+        order = numpy.lexsort((times, fids, windows, sids))
+        sids, fids, windows, values = \
+            sids[order], fids[order], windows[order], values[order]
+        change = (sids[1:] != sids[:-1]) | (windows[1:] != windows[:-1]) | \
+            (fids[1:] != fids[:-1])
+        starts = numpy.flatnonzero(numpy.concatenate(([True], change)))
+        ends = numpy.append(starts[1:], len(values))
+
+        aggregates = zip(numpy.minimum.reduceat(values, starts).tolist(),
+                         numpy.maximum.reduceat(values, starts).tolist(),
+                         (numpy.add.reduceat(values, starts) /
+                          (ends - starts)).tolist(),
+                         values[ends - 1].tolist())
+        groups = list(zip(sids[starts].tolist(), windows[starts].tolist(),
+                          fids[starts].tolist(), aggregates))
+        return groups, kept
+
+    @staticmethod
+    def reduce_python(columns, cutoff):
+        """
+        reduce_numpy() without NumPy.
+        """
+        # (series, window, field) -> [min, max, sum, count, time, last]
+        reduced = dict()
+        kept = []
+        for sample in zip(*columns):
+            sid, fid, window, timestamp, value = sample
+            if window >= cutoff:
+                kept.append(sample)
+                continue
+
+            key = (sid, window, fid)
+            acc = reduced.get(key)
+            if acc is None:
+                reduced[key] = [value, value, value, 1, timestamp, value]
+                continue
+            if value < acc[0]:
+                acc[0] = value
+            if value > acc[1]:
+                acc[1] = value
+            acc[2] += value
+            acc[3] += 1
+            if timestamp >= acc[4]:
+                acc[4] = timestamp
+                acc[5] = value
+
+        groups = [(sid, window, fid,
+                   (acc[0], acc[1], acc[2] / acc[3], acc[5]))
+                  for (sid, window, fid), acc in sorted(reduced.items())]
+        return groups, kept
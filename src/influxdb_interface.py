@@ -1,33 +1,112 @@
+import gzip
 import requests
+import threading
+import time
 
+from http_transport import HttpTransport
+from influxdb_line_protocol import PRECISION, encode_line, line_prefix, \
+    parse_tag_set
+from yolink_metrics import YoLinkMetrics
 from logger import Logger
 log = Logger.getInstance().getLogger()
 
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 10.0  # seconds
+DEFAULT_REPLAY_BATCH_SIZE = 5000
+DEFAULT_GZIP_LEVEL = 5
 
-class InfluxDbClient(object):
+
+class InfluxDbBatchResult(object):
     """
-        Object representation for influx db interface client.
+    Outcome of a single multi-line POST to influx db.
     """
-    def __init__(self, config, measurement, tag_set):
+    def __init__(self, points, status_code, elapsed=None):
+        """
+        Args:
+            points (int): Number of points in the batch.
+            status_code (int): HTTP status code, -1 if the request
+                could not be sent at all.
+            elapsed (timedelta, optional): Request round trip time.
+        """
+        self.points = points
+        self.status_code = status_code
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.status_code == 204
+
+    @property
+    def retryable(self):
+        """
+        True if the batch may succeed later: not sent at all, a server
+        error or rate limited. Other errors (4xx) reject the points
+        for good.
         """
+        return self.status_code == -1 or self.status_code == 429 or \
+            self.status_code >= 500
+
+    def __str__(self):
+        return ("points: {0} status_code: {1} elapsed: {2}").format(
+            self.points,
+            self.status_code,
+            self.elapsed
+        )
+
+
+class InfluxDbWriter(object):
+    """
+        Shared, buffered influx db writer.
 
+        Points from every device are buffered and sent as one
+        multi-line POST when batchSize points are pending or every
+        flushInterval seconds, whichever comes first. With a spool,
+        batches that fail are written to disk and replayed once
+        influx db accepts writes again. Points carry their event time
+        (ms precision) so late, spooled or replayed points land where
+        they belong. With gzip the request bodies are compressed.
+        With a downsampler, numeric fields are aggregated per window
+        and only the aggregates are written.
+    """
+    def __init__(self, config, on_result=None, spool=None,
+                 downsampler=None):
+        """
         Args:
-            url ([type]): [description]
-            auth ([type]): [description]
-            db_name ([type]): [description]
-            measurement ([type]): [description]
-            tag_set ([type]): [description]
+            config (dict): The influxdb section of the config file.
+            on_result (callable, optional): Called with an
+                InfluxDbBatchResult after every flushed batch.
+            spool (InfluxDbSpool, optional): Write-ahead spool for
+                batches that could not be sent.
+            downsampler (InfluxDbDownsampler, optional): Windowed
+                aggregation of the clients' points.
         """
         self.url = config['url']
         self.auth = (config['auth']['user'],
                      config['auth']['pasw'])
-        self.db = config['dbName']
-        self.params = (
-            ('db', config['dbName']),
-        )
-        self.headers = {'Content-Type': 'application/json'}
-        self.measurement = measurement
-        self.tag_set = tag_set
+        self.set_db(config['dbName'])
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        self.gzip_level = None
+        if config.get('gzip', False):
+            self.gzip_level = int(config.get('gzipLevel',
+                                             DEFAULT_GZIP_LEVEL))
+            self.headers['Content-Encoding'] = 'gzip'
+        self.batch_size = \
+            int(config.get('batchSize', DEFAULT_BATCH_SIZE))
+        self.flush_interval = \
+            float(config.get('flushInterval', DEFAULT_FLUSH_INTERVAL))
+        self.on_result = on_result
+        self.last_result = None
+        self.spool = spool
+        self.downsampler = downsampler
+        self.replay_batch_size = \
+            int(config.get('spool', {}).get('replayBatchSize',
+                                            DEFAULT_REPLAY_BATCH_SIZE))
+
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
 
     def set_url(self, url):
         self.url = url
@@ -39,31 +118,269 @@ class InfluxDbClient(object):
         self.db = db_name
         self.params = (
             ('db', db_name),
+            ('precision', PRECISION)
         )
 
-    def write_data(self, data):
-        # measurement,tag_set field_set=<val>
-        # Example:
-        # weather,location=home temperature=55.5,humidity=70.2
-        data = ("{0},{1} {2}").format(
-            self.measurement,
-            self.tag_set,
-            data
-        )
-        log.debug(data)
-        response = requests.post(url=self.url,
-                                 params=self.params,
-                                 data=data,
-                                 auth=self.auth,
-                                 headers=self.headers)
-        log.debug(response)
-
-        if response.status_code == 204:
-            log.debug(("Successfully sent data to influx db "
-                       "Elapsed time {0}").format(response.elapsed))
+    def start(self):
+        """
+        Start the background flush thread.
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run,
+                                       name='influxdb-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the background flush thread and flush what is left.
+        """
+        self.running = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+        self.aggregate(force=True)
+        self.flush()
+        if self.spool:
+            log.info("Influx db spool depth %s", self.spool.depth())
+            self.spool.close()
+
+    def run(self):
+        """
+        Flush the buffer on every interval tick or when woken up
+        because the batch size was reached.
+        """
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.aggregate()
+            self.flush()
+            self.replay_spool()
+
+    def aggregate(self, force=False) -> int:
+        """
+        Buffer the aggregates of the downsampler's closed windows.
+
+        Args:
+            force (bool, optional): Aggregate open windows too.
+
+        Returns:
+            int: Number of aggregated points.
+        """
+        if not self.downsampler:
+            return 0
+
+        lines = self.downsampler.flush(force)
+        for line in lines:
+            self.write(line)
+        return len(lines)
+
+    def replay_spool(self) -> int:
+        """
+        Send spooled points, if influx db is reachable again.
+
+        Returns:
+            int: Number of replayed points.
+        """
+        if not self.spool:
             return 0
 
-        log.error("Error to send data to influx db {0}".format(
-            response.status_code
-        ))
-        return response.status_code
+        return self.spool.replay(self.send, self.replay_batch_size)
+
+    def pending(self) -> int:
+        return len(self.buffer)
+
+    def write(self, line: str) -> int:
+        """
+        Buffer a line protocol point.
+
+        Args:
+            line (str): measurement,tag_set field_set [timestamp]
+
+        Returns:
+            int: 0, the point is sent later by the flush thread.
+        """
+        with self.lock:
+            self.buffer.append(line)
+            full = len(self.buffer) >= self.batch_size
+
+        if full:
+            self.wakeup.set()
+
+        return 0
+
+    def take_batch(self) -> list:
+        """
+        Remove up to batchSize points from the buffer.
+
+        Returns:
+            list: Line protocol points, empty if nothing is pending.
+        """
+        with self.lock:
+            lines = self.buffer[:self.batch_size]
+            del self.buffer[:self.batch_size]
+
+        return lines
+
+    def flush(self) -> list:
+        """
+        Send all buffered points, batchSize points per POST.
+
+        Returns:
+            list: InfluxDbBatchResult for each batch sent.
+        """
+        results = []
+        lines = self.take_batch()
+        while lines:
+            results.append(self.post(lines))
+            lines = self.take_batch()
+
+        return results
+
+    def post(self, lines: list) -> InfluxDbBatchResult:
+        """
+        Send a batch of line protocol points, spool it if it failed
+        with a retryable error. A rejected batch is dropped.
+
+        Args:
+            lines (list): Line protocol points.
+
+        Returns:
+            InfluxDbBatchResult: Result of the request.
+        """
+        result = self.send(lines)
+        if result.ok:
+            return result
+
+        if not result.retryable:
+            log.error("Influx db rejected %s points (%s), dropped",
+                      len(lines), result.status_code)
+        elif self.spool:
+            self.spool.append(lines)
+
+        return result
+
+    def send(self, lines: list) -> InfluxDbBatchResult:
+        """
+        Send a batch of line protocol points in one request.
+
+        Args:
+            lines (list): Line protocol points.
+
+        Returns:
+            InfluxDbBatchResult: Result of the request.
+        """
+        start = time.time()
+        data = '\n'.join(lines).encode('utf-8')
+        if self.gzip_level is not None:
+            data = gzip.compress(data, self.gzip_level)
+        try:
+            response = HttpTransport.getInstance().post(
+                self.url,
+                params=self.params,
+                data=data,
+                auth=self.auth,
+                headers=self.headers)
+            result = InfluxDbBatchResult(points=len(lines),
+                                         status_code=response.status_code,
+                                         elapsed=response.elapsed)
+        except requests.exceptions.RequestException as e:
+            log.error("Error to send data to influx db %s", e)
+            result = InfluxDbBatchResult(points=len(lines),
+                                         status_code=-1)
+
+        metrics = YoLinkMetrics.getInstance()
+        metrics.observe_stage('influxdb_write', time.time() - start)
+        if not result.ok:
+            metrics.inc_error('influxdb_write')
+
+        if result.ok:
+            log.debug("Successfully sent %s points to influx db Elapsed time "
+                      "%.3fs", result.points, time.time() - start)
+        else:
+            log.error("Error to send %s points to influx db %s",
+                      result.points, result.status_code)
+
+        self.last_result = result
+        if self.on_result:
+            self.on_result(result)
+
+        return result
+
+    def ping(self) -> bool:
+        """
+        Check that influx db is reachable, using the /ping endpoint
+        next to the configured write url.
+
+        Returns:
+            bool: True if influx db answered.
+        """
+        url = self.url.rsplit('/', 1)[0] + '/ping'
+        try:
+            response = HttpTransport.getInstance().get(url, auth=self.auth)
+        except requests.exceptions.RequestException as e:
+            log.error("Influx db is not reachable %s", e)
+            return False
+
+        if response.status_code != 204:
+            log.error("Influx db ping returned %s", response.status_code)
+            return False
+
+        return True
+
+
+class InfluxDbClient(object):
+    """
+        Object representation for influx db interface client.
+
+        One client per sensor, all sharing the same InfluxDbWriter.
+        The escaped measurement,tag_set prefix is built once.
+    """
+    def __init__(self, writer, measurement, tag_set=None, tags=None,
+                 raw=False):
+        """
+
+        Args:
+            writer (InfluxDbWriter): Shared buffered writer.
+            measurement (str): Influx db measurement.
+            tag_set (str, optional): Influx db tag set, key=value,...
+            tags (dict, optional): Tags, merged over tag_set.
+            raw (bool, optional): Write every point even if the
+                writer downsamples.
+        """
+        self.writer = writer
+        self.measurement = measurement
+        self.tags = parse_tag_set(tag_set)
+        self.tags.update(tags or {})
+        self.prefix = line_prefix(measurement, self.tags)
+        self.downsampler = None if raw else writer.downsampler
+
+    def write_data(self, fields, timestamp=None):
+        """
+        Write a point.
+
+        Args:
+            fields (dict): Field key -> value, typed on encoding.
+            timestamp (int, optional): Event time in ms since the
+                epoch. Defaults to None (influx db arrival time).
+
+        Returns:
+            int: 0 if the point was buffered, -1 if it had no fields.
+        """
+        # measurement,tag_set field_set timestamp
+        # Example:
+        # weather,location=home temperature=55.5,humidity=70.2 1700000000000
+        if self.downsampler:
+            if not any(value is not None for value in fields.values()):
+                return -1
+            fields = self.downsampler.add(self.prefix, fields, timestamp)
+            if not fields:
+                return 0
+
+        line = encode_line(self.prefix, fields, timestamp)
+        if line is None:
+            return -1
+
+        log.debug(line)
+        return self.writer.write(line)
@@ -0,0 +1,141 @@
+import functools
+import math
+
+# Timestamps are the YoLink payload time, ms since the epoch.
+PRECISION = 'ms'
+
+# https://docs.influxdata.com/influxdb/v1.8/write_protocols/line_protocol_reference/#special-characters
+# Influx db 1.x has no newline escape, newlines become an (escaped)
+# space. Points are one per line in batches and the spool, so string
+# values lose their newlines too.
+MEASUREMENT_ESCAPES = str.maketrans({
+    '\\': '\\\\', ',': '\\,', ' ': '\\ ', '\n': '\\ ', '\r': '\\ '})
+KEY_ESCAPES = str.maketrans({
+    '\\': '\\\\', ',': '\\,', '=': '\\=', ' ': '\\ ', '\n': '\\ ',
+    '\r': '\\ '})
+STRING_ESCAPES = str.maketrans({
+    '\\': '\\\\', '"': '\\"', '\n': ' ', '\r': ' '})
+
+
+@functools.lru_cache(maxsize=1024)
+def escape_key(key: str) -> str:
+    """
+    Escape a tag key, tag value or field key.
+    """
+    return str(key).translate(KEY_ESCAPES)
+
+
+def format_value(value):
+    """
+    Typed line protocol field value: booleans as true/false, integers
+    with the i suffix, floats as is and everything else as a quoted
+    string.
+
+    Args:
+        value: Field value.
+
+    Returns:
+        str: The encoded value, None for values influx db cannot store
+        (NaN, infinity).
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{0}i'.format(value)
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        return repr(value)
+    return '"{0}"'.format(str(value).translate(STRING_ESCAPES))
+
+
+def parse_tag_set(tag_set: str) -> dict:
+    """
+    Split a tagSet string from the config (key=value,key=value) into
+    tags. Backslash escaped commas and equal signs are kept.
+
+    Args:
+        tag_set (str): Tag set, may be empty or None.
+
+    Returns:
+        dict: Tag key -> tag value, unescaped.
+    """
+    tags = dict()
+    if not tag_set:
+        return tags
+
+    pairs = ['']
+    escaped = False
+    for char in tag_set:
+        if escaped:
+            pairs[-1] += char
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == ',':
+            pairs.append('')
+        else:
+            # Mark unescaped separators, the only ones that split.
+            pairs[-1] += '\0' if char == '=' else char
+
+    for pair in pairs:
+        if '\0' not in pair:
+            raise ValueError("Invalid tag {0!r} in tagSet {1!r}".format(
+                pair, tag_set))
+        key, value = pair.split('\0', 1)
+        tags[key] = value.replace('\0', '=')
+
+    return tags
+
+
+def line_prefix(measurement: str, tags=None) -> str:
+    """
+    Escaped measurement,tag_set part of a point, tags sorted by key as
+    influx db prefers. Computed once per series.
+
+    Args:
+        measurement (str): Measurement name.
+        tags (dict, optional): Tag key -> tag value. Empty values are
+            left out, influx db rejects them.
+
+    Returns:
+        str: measurement[,tag=value...] followed by a space.
+    """
+    parts = [str(measurement).translate(MEASUREMENT_ESCAPES)]
+    for key in sorted(tags or {}):
+        value = tags[key]
+        if value is None or value == '':
+            continue
+        parts.append('{0}={1}'.format(escape_key(key), escape_key(value)))
+
+    return ','.join(parts) + ' '
+
+
+def encode_line(prefix: str, fields: dict, timestamp=None) -> str:
+    """
+    Encode one point.
+
+    Args:
+        prefix (str): See line_prefix().
+        fields (dict): Field key -> value, None values are left out.
+        timestamp (int, optional): Point time in ms since the epoch,
+            left out to let influx db use the arrival time.
+
+    Returns:
+        str: The line, None if no field has a value.
+    """
+    field_set = []
+    for key, value in fields.items():
+        if value is None:
+            continue
+        value = format_value(value)
+        if value is not None:
+            field_set.append(escape_key(key) + '=' + value)
+
+    if not field_set:
+        return None
+
+    line = prefix + ','.join(field_set)
+    if timestamp is not None:
+        line += ' {0:d}'.format(int(timestamp))
+    return line
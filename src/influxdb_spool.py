@@ -0,0 +1,283 @@
+import os
+import threading
+
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+DEFAULT_SPOOL_DIR = 'influxdb_spool'
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024  # 64MB
+DEFAULT_SEGMENT_BYTES = 1 * 1024 * 1024  # 1MB
+SEGMENT_SUFFIX = '.lp'
+# Replay position in the oldest segment: "<seq> <points>".
+OFFSET_FILE = 'replay.offset'
+
+EVICT_OLDEST = 'dropOldest'
+EVICT_NEWEST = 'dropNewest'
+
+
+class InfluxDbSpool(object):
+    """
+    Append-only, on-disk spool of line protocol points that could not
+    be sent to influx db.
+
+    Points are appended to numbered segment files in a directory, so
+    the spool survives restarts. Segments are replayed and deleted
+    oldest first once influx db is reachable again, the replay
+    position is kept on disk so a restart does not send points twice.
+    """
+    def __init__(self, directory=DEFAULT_SPOOL_DIR,
+                 max_bytes=DEFAULT_MAX_BYTES,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 eviction=EVICT_OLDEST):
+        """
+        Args:
+            directory (str, optional): Segment file directory.
+            max_bytes (int, optional): Size cap of all segments.
+            segment_bytes (int, optional): Segment size before a new
+                segment is started.
+            eviction (str, optional): dropOldest deletes the oldest
+                segment when the cap is hit, dropNewest refuses the
+                new points.
+        """
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.segment_bytes = int(segment_bytes)
+        self.eviction = eviction
+        self.lock = threading.Lock()
+
+        # seq -> [bytes, points]
+        self.segments = dict()
+        self.evicted = 0
+        self.active = None
+        self.active_fp = None
+        # Points of the oldest segment already replayed.
+        self.replay_offset = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.load()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Args:
+            config (dict): The influxdb.spool section of the config.
+
+        Returns:
+            InfluxDbSpool: The spool.
+        """
+        return cls(directory=config.get('directory', DEFAULT_SPOOL_DIR),
+                   max_bytes=config.get('maxBytes', DEFAULT_MAX_BYTES),
+                   segment_bytes=config.get('segmentBytes',
+                                            DEFAULT_SEGMENT_BYTES),
+                   eviction=config.get('eviction', EVICT_OLDEST))
+
+    def path(self, seq: int) -> str:
+        return os.path.join(self.directory,
+                            "{0:012d}{1}".format(seq, SEGMENT_SUFFIX))
+
+    def load(self):
+        """
+        Pick up segments left by a previous run and start a new
+        active segment after them.
+        """
+        for fname in os.listdir(self.directory):
+            if not fname.endswith(SEGMENT_SUFFIX):
+                continue
+
+            try:
+                seq = int(fname[:-len(SEGMENT_SUFFIX)])
+            except ValueError:
+                log.warning("Ignoring %s in influx db spool %s", fname,
+                            self.directory)
+                continue
+
+            with open(self.path(seq), 'rb+') as fp:
+                data = fp.read()
+                # Cut off a torn write from a crash, keep whole lines.
+                good = data.rfind(b'\n') + 1
+                if good < len(data):
+                    log.warning("Dropping torn point at the end of %s",
+                                self.path(seq))
+                    data = data[:good]
+                    fp.truncate(good)
+
+            if not data:
+                os.remove(self.path(seq))
+                continue
+
+            self.segments[seq] = [len(data), data.count(b'\n')]
+
+        self.load_offset()
+        if self.segments:
+            log.info("Influx db spool has %s points from a previous run",
+                     self.depth()['points'])
+
+        self.rotate()
+
+    def load_offset(self):
+        """
+        Restore the replay position saved by a previous run, if it is
+        for the oldest segment.
+        """
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as fp:
+                seq, offset = (int(part) for part in fp.read().split())
+        except (OSError, ValueError):
+            return
+
+        if self.segments and seq == min(self.segments):
+            self.replay_offset = min(offset, self.segments[seq][1])
+
+    def save_offset(self, seq: int):
+        """
+        Persist the replay position, called with the lock held.
+        """
+        path = os.path.join(self.directory, OFFSET_FILE)
+        if not self.replay_offset:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        with open(path + '.tmp', 'w') as fp:
+            fp.write("{0} {1}\n".format(seq, self.replay_offset))
+        os.replace(path + '.tmp', path)
+
+    def rotate(self):
+        """
+        Close the active segment and start a new one.
+        """
+        if self.active_fp:
+            self.active_fp.close()
+            if self.segments[self.active][0] == 0:
+                os.remove(self.path(self.active))
+                del self.segments[self.active]
+
+        self.active = max(self.segments, default=0) + 1
+        self.segments[self.active] = [0, 0]
+        self.active_fp = open(self.path(self.active), 'ab')
+
+    def size(self) -> int:
+        return sum(seg[0] for seg in self.segments.values())
+
+    def depth(self) -> dict:
+        """
+        Returns:
+            dict: Spooled points, bytes, segments and evicted points.
+        """
+        with self.lock:
+            return {
+                'points': sum(seg[1] for seg in self.segments.values()) -
+                self.replay_offset,
+                'bytes': self.size(),
+                'segments': len([seg for seg in self.segments.values()
+                                 if seg[1]]),
+                'evicted': self.evicted
+            }
+
+    def append(self, lines: list) -> bool:
+        """
+        Spool points.
+
+        Args:
+            lines (list): Line protocol points.
+
+        Returns:
+            bool: False if the points were refused (dropNewest).
+        """
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+
+        with self.lock:
+            while self.size() + len(data) > self.max_bytes:
+                oldest = min(self.segments)
+                if self.eviction == EVICT_NEWEST or oldest == self.active:
+                    self.evicted += len(lines)
+                    log.error("Influx db spool full, dropped %s new points",
+                              len(lines))
+                    return False
+
+                self.evict(oldest)
+
+            self.active_fp.write(data)
+            self.active_fp.flush()
+            seg = self.segments[self.active]
+            seg[0] += len(data)
+            seg[1] += len(lines)
+
+            if seg[0] >= self.segment_bytes:
+                self.rotate()
+
+        return True
+
+    def evict(self, seq: int):
+        points = self.segments[seq][1]
+        if seq == min(self.segments):
+            points -= self.replay_offset
+            self.replay_offset = 0
+            self.save_offset(seq)
+
+        self.evicted += points
+        os.remove(self.path(seq))
+        del self.segments[seq]
+        log.error("Influx db spool full, evicted %s oldest points", points)
+
+    def replay(self, send, batch_size: int) -> int:
+        """
+        Send spooled points oldest first, stopping at the first batch
+        that failed with a retryable error. Batches influx db rejected
+        (4xx) are dropped. Each segment is deleted once fully sent.
+
+        Args:
+            send (callable): lines -> InfluxDbBatchResult.
+            batch_size (int): Points per request.
+
+        Returns:
+            int: Number of points sent.
+        """
+        sent = 0
+        while True:
+            with self.lock:
+                pending = [seq for seq, seg in self.segments.items()
+                           if seg[1]]
+                if not pending:
+                    return sent
+
+                seq = min(pending)
+                if seq == self.active:
+                    self.rotate()
+
+                offset = self.replay_offset
+                with open(self.path(seq), 'rb') as fp:
+                    lines = fp.read().decode('utf-8').splitlines()
+
+            for idx in range(offset, len(lines), batch_size):
+                batch = lines[idx:idx + batch_size]
+                result = send(batch)
+                if result.ok:
+                    sent += len(batch)
+                elif result.retryable:
+                    return sent
+                else:
+                    log.error("Influx db rejected %s spooled points (%s), "
+                              "dropped", len(batch), result.status_code)
+
+                with self.lock:
+                    if seq not in self.segments:
+                        # Evicted while sending.
+                        break
+                    self.replay_offset = idx + len(batch)
+                    self.save_offset(seq)
+
+            with self.lock:
+                if seq in self.segments:
+                    os.remove(self.path(seq))
+                    del self.segments[seq]
+                self.replay_offset = 0
+                self.save_offset(seq)
+
+            log.info("Replayed spooled segment %s, %s points", seq, len(lines))
+
+    def close(self):
+        with self.lock:
+            if self.active_fp:
+                self.active_fp.close()
+                self.active_fp = None
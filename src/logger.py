@@ -1,6 +1,9 @@
+import atexit
+import json
 import logging
+import queue
 
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 FILE = 'yolinkv2.log'
 FILE_MAXSIZE = 1 * 1024 * 1024  # 1MB
@@ -19,8 +22,60 @@ class SingletonType(type):
         return cls._instances[cls]
 
 
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, for log shippers.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, DATE_FORMAT),
+            'level': record.levelname,
+            'module': record.module,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        sample_every = getattr(record, 'sample_every', None)
+        if sample_every:
+            entry['sampleEvery'] = sample_every
+
+        return json.dumps(entry)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Let through the first and then every Nth record of each logging
+    call site at or below max_level. Warnings and errors always pass.
+
+    Records are counted per call site rather than per message, so
+    preformatted or non str messages (e.g. a logged dict) neither
+    break the filter nor grow the counts without bound.
+    """
+    def __init__(self, every, max_level=logging.INFO):
+        super(SamplingFilter, self).__init__()
+        self.every = max(1, int(every))
+        self.max_level = max_level
+        self.counts = dict()
+
+    def filter(self, record):
+        if record.levelno > self.max_level or self.every == 1:
+            return True
+
+        key = (record.pathname, record.lineno)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if count % self.every:
+            return False
+
+        record.sample_every = self.every
+        return True
+
+
 class Logger(object, metaclass=SingletonType):
-    """_summary_
+    """
+    Process wide logger.
+
+    Callers only put records on a queue, a QueueListener thread does
+    the console and file I/O so logging never blocks the consumer.
 
     Args:
         object (_type_): _description_
@@ -39,10 +94,73 @@ class Logger(object, metaclass=SingletonType):
         formatter = logging.Formatter(LOG_FORMAT, DATE_FORMAT)
         handler.setFormatter(formatter)
 
-        self.logger.addHandler(handler)
         rotate_file_handler = RotatingFileHandler(fname, maxBytes, backupCount)
+        self.handlers = [handler, rotate_file_handler]
+
+        self.queue_handler = QueueHandler(queue.SimpleQueue())
+        self.logger.addHandler(self.queue_handler)
+        self.listener = QueueListener(self.queue_handler.queue,
+                                      *self.handlers,
+                                      respect_handler_level=True)
+        self.listener.start()
+        # Flush what is queued before the interpreter goes away.
+        atexit.register(self.stop)
+
+    def configure(self, config=None):
+        """
+        Apply the logging section of the config file.
+
+        Args:
+            config (dict, optional): json (bool) for one JSON object per
+                line, sampleEvery (int) to keep only every Nth debug/info
+                record of the same message.
+        """
+        config = config or {}
+        if config.get('json', False):
+            for handler in self.handlers:
+                handler.setFormatter(JsonFormatter())
+
+        sample_every = int(config.get('sampleEvery', 1))
+        if sample_every > 1:
+            self.queue_handler.addFilter(SamplingFilter(sample_every))
+
+    def forward(self, log_queue):
+        """
+        Send records to another process instead of writing them, for
+        worker processes. The parent writes them with its handlers,
+        see listen(), so only one process owns the rotating log file.
+
+        Args:
+            log_queue (multiprocessing.Queue): The parent's queue.
+        """
+        self.stop()
+        for handler in self.handlers:
+            handler.close()
+        self.handlers = []
+        self.queue_handler.queue = log_queue
+
+    def listen(self, log_queue) -> QueueListener:
+        """
+        Write the records that worker processes forward, see
+        forward().
+
+        Args:
+            log_queue (multiprocessing.Queue): Queue the workers
+                forward to.
+
+        Returns:
+            QueueListener: The started listener, stop it after the
+            workers exited.
+        """
+        listener = QueueListener(log_queue, *self.handlers,
+                                 respect_handler_level=True)
+        listener.start()
+        return listener
 
-        self.logger.addHandler(rotate_file_handler)
+    def stop(self):
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
 
     def getLogger(self):
         return self.logger
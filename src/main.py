@@ -1,20 +1,33 @@
 import argparse
+import functools
 import json
 import logging
 import os
-import queue
+import signal
 import sys
+import threading
+import time
+import yolink_json
 
-from time import sleep
-from yolink_token import YoLinkToken
 from yolink_devices import YoLinkFactory
-from yolink_consumer import YoLinkConsumer, YoLinkApi
-from influxdb_interface import InfluxDbClient
-from yolink_mqtt_client import YoLinkMqttClient, MqttClient
+from yolink_device_types import YoLinkDeviceRegistry
+from yolink_consumer import YoLinkConsumerPool, YoLinkShardedDispatcher, \
+    coalesce_key_func
+from http_transport import HttpTransport
+from yolink_async_runtime import YoLinkAsyncRuntime
+from yolink_queue import create_queue, DEFAULT_COALESCE_EXCLUDE
+from yolink_home import YoLinkHome, home_configs
+from yolink_metrics import YoLinkMetrics
+from yolink_profiler import YoLinkProfiler
+from yolink_workers import YoLinkProcessDispatcher, DEFAULT_BATCH_SIZE
+from yolink_setup import LOCAL_MQTT_TIMEOUT, attach_influxdb_clients, \
+    attach_sinks, create_dedup, create_influxdb_writer, \
+    create_local_mqtt_server, create_sinks
+from yolink_startup import StartupGraph
 from logger import Logger
 log = Logger.getInstance().getLogger()
 
-Q_SIZE = 64
+DEFAULT_CONSUMER_WORKERS = 1
 
 
 def parse_config_file(fname: str) -> dict:
@@ -32,46 +45,284 @@ def parse_config_file(fname: str) -> dict:
         return data
 
 
-def configure_influxdb_devices(device_hash, config):
+def build_device_hash(devices, registry) -> dict:
     """
-    Configure influx db devices.
+    Create the YoLinkDevice objects for a YoLink device list. Devices
+    of skipped or undescribed types are left out.
 
     Args:
-        device_hash (map): Device hash map.
+        devices (list): Device list as returned by get_all_devices().
+        registry (YoLinkDeviceRegistry): Compiled device types.
+
+    Returns:
+        dict: deviceId -> YoLinkDevice.
+    """
+    device_hash = dict()
+
+    for device in devices:
+        device_type = device['type']
+        device_name = device['name']
+        log.debug("%s %s", device_type, device_name)
+
+        yolink_device = YoLinkFactory(registry, device)
+        if yolink_device is None:
+            continue
+
+        device_hash[yolink_device.get_id()] = yolink_device
+
+    return device_hash
+
+
+def add_home_devices(home, device_hash, registry, config,
+                     influxdb_writer=None, mqtt_server=None, sinks=None):
+    """
+    Add a started home's devices, with their sinks, to the shared
+    device hash and create its broker client.
+
+    Args:
+        home (YoLinkHome): The started home.
+        device_hash (map): Shared device hash map.
+        registry (YoLinkDeviceRegistry): Compiled device types.
         config (map): Config hash map.
+        influxdb_writer (InfluxDbWriter, optional): Shared writer.
+        mqtt_server (MqttClient, optional): Local broker client.
+        sinks (YoLinkFanout, optional): Per sink queues and workers.
+
+    Returns:
+        YoLinkMqttClient: The home's client, not yet connected.
     """
-    influxdb_info = config['influxdb']
-    if len(influxdb_info['sensors']) == 0:
-        log.debug("No sensors are configured for influx db")
-        return
+    fresh = build_device_hash(home.devices, registry)
+    if influxdb_writer:
+        attach_influxdb_clients(fresh, config, influxdb_writer)
+    attach_sinks(fresh.values(), mqtt_server, sinks)
 
-    for sensor in influxdb_info['sensors']:
-        device_id = sensor['deviceId']
-        if device_id in device_hash:
-            client = \
-                InfluxDbClient(config=influxdb_info,
-                               measurement=sensor['measurement'],
-                               tag_set=sensor['tagSet'])
-            device_hash[device_id].set_influxdb_client(client)
+    for device_id in set(fresh) & set(device_hash):
+        log.warning("Device %s is in more than one home", device_id)
+    home.device_ids = set(fresh)
+    device_hash.update(fresh)
+    log.info("Home %s: %s devices", home.name, len(fresh))
 
+    if home.warm_start:
+        threading.Thread(target=revalidate_cache,
+                         args=(home, device_hash, registry, config,
+                               influxdb_writer, mqtt_server, sinks),
+                         daemon=True).start()
 
-def configure_local_mqtt_server(device_hash, config):
+    return home.create_client(device_hash)
+
+
+def revalidate_cache(home, device_hash, registry, config,
+                     influxdb_writer=None, mqtt_server=None, sinks=None):
     """
-    Need to publish to another broker to distinguish between
-    each of the YoLink devices. All YoLink devices publish
-    to the same topic (CSName/report)
+    Check a warm start against the cloud API and refresh the cache.
+    Devices added since the cache was written are picked up, removed
+    ones are dropped. Runs on its own thread.
 
     Args:
-        device_hash (map): Device hash map.
+        home (YoLinkHome): Home started from its cache.
+        device_hash (map): Live, shared device hash map.
+        registry (YoLinkDeviceRegistry): Compiled device types.
         config (map): Config hash map.
+        influxdb_writer (InfluxDbWriter, optional): Shared writer for
+            new devices.
+        mqtt_server (MqttClient, optional): Local broker for new
+            devices.
+        sinks (YoLinkFanout, optional): Sink fan-out for new devices.
     """
-    mqtt_server = \
-        MqttClient(config=config['mqttBroker'])
+    yolink_api = home.yolink_api
+    yolink_api.access_token = home.yolink_token.access_token
+    devices = yolink_api.get_all_devices()
+    cloud_home_id = yolink_api.get_home_id()
+    if not devices or not cloud_home_id:
+        log.error("Home %s: cache revalidation failed, keeping cached "
+                  "inventory", home.name)
+        return
 
-    mqtt_server.connect_to_broker()
+    fresh = build_device_hash(devices, registry)
+    for device_id in home.device_ids - set(fresh):
+        log.info("Device %s no longer in home %s, removed",
+                 device_id, home.name)
+        device_hash.pop(device_id, None)
+    new = {device_id: fresh[device_id]
+           for device_id in set(fresh) - home.device_ids}
+    if influxdb_writer:
+        attach_influxdb_clients(new, config, influxdb_writer)
+    attach_sinks(new.values(), mqtt_server, sinks)
+    for device_id in new:
+        log.info("New device %s added to home %s", device_id, home.name)
+        device_hash[device_id] = new[device_id]
+    home.device_ids = set(fresh)
+
+    if cloud_home_id != home.home_id:
+        log.error("YoLink home %s id changed from %s to %s, restart to "
+                  "subscribe to the new home", home.name, home.home_id,
+                  cloud_home_id)
+
+    home.cache.update(homeId=cloud_home_id, devices=devices)
+    log.info("Home %s: cache revalidated, %s devices",
+             home.name, len(fresh))
+
+
+def register_metrics(homes, influxdb_writer=None, mqtt_server=None,
+                     dedup=None, sinks=None):
+    """
+    Expose queue, token, sink and dedup state as scrape time gauges.
 
-    for deviceid in device_hash:
-        device_hash[deviceid].set_mqtt_server(mqtt_server)
+    Args:
+        homes (list): The YoLinkHome objects, broker and token state
+            is labelled per home. Their clients' shared input_q is
+            read at scrape time.
+        influxdb_writer (InfluxDbWriter, optional): Shared writer.
+        mqtt_server (MqttClient, optional): Local broker client.
+        dedup (YoLinkDedup, optional): Duplicate/stale event filter.
+        sinks (YoLinkFanout, optional): Per sink queues and workers.
+    """
+    metrics = YoLinkMetrics.getInstance()
+
+    def input_queue():
+        for home in homes:
+            client = home.yolink_mqtt_client
+            if client and client.input_q:
+                return client.input_q
+        return None
+
+    def queue_stat(key):
+        input_q = input_queue()
+        return input_q.stats().get(key) if input_q else None
+
+    def worker_stat(key):
+        worker_stats = getattr(input_queue(), 'worker_stats', None)
+        if worker_stats is None:
+            return None
+        return {(('worker', str(idx)),): stats[key]
+                for idx, stats in enumerate(worker_stats())}
+
+    def shard_depth():
+        shard_depths = getattr(input_queue(), 'shard_depths', None)
+        if shard_depths is None:
+            return None
+        return {(('shard', str(idx)),): depth
+                for idx, depth in enumerate(shard_depths())}
+
+    def per_home(func):
+        return lambda: {(('home', home.name),): func(home)
+                        for home in homes}
+
+    def token_age(home):
+        access_token_t = home.yolink_token.access_token_t
+        return time.time() - access_token_t if access_token_t else None
+
+    metrics.add_gauge('yolink_queue_depth',
+                      'Entries waiting in the ingest queue.',
+                      lambda: queue_stat('size'))
+    metrics.add_gauge('yolink_queue_spill_depth',
+                      'Entries waiting in the ingest spill file.',
+                      lambda: queue_stat('spillDepth'))
+    metrics.add_gauge('yolink_queue_dropped_total',
+                      'Entries dropped by the ingest queue policy.',
+                      lambda: queue_stat('dropped'), type='counter')
+    metrics.add_gauge('yolink_queue_merged_total',
+                      'Entries merged by the coalescing queue.',
+                      lambda: queue_stat('merged'), type='counter')
+    metrics.add_gauge('yolink_shard_queue_depth',
+                      'Entries waiting in each consumer shard queue.',
+                      shard_depth)
+    metrics.add_gauge('yolink_worker_processed_total',
+                      'Entries processed per worker process.',
+                      lambda: worker_stat('processed'), type='counter')
+    metrics.add_gauge('yolink_worker_failed_total',
+                      'Entries that failed per worker process.',
+                      lambda: worker_stat('failed'), type='counter')
+    metrics.add_gauge('yolink_worker_backlog',
+                      'Entries waiting to be sent to each worker process.',
+                      lambda: worker_stat('backlog'))
+    metrics.add_gauge('yolink_home_up',
+                      'YoLink broker connection per home, 1 if connected.',
+                      per_home(lambda home: int(home.stats()['connected'])))
+    metrics.add_gauge('yolink_home_failures_total',
+                      'Failed startup steps and broker connections per '
+                      'home.',
+                      per_home(lambda home: home.failures), type='counter')
+    metrics.add_gauge('yolink_received_total',
+                      'Messages received per home.',
+                      per_home(lambda home: home.stats().get('received')),
+                      type='counter')
+    metrics.add_gauge('yolink_rejected_total',
+                      'Messages for unknown devices per home.',
+                      per_home(lambda home: home.stats().get('rejected')),
+                      type='counter')
+    metrics.add_gauge('yolink_reconnects_total',
+                      'YoLink broker reconnects per home.',
+                      per_home(lambda home: home.stats().get('reconnects')),
+                      type='counter')
+    metrics.add_gauge('yolink_reconnect_last_seconds',
+                      'Duration of the last YoLink broker reconnect per '
+                      'home.',
+                      per_home(lambda home: home.stats().get('lastDuration')))
+    metrics.add_gauge('yolink_reconnect_max_seconds',
+                      'Longest YoLink broker reconnect per home.',
+                      per_home(lambda home: home.stats().get('maxDuration')))
+    metrics.add_gauge('yolink_token_age_seconds',
+                      'Age of the YoLink access token per home.',
+                      per_home(token_age))
+
+    if influxdb_writer:
+        metrics.add_gauge('yolink_influxdb_pending_points',
+                          'Points buffered for the next influx db batch.',
+                          influxdb_writer.pending)
+        if influxdb_writer.spool:
+            metrics.add_gauge('yolink_influxdb_spool_points',
+                              'Points waiting in the influx db spool.',
+                              lambda: influxdb_writer.spool.depth()['points'])
+        downsampler = influxdb_writer.downsampler
+        if downsampler:
+            metrics.add_gauge('yolink_influxdb_downsample_buffered',
+                              'Values waiting for their window to close.',
+                              downsampler.buffered)
+            metrics.add_gauge('yolink_influxdb_downsample_late_total',
+                              'Points dropped, their window was written.',
+                              lambda: downsampler.late, type='counter')
+
+    if sinks:
+        def sink_stat(key):
+            return lambda: {(('sink', name),): stats[key]
+                            for name, stats in sinks.stats().items()}
+
+        metrics.add_gauge('yolink_sink_queue_depth',
+                          'Events waiting in each sink queue.',
+                          sink_stat('size'))
+        metrics.add_gauge('yolink_sink_dropped_total',
+                          'Events dropped by each sink queue policy.',
+                          sink_stat('dropped'), type='counter')
+        metrics.add_gauge('yolink_sink_written_total',
+                          'Events written per sink.',
+                          sink_stat('written'), type='counter')
+        metrics.add_gauge('yolink_sink_failed_total',
+                          'Events a sink failed to write after retries.',
+                          sink_stat('failed'), type='counter')
+
+    if mqtt_server:
+        metrics.add_gauge('yolink_mqtt_suppressed_total',
+                          'Unchanged states not republished.',
+                          lambda: mqtt_server.suppressed, type='counter')
+
+    if dedup:
+        metrics.add_gauge('yolink_dedup_total',
+                          'Events dropped as duplicate or stale.',
+                          lambda: {(('result', 'duplicate'),):
+                                   dedup.stats()['hits'],
+                                   (('result', 'stale'),):
+                                   dedup.stats()['stale']},
+                          type='counter')
+
+
+def handle_sigterm(signum, frame):
+    """
+    Turn SIGTERM (docker stop, systemctl stop) into a regular exit
+    so the consumer workers get a chance to drain the queue.
+    """
+    log.info("Received signal %s, shutting down", signum)
+    sys.exit(0)
 
 
 def main(argv):
@@ -90,67 +341,196 @@ def main(argv):
         log.setLevel(logging.DEBUG)
 
     config = parse_config_file(args.config)
-    yolinkv2_config = config['yoLink']['apiv2']
+    Logger.getInstance().configure(config.get('logging'))
+    http_transport = HttpTransport.getInstance(config=config.get('http'))
+    yolink_json.set_backend(
+        config.get('consumer', {}).get('jsonBackend', 'auto'))
     localMqttEnabled = config['features']['localMQTT']
     influxDbEnabled = config['features']['influxDB']
+    asyncioEnabled = config['features'].get('asyncio', False)
+    workerProcesses = config.get('consumer', {}).get('processes', 0)
+    if workerProcesses and asyncioEnabled:
+        log.warning("Worker processes are not supported by the asyncio "
+                    "runtime, ignored")
+        workerProcesses = 0
+
+    registry = YoLinkDeviceRegistry.from_config(config.get('devices'))
+    homes = [YoLinkHome(name, apiv2, cache_config=config.get('cache'))
+             for name, apiv2 in home_configs(config)]
+    for home in homes:
+        home.load_cache()
+
+    def connect_influxdb():
+        if not influxDbEnabled or workerProcesses:
+            return None
+        log.info("Influx DB Enabled")
+        return create_influxdb_writer(config, start=not asyncioEnabled,
+                                      ping=True)
 
-    yolink_token = \
-        YoLinkToken(url=yolinkv2_config['tokenUrl'],
-                    ua_id=yolinkv2_config['uaId'],
-                    sec_id=yolinkv2_config['secId'])
-    access_token = yolink_token.get_access_token()
-    log.debug(access_token)
+    def connect_local_mqtt():
+        if not localMqttEnabled or workerProcesses:
+            return None
+        log.info("MQTT Broker Enabled")
+        return create_local_mqtt_server(config,
+                                        connect=not asyncioEnabled,
+                                        timeout=LOCAL_MQTT_TIMEOUT)
 
-    yolink_api = \
-        YoLinkApi(api_url=yolinkv2_config['apiUrl'],
-                  access_token=access_token)
-    devices = yolink_api.get_all_devices()
-    home_id = yolink_api.get_home_id()
+    def connect_sinks(influxdb, local_mqtt):
+        # The asyncio runtime writes inline, its sinks do not block.
+        if asyncioEnabled or workerProcesses:
+            return None
+        return create_sinks(config, influxdb, local_mqtt)
 
     device_hash = dict()
-    yolink_device = None
-
-    for device in devices:
-        device_type = device['type']
-        device_name = device['name']
-        log.debug("{} {}".format(
-            device_type,
-            device_name
-        ))
-
-        if (device_type == 'Hub' or device_type == 'Siren'):
-            continue
 
-        yolink_device = YoLinkFactory(device_type, device)
-        device_hash[yolink_device.get_id()] = yolink_device
-
-    if influxDbEnabled:
-        log.info("Influx DB Enabled")
-        configure_influxdb_devices(device_hash, config)
-    if localMqttEnabled:
-        log.info("MQTT Broker Enabled")
-        configure_local_mqtt_server(device_hash, config)
+    def join_homes(influxdb, local_mqtt, sinks, **home_phases):
+        for home in homes:
+            if home.ready():
+                add_home_devices(home, device_hash, registry, config,
+                                 influxdb, local_mqtt, sinks)
+        if not any(home.started for home in homes):
+            raise RuntimeError("No YoLink home could be started")
+        return device_hash
+
+    # Startup as a dependency graph: the cloud lookups of every home
+    # and the sink connections do not depend on each other and run
+    # concurrently. A failing home does not fail the startup, it is
+    # retried by the runtime.
+    startup = StartupGraph(workers=2 * len(homes) + 2)
+    home_phases = []
+    for home in homes:
+        token = 'token_' + home.name
+        startup.add(token, home.phase(home.get_token))
+        startup.add('devices_' + home.name, home.phase(home.get_devices),
+                    deps=(token,))
+        startup.add('home_id_' + home.name, home.phase(home.get_home_id),
+                    deps=(token,))
+        home_phases += ['devices_' + home.name, 'home_id_' + home.name]
+    startup.add('influxdb', connect_influxdb)
+    startup.add('local_mqtt', connect_local_mqtt)
+    startup.add('sinks', connect_sinks, deps=('influxdb', 'local_mqtt'))
+    startup.add('device_hash', join_homes,
+                deps=['influxdb', 'local_mqtt', 'sinks'] + home_phases)
+    phases = startup.run()
+
+    influxdb_writer = phases['influxdb']
+    mqtt_server = phases['local_mqtt']
+    sinks = phases['sinks']
+    # Late homes join the shared pipeline the same way.
+    join = functools.partial(add_home_devices, device_hash=device_hash,
+                             registry=registry, config=config,
+                             influxdb_writer=influxdb_writer,
+                             mqtt_server=mqtt_server, sinks=sinks)
 
     log.debug(device_hash)
-    input_q = queue.Queue(maxsize=Q_SIZE)
-    consumer = YoLinkConsumer(name='consumer',
-                              args=(input_q, device_hash,))
-    consumer.start()
-    sleep(1)
-
-    mqtt_topic = \
-        yolinkv2_config['mqtt']['topic'].format(home_id)
-
-    yolink_mqtt_server = \
-        YoLinkMqttClient(username=access_token,
-                         passwd=None,
-                         topic=mqtt_topic,
-                         mqtt_url=yolinkv2_config['mqtt']['url'],
-                         mqtt_port=yolinkv2_config['mqtt']['port'],
-                         device_hash=device_hash,
-                         input_q=input_q,
-                         yolink_token=yolink_token)
-    yolink_mqtt_server.connect_to_broker()
+    # Worker processes own their dedup state and sinks.
+    dedup = None if workerProcesses else create_dedup(config)
+
+    metrics_config = config.get('metrics', {})
+    if metrics_config.get('enabled', False):
+        register_metrics(homes, influxdb_writer, mqtt_server, dedup,
+                         sinks)
+        YoLinkMetrics.getInstance().start_server(metrics_config)
+
+    profiling_config = config.get('profiling', {})
+    if profiling_config.get('enabled', False):
+        profiler = YoLinkProfiler.getInstance()
+        profiler.configure(profiling_config)
+        if metrics_config.get('enabled', False):
+            profiler.register_routes(YoLinkMetrics.getInstance())
+
+    try:
+        if asyncioEnabled:
+            log.info("asyncio runtime Enabled")
+            YoLinkAsyncRuntime(homes=homes,
+                               join=join,
+                               device_hash=device_hash,
+                               mqtt_server=mqtt_server,
+                               influxdb_writer=influxdb_writer,
+                               queue_config=config.get('queue'),
+                               dedup=dedup).run()
+        else:
+            run_threaded(homes, join, device_hash, influxdb_writer,
+                         config, dedup, sinks)
+    finally:
+        if dedup:
+            log.info("Dedup stats: %s", dedup.stats())
+        log.info("HTTP connection stats: %s", http_transport.stats())
+        http_transport.close()
+
+
+def run_threaded(homes, join, device_hash, influxdb_writer, config,
+                 dedup=None, sinks=None):
+    """
+    Run each home's paho network loop on its own thread and process
+    entries from all homes on one pool of consumer threads.
+
+    Args:
+        homes (list): The YoLinkHome objects.
+        join (callable): Adds a late home to the shared device hash,
+            see add_home_devices().
+        device_hash (map): Shared device hash map.
+        influxdb_writer (InfluxDbWriter): Started writer or None.
+        config (map): Config hash map.
+        dedup (YoLinkDedup, optional): Duplicate/stale event filter.
+        sinks (YoLinkFanout, optional): Started sinks, drained after
+            the consumers.
+    """
+    consumer_config = config.get('consumer', {})
+    queue_config = config.get('queue', {})
+    workers = consumer_config.get('workers', DEFAULT_CONSUMER_WORKERS)
+    if consumer_config.get('processes', 0):
+        # Decode and process on other cores, sharded by deviceId.
+        consumers = \
+            YoLinkProcessDispatcher(device_hash=device_hash,
+                                    config=config,
+                                    workers=consumer_config['processes'],
+                                    batch_size=consumer_config.get(
+                                        'batchSize', DEFAULT_BATCH_SIZE))
+        input_q = consumers
+    elif consumer_config.get('sharded', False):
+        # Per device ordering, one queue and worker per shard.
+        consumers = \
+            YoLinkShardedDispatcher(device_hash=device_hash,
+                                    shards=workers,
+                                    queue_config=queue_config,
+                                    dedup=dedup)
+        input_q = consumers
+    else:
+        key_func = coalesce_key_func(
+            device_hash,
+            queue_config.get('coalesceExclude', DEFAULT_COALESCE_EXCLUDE))
+        input_q = create_queue(queue_config, key_func=key_func)
+        consumers = \
+            YoLinkConsumerPool(input_q=input_q,
+                               device_hash=device_hash,
+                               workers=workers,
+                               dedup=dedup)
+    consumers.start()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    # Each home keeps its own token fresh and moves its broker
+    # connection to the new token without restarting the process.
+    threads = []
+    for home in homes:
+        thread = threading.Thread(target=home.run, args=(join, input_q),
+                                  name='home-' + home.name, daemon=True)
+        thread.start()
+        threads.append(thread)
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        for home in homes:
+            home.stop()
+        consumers.stop()
+        log.info("Input queue stats: %s", input_q.stats())
+        for home in homes:
+            log.info("Home %s stats: %s", home.name, home.stats())
+        if sinks:
+            sinks.stop()
+        if influxdb_writer:
+            influxdb_writer.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,382 @@
+import argparse
+import json
+import logging
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+import paho.mqtt.client as mqtt
+import yolink_consumer
+
+from influxdb_downsample import InfluxDbDownsampler
+from influxdb_interface import InfluxDbBatchResult, InfluxDbClient, \
+    InfluxDbWriter
+from yolink_consumer import YoLinkConsumerPool, YoLinkShardedDispatcher, \
+    coalesce_key_func
+from yolink_dedup import YoLinkDedup
+from yolink_devices import YoLinkFactory
+from yolink_device_types import YoLinkDeviceRegistry
+from yolink_mqtt_client import YoLinkMqttClient, MqttClient
+from yolink_queue import create_queue, DEFAULT_COALESCE_EXCLUDE
+from yolink_sinks import YoLinkFanout
+from yolink_workers import YoLinkProcessDispatcher
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+HOME_ID = 'benchmark'
+TOPIC = 'yl-home/{0}/+/report'
+DEFAULT_MIX = 'DoorSensor=1,THSensor=4,LeakSensor=1,VibrationSensor=1'
+
+# Event name and possible states of the synthetic reports.
+EVENTS = {
+    'DoorSensor': ('DoorSensor.Alert', ['open', 'closed']),
+    'THSensor': ('THSensor.Report', ['normal']),
+    'LeakSensor': ('LeakSensor.Report', ['dry', 'full']),
+    'VibrationSensor': ('VibrationSensor.Alert', ['normal', 'alert'])
+}
+
+
+class StubMqttServer(MqttClient):
+    """
+    Local broker client that never connects, publishes only cost the
+    injected latency. changeOnly and heartbeat logic stay real.
+    """
+    def __init__(self, latency=0.0, change_only=False):
+        super(StubMqttServer, self).__init__({
+            'host': 'localhost',
+            'port': 1883,
+            'user': None,
+            'pasw': None,
+            'changeOnly': change_only
+        })
+        self.latency = latency
+        self.published = 0
+
+    def publish(self, topic, data, qos=0, retain=False):
+        if self.latency:
+            time.sleep(self.latency)
+        self.published += 1
+        return 0
+
+
+class StubInfluxDbWriter(InfluxDbWriter):
+    """
+    Influx db writer whose batches only cost the injected latency,
+    buffering and flushing stay real.
+    """
+    def __init__(self, latency=0.0, batch_size=500, downsampler=None):
+        super(StubInfluxDbWriter, self).__init__({
+            'url': 'http://localhost:8086/write',
+            'auth': {'user': '', 'pasw': ''},
+            'dbName': HOME_ID,
+            'batchSize': batch_size
+        }, downsampler=downsampler)
+        self.latency = latency
+        self.points = 0
+
+    def send(self, lines: list) -> InfluxDbBatchResult:
+        if self.latency:
+            time.sleep(self.latency)
+        self.points += len(lines)
+        return InfluxDbBatchResult(points=len(lines), status_code=204)
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    Args:
+        mix (str): e.g. DoorSensor=1,THSensor=4
+
+    Returns:
+        dict: Device type -> weight.
+    """
+    weights = dict()
+    for part in mix.split(','):
+        device_type, _, weight = part.partition('=')
+        if device_type not in EVENTS:
+            raise ValueError("Unknown device type {0}".format(device_type))
+        weights[device_type] = float(weight or 1)
+
+    return weights
+
+
+def make_devices(count: int, mix: dict) -> list:
+    """
+    Synthetic device list, as returned by Home.getDeviceList.
+    """
+    total = sum(mix.values())
+    devices = []
+    for device_type, weight in mix.items():
+        for idx in range(max(1, round(count * weight / total))):
+            device_id = '{0}{1:06d}'.format(device_type[:4].lower(), idx)
+            devices.append({
+                'deviceId': device_id,
+                'deviceUDID': device_id,
+                'name': device_id,
+                'token': device_id,
+                'type': device_type
+            })
+
+    return devices
+
+
+def make_payload(device: dict, seq: int) -> bytes:
+    """
+    Synthetic YoLink MQTT report for a device.
+    """
+    event, states = EVENTS[device['type']]
+    data = {
+        'state': states[seq % len(states)],
+        'battery': 4,
+        'loraInfo': {'signal': -60, 'gatewayId': HOME_ID}
+    }
+    if device['type'] == 'THSensor':
+        data['temperature'] = round(random.uniform(15.0, 30.0), 1)
+        data['humidity'] = round(random.uniform(20.0, 80.0), 1)
+
+    return json.dumps({
+        'event': event,
+        'time': int(time.time() * 1000),
+        'msgid': str(seq),
+        'deviceId': device['deviceId'],
+        'data': data
+    }).encode('utf-8')
+
+
+def make_message(device: dict, seq: int) -> mqtt.MQTTMessage:
+    msg = mqtt.MQTTMessage(topic='yl-home/{0}/{1}/report'.format(
+        HOME_ID, device['deviceId']).encode('utf-8'))
+    msg.payload = make_payload(device, seq)
+    return msg
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(pct * len(values)))]
+
+
+def run_benchmark(args) -> dict:
+    """
+    Feed synthetic reports through on_message, the ingest queue, the
+    consumers and YoLinkDevice.process into the stub sinks.
+
+    Returns:
+        dict: Results.
+    """
+    devices = make_devices(args.devices, parse_mix(args.mix))
+    messages = [make_message(devices[seq % len(devices)], seq)
+                for seq in range(args.messages)]
+
+    mqtt_server = StubMqttServer(latency=args.mqtt_latency,
+                                 change_only=args.change_only)
+    downsampler = None
+    if args.downsample:
+        downsampler = InfluxDbDownsampler(window=args.downsample,
+                                          vectorized=not args.no_numpy)
+    writer = StubInfluxDbWriter(latency=args.influx_latency,
+                                batch_size=args.batch_size,
+                                downsampler=downsampler)
+    sinks = None
+    if args.sinks:
+        # Block instead of dropping, every event is delivered.
+        sinks = YoLinkFanout.from_config({'policy': 'block',
+                                          'timeout': None},
+                                         influxdb_writer=writer,
+                                         mqtt_server=mqtt_server)
+    registry = YoLinkDeviceRegistry()
+    device_hash = dict()
+    for device in devices:
+        yolink_device = YoLinkFactory(registry, device)
+        if yolink_device is None:
+            continue
+        yolink_device.set_mqtt_server(mqtt_server)
+        yolink_device.set_sinks(sinks)
+        if device['type'] == 'THSensor':
+            yolink_device.set_influxdb_client(
+                InfluxDbClient(writer=writer, measurement='weather',
+                               tag_set='location=' + device['name']))
+        device_hash[device['deviceId']] = yolink_device
+
+    queue_config = {
+        'size': args.queue_size,
+        'policy': args.policy,
+        'timeout': None,
+        'coalesce': args.coalesce
+    }
+    dedup = YoLinkDedup() if args.dedup else None
+    if args.processes:
+        # Workers build their own devices without sinks, this measures
+        # decode and process scaling. Latency is not recorded.
+        consumers = YoLinkProcessDispatcher(
+            device_hash=device_hash,
+            config={'queue': queue_config,
+                    'dedup': {'enabled': args.dedup}},
+            workers=args.processes)
+        input_q = consumers
+    elif args.sharded:
+        consumers = YoLinkShardedDispatcher(device_hash=device_hash,
+                                            shards=args.workers,
+                                            queue_config=queue_config,
+                                            dedup=dedup)
+        input_q = consumers
+    else:
+        input_q = create_queue(queue_config, key_func=coalesce_key_func(
+            device_hash, DEFAULT_COALESCE_EXCLUDE))
+        consumers = YoLinkConsumerPool(input_q=input_q,
+                                       device_hash=device_hash,
+                                       workers=args.workers,
+                                       dedup=dedup)
+
+    client = YoLinkMqttClient(username=None, passwd=None,
+                              topic=TOPIC.format(HOME_ID),
+                              mqtt_url='localhost', mqtt_port=0,
+                              device_hash=device_hash, input_q=input_q,
+                              yolink_token=None)
+
+    # End to end latency: on_message receive time to processed or,
+    # with sinks, to the last sink write of the event.
+    latencies = []
+    process_entry = yolink_consumer.process_entry
+
+    def timed_process_entry(device_hash, message, dedup=None):
+        rc = process_entry(device_hash, message, dedup)
+        latencies.append(time.time() - message.received_at)
+        return rc
+
+    # msgid -> sink write times, msgid is the message index.
+    received_at = [0.0] * len(messages)
+    delivered = dict()
+
+    def timed_deliver(deliver):
+        def wrapper(entry):
+            deliver(entry)
+            delivered.setdefault(entry[1].msgid, []).append(time.time())
+        return wrapper
+
+    yolink_consumer.process_entry = timed_process_entry
+    if sinks:
+        for sink in sinks.sinks:
+            sink.deliver = timed_deliver(sink.deliver)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    writer.start()
+    if sinks:
+        sinks.start()
+    consumers.start()
+    interval = 1.0 / args.rate if args.rate else 0
+    started = time.time()
+    for idx, msg in enumerate(messages):
+        if interval:
+            delay = started + idx * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        received_at[idx] = time.time()
+        client.on_message(None, None, msg)
+
+    consumers.stop()
+    if sinks:
+        sinks.stop()
+    elapsed = time.time() - started
+    writer.stop()
+
+    yolink_consumer.process_entry = process_entry
+    peak_traced = None
+    if args.tracemalloc:
+        peak_traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    processed = len(latencies)
+    if sinks:
+        latencies = [max(times) - received_at[int(msgid)]
+                     for msgid, times in delivered.items()]
+    latencies.sort()
+    if args.processes:
+        processed = sum(stats['processed'] + stats['failed']
+                        for stats in consumers.worker_stats())
+    return {
+        'messages': args.messages,
+        'processed': processed,
+        'devices': len(device_hash),
+        'workers': args.workers,
+        'processes': args.processes,
+        'sharded': args.sharded,
+        'sinks': args.sinks,
+        'elapsed': round(elapsed, 3),
+        'msgsPerSec': round(processed / elapsed, 1) if elapsed else 0,
+        'latencyP50Ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'latencyP99Ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'latencyMaxMs': round(latencies[-1] * 1000, 3) if latencies else 0,
+        'peakRssKb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peakTracedKb': (None if peak_traced is None
+                         else peak_traced // 1024),
+        'mqttPublished': mqtt_server.published,
+        'influxPoints': writer.points,
+        'downsample': downsampler.stats() if downsampler else None,
+        'queue': input_q.stats()
+    }
+
+
+def main(argv):
+    usage = ("{FILE} --messages <count> --devices <count> "
+             "--workers <count>").format(FILE=__file__)
+    description = 'YoLink ingest path benchmark'
+    parser = argparse.ArgumentParser(usage=usage, description=description)
+    parser.add_argument("--messages", type=int, default=100000,
+                        help="Synthetic reports to send")
+    parser.add_argument("--devices", type=int, default=100,
+                        help="Synthetic devices")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="Device type weights")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Reports per second, 0 for unthrottled")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Consumer workers (shards)")
+    parser.add_argument("--sharded", action='store_true',
+                        help="Shard consumers by deviceId")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="Worker processes instead of threads")
+    parser.add_argument("--queue-size", type=int, default=1024,
+                        help="Ingest queue size")
+    parser.add_argument("--policy", default='block',
+                        help="Ingest queue overflow policy")
+    parser.add_argument("--coalesce", action='store_true',
+                        help="Coalesce telemetry reports")
+    parser.add_argument("--dedup", action='store_true',
+                        help="Enable msgid deduplication")
+    parser.add_argument("--change-only", action='store_true',
+                        help="Change only local MQTT publishing")
+    parser.add_argument("--sinks", action='store_true',
+                        help="Per sink queues and workers")
+    parser.add_argument("--mqtt-latency", type=float, default=0.0,
+                        help="Seconds per local MQTT publish")
+    parser.add_argument("--influx-latency", type=float, default=0.0,
+                        help="Seconds per influx db batch")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="Influx db batch size")
+    parser.add_argument("--downsample", type=float, default=0,
+                        help="Influx db downsampling window in seconds")
+    parser.add_argument("--no-numpy", action='store_true',
+                        help="Downsample without NumPy")
+    parser.add_argument("--tracemalloc", action='store_true',
+                        help="Trace peak Python heap (slower)")
+    parser.add_argument("--json", action='store_true',
+                        help="Print results as JSON")
+
+    args = parser.parse_args()
+    # Keep per message logging out of the measurement.
+    log.setLevel(logging.WARNING)
+
+    results = run_benchmark(args)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print("{0:>14}: {1}".format(key, value))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -46,10 +46,10 @@ def main(args):
                                access_token=token)
         devices = yolink_api.get_all_devices()
         for device in devices:
-            log.info("{}".format(json.dumps(device, indent=2)))
+            log.info("%s", json.dumps(device, indent=2))
 
         home_id = yolink_api.get_home_id()
-        log.info("Home ID: {}".format(home_id))
+        log.info("Home ID: %s", home_id)
 
 
 if __name__ == '__main__':
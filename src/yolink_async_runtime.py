@@ -0,0 +1,339 @@
+import asyncio
+import signal
+
+import paho.mqtt.client as mqtt
+from yolink_consumer import process_entry
+from yolink_profiler import YoLinkProfiler
+from yolink_queue import DEFAULT_QUEUE_SIZE, POLICY_BLOCK, \
+    POLICY_DROP_OLDEST, DROP_LOG_EVERY
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+MISC_LOOP_INTERVAL = 1  # seconds
+RECONNECT_DELAY = 5  # seconds
+
+
+class AsyncioMqttHelper(object):
+    """
+    Drive a paho MQTT client's network I/O from an asyncio event loop
+    instead of loop_forever()/loop_start().
+    """
+    def __init__(self, loop, client):
+        """
+        Args:
+            loop (asyncio.AbstractEventLoop): Running event loop.
+            client (mqtt.Client): Paho client, not yet connected.
+        """
+        self.loop = loop
+        self.client = client
+        self.misc = None
+
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = \
+            self.on_socket_register_write
+        self.client.on_socket_unregister_write = \
+            self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        """
+        Keepalive pings and retry handling, until the client
+        disconnects.
+        """
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(MISC_LOOP_INTERVAL)
+
+
+class AsyncInputQueue(object):
+    """
+    queue.Queue like facade over an asyncio.Queue so that
+    YoLinkMqttClient.on_message can enqueue from the event loop.
+
+    on_message runs on the event loop and must never block, so only
+    the dropOldest policy is honoured, every other policy drops the
+    new entry when full.
+    """
+    def __init__(self, queue, policy=POLICY_BLOCK):
+        self.queue = queue
+        self.policy = policy
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        if self.queue.full():
+            self.dropped += 1
+            if self.dropped % DROP_LOG_EVERY == 1:
+                log.warning("Input queue full, dropped %s entries so far",
+                            self.dropped)
+
+            if self.policy != POLICY_DROP_OLDEST:
+                return
+
+            self.queue.get_nowait()
+            self.queue.task_done()
+
+        self.queue.put_nowait(item)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def stats(self) -> dict:
+        return {
+            'policy': self.policy,
+            'size': self.qsize(),
+            'dropped': self.dropped
+        }
+
+
+class YoLinkAsyncRuntime(object):
+    """
+    Single event loop runtime: YoLink MQTT receive for every home,
+    dispatch to the YoLinkDevice objects, local MQTT publishes and
+    influx db flushes all run on one asyncio loop.
+    """
+    def __init__(self, homes, device_hash, mqtt_server=None,
+                 influxdb_writer=None, queue_config=None, dedup=None,
+                 join=None):
+        """
+        Args:
+            homes (list): The YoLinkHome objects. Started homes have
+                a broker client, not yet connected, the others are
+                retried in the background.
+            device_hash (dict): Shared device hash map.
+            mqtt_server (MqttClient, optional): Local broker client,
+                not yet connected.
+            influxdb_writer (InfluxDbWriter, optional): Shared writer,
+                its flush thread must not be started.
+            queue_config (dict, optional): Queue section of the config
+                file.
+            dedup (YoLinkDedup, optional): Drops duplicate and stale
+                events.
+            join (callable, optional): Adds a late home to the shared
+                device hash and creates its client.
+        """
+        self.homes = homes
+        self.join = join
+        self.device_hash = device_hash
+        self.mqtt_server = mqtt_server
+        self.influxdb_writer = influxdb_writer
+        self.queue_config = queue_config or {}
+        self.dedup = dedup
+
+        self.loop = None
+        self.queue = None
+        self.input_q = None
+        self.stopping = None
+        self.inflight = set()
+        # paho client -> YoLinkMqttClient, for the disconnect callback.
+        self.yolink_clients = dict()
+        self.profiler = YoLinkProfiler.getInstance()
+
+    def run(self):
+        """
+        Run until SIGINT/SIGTERM, then drain the queue and flush sinks.
+        """
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(
+            maxsize=int(self.queue_config.get('size', DEFAULT_QUEUE_SIZE)))
+        self.stopping = asyncio.Event()
+        self.input_q = \
+            AsyncInputQueue(self.queue,
+                            self.queue_config.get('policy', POLICY_BLOCK))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.stopping.set)
+
+        if self.mqtt_server:
+            self.attach(self.mqtt_server.client)
+            self.mqtt_server.connect()
+
+        tasks = [self.loop.create_task(self.dispatch())]
+        for home in self.homes:
+            if home.yolink_mqtt_client:
+                self.start_home(home)
+            elif self.join:
+                tasks.append(self.loop.create_task(self.retry_home(home)))
+
+        if self.influxdb_writer:
+            tasks.append(self.loop.create_task(self.influxdb_flusher()))
+        if self.mqtt_server and self.mqtt_server.change_only:
+            tasks.append(self.loop.create_task(self.mqtt_heartbeat()))
+
+        log.info("asyncio runtime started")
+        await self.stopping.wait()
+
+        log.info("Stopping asyncio runtime, %s entries left",
+                 self.queue.qsize())
+        for home in self.homes:
+            home.stop()
+        await self.queue.join()
+        for task in tasks:
+            task.cancel()
+
+        if self.influxdb_writer:
+            self.influxdb_writer.aggregate(force=True)
+            while self.influxdb_writer.pending():
+                self.schedule_influxdb_flush()
+        if self.inflight:
+            await asyncio.gather(*self.inflight, return_exceptions=True)
+        if self.influxdb_writer and self.influxdb_writer.spool:
+            self.influxdb_writer.spool.close()
+
+        if self.mqtt_server:
+            self.mqtt_server.client.disconnect()
+
+        log.info("Input queue stats: %s", self.input_q.stats())
+        for home in self.homes:
+            log.info("Home %s stats: %s", home.name, home.stats())
+
+    def start_home(self, home):
+        """
+        Connect a started home's broker client on the event loop and
+        keep its token fresh.
+        """
+        yolink_mqtt_client = home.yolink_mqtt_client
+        yolink_mqtt_client.input_q = self.input_q
+        self.attach(yolink_mqtt_client.client)
+        self.yolink_clients[yolink_mqtt_client.client] = yolink_mqtt_client
+        home.start_token_refresher(
+            lambda token: self.loop.call_soon_threadsafe(
+                yolink_mqtt_client.request_reconnect))
+
+        try:
+            yolink_mqtt_client.connect()
+        except OSError as e:
+            home.failures += 1
+            log.error("Home %s: broker connection failed %s, retrying in "
+                      "%ss", home.name, e, RECONNECT_DELAY)
+            self.loop.call_later(RECONNECT_DELAY, self.reconnect,
+                                 yolink_mqtt_client.client)
+
+    async def retry_home(self, home):
+        """
+        Retry a home that failed to start, the token and device list
+        requests block so they run on the default executor.
+        """
+        if not await self.loop.run_in_executor(None, home.wait_ready):
+            return
+
+        await self.loop.run_in_executor(None, self.join, home)
+        self.start_home(home)
+
+    def attach(self, client):
+        """
+        Hook a paho client up to the event loop.
+        """
+        AsyncioMqttHelper(self.loop, client)
+        client.on_disconnect = self.on_disconnect
+
+    def on_disconnect(self, client, userdata, rc):
+        yolink_mqtt_client = self.yolink_clients.get(client)
+        if yolink_mqtt_client:
+            yolink_mqtt_client.on_disconnect(client, userdata, rc)
+            if yolink_mqtt_client.reconnect_pending:
+                yolink_mqtt_client.reconnect_pending = False
+                self.loop.create_task(
+                    self.reconnect_yolink(yolink_mqtt_client))
+                return
+
+        if rc == 0 or self.stopping.is_set():
+            return
+
+        log.error("Unexpected disconnect %s, reconnecting in %ss",
+                  rc, RECONNECT_DELAY)
+        self.loop.call_later(RECONNECT_DELAY, self.reconnect, client)
+
+    def reconnect(self, client):
+        try:
+            client.reconnect()
+        except OSError as e:
+            log.error("Reconnect failed %s", e)
+            self.loop.call_later(RECONNECT_DELAY, self.reconnect, client)
+
+    async def reconnect_yolink(self, yolink_mqtt_client):
+        """
+        Requested reconnect, e.g. after a token renewal. The token
+        request blocks, so it runs on the default executor.
+        """
+        delay = yolink_mqtt_client.refused_delay()
+        if delay:
+            await asyncio.sleep(delay)
+            if self.stopping.is_set():
+                return
+        await self.loop.run_in_executor(
+            None, yolink_mqtt_client.prepare_reconnect)
+        self.reconnect(yolink_mqtt_client.client)
+
+    async def dispatch(self):
+        """
+        Dequeue and process device data.
+        """
+        while True:
+            message = await self.queue.get()
+            try:
+                rc = self.profiler.run_profiled(
+                    process_entry, self.device_hash, message, self.dedup)
+                if rc != 0:
+                    log.error("Failed to process entry %s", rc)
+
+                if self.influxdb_writer:
+                    while self.influxdb_writer.pending() >= \
+                            self.influxdb_writer.batch_size:
+                        self.schedule_influxdb_flush()
+            finally:
+                self.queue.task_done()
+
+    def schedule_influxdb_flush(self):
+        """
+        Send one batch without waiting for it, so several slow
+        influx db writes can be in flight at once.
+        """
+        lines = self.influxdb_writer.take_batch()
+        if not lines:
+            return
+
+        # requests is blocking, run the POST on the default executor.
+        future = self.loop.run_in_executor(None,
+                                           self.influxdb_writer.post,
+                                           lines)
+        self.inflight.add(future)
+        future.add_done_callback(self.inflight.discard)
+
+    async def influxdb_flusher(self):
+        """
+        Flush whatever is pending every flushInterval seconds.
+        """
+        while True:
+            await asyncio.sleep(self.influxdb_writer.flush_interval)
+            await self.loop.run_in_executor(None,
+                                            self.influxdb_writer.aggregate)
+            while self.influxdb_writer.pending():
+                self.schedule_influxdb_flush()
+            await self.loop.run_in_executor(None,
+                                            self.influxdb_writer.replay_spool)
+
+    async def mqtt_heartbeat(self):
+        """
+        Resend unchanged local MQTT states every heartbeat interval.
+        """
+        while True:
+            await asyncio.sleep(self.mqtt_server.heartbeat)
+            self.mqtt_server.send_heartbeats()
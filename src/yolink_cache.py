@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+DEFAULT_CACHE_FILE = 'yolink_cache.json'
+CACHE_VERSION = 1
+
+
+class YoLinkCache(object):
+    """
+    Local copy of the access token, home id and device list, so a
+    restart can subscribe without waiting on the cloud API.
+
+    The file holds the access token, it is written with owner only
+    permissions.
+    """
+    def __init__(self, fname=DEFAULT_CACHE_FILE):
+        """
+        Args:
+            fname (str, optional): Cache file.
+        """
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.data = dict()
+
+    @classmethod
+    def from_config(cls, config=None, home=None):
+        """
+        Args:
+            config (dict, optional): The cache section of the config.
+            home (str, optional): Home name, each home but the default
+                one gets its own file, e.g. yolink_cache-<home>.json.
+
+        Returns:
+            YoLinkCache: The cache, None if disabled.
+        """
+        config = config or {}
+        if not config.get('enabled', False):
+            return None
+
+        fname = config.get('file', DEFAULT_CACHE_FILE)
+        if home:
+            root, ext = os.path.splitext(fname)
+            fname = "{0}-{1}{2}".format(root, home, ext)
+
+        return cls(fname=fname)
+
+    def load(self) -> bool:
+        """
+        Read the cache file.
+
+        Returns:
+            bool: True if a complete cache was loaded.
+        """
+        try:
+            with open(self.fname, 'r') as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            log.info("No cache file %s, cold start", self.fname)
+            return False
+        except (OSError, ValueError) as e:
+            log.error("Ignoring unreadable cache file %s: %s", self.fname, e)
+            return False
+
+        if data.get('version') != CACHE_VERSION or \
+                not all(data.get(key) for key in
+                        ('token', 'homeId', 'devices')):
+            log.info("Incomplete cache file %s, cold start", self.fname)
+            return False
+
+        self.data = data
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def update(self, **kwargs):
+        """
+        Update entries and write the cache file.
+
+        Args:
+            kwargs: token, homeId and/or devices.
+        """
+        with self.lock:
+            self.data.update(kwargs)
+            self.data['version'] = CACHE_VERSION
+            tmp = self.fname + '.tmp'
+            try:
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0o600)
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(self.data, fp)
+                os.replace(tmp, self.fname)
+            except OSError as e:
+                log.error("Failed to write cache file %s: %s", self.fname, e)
@@ -1,13 +1,108 @@
 import json
+import re
 import time
-import requests
 import threading
+import zlib
 
-from time import sleep
+import yolink_json
 
+from http_transport import HttpTransport
+from yolink_event import YoLinkEvent
+from yolink_metrics import YoLinkMetrics
+from yolink_profiler import YoLinkProfiler
+from yolink_queue import create_queue, DEFAULT_COALESCE_EXCLUDE
 from logger import Logger
 log = Logger.getInstance().getLogger()
 
+# Placed on the input queue to tell a consumer worker to exit.
+STOP_SENTINEL = object()
+EVENT_RE = re.compile(rb'"event"\s*:\s*"([^"]+)"')
+# Warn when a shard queue gets this full, it points at a hot device.
+SHARD_HIGH_WATER = 0.75
+
+
+def process_entry(device_hash, message, dedup=None) -> int:
+    """
+    Process the device info data.
+
+    Shared by the threaded consumers and the asyncio runtime.
+
+    Args:
+        device_hash (dict): Device hash map.
+        message (YoLinkRawMessage): Undecoded message from the broker.
+        dedup (YoLinkDedup, optional): Drops duplicate and stale
+            events.
+
+    Returns:
+        int: 0 if successful else -1.
+    """
+    device_id = message.device_id
+    metrics = YoLinkMetrics.getInstance()
+
+    if device_id not in device_hash:
+        log.debug("Device ID:%s is not in device hash", device_id)
+        metrics.inc_message('unknown')
+        return -1
+
+    rc = 0
+    start = time.time()
+    metrics.observe_stage('queue_wait', start - message.received_at)
+    try:
+        event = YoLinkEvent.from_payload(yolink_json.loads(message.payload))
+        decoded = time.time()
+        metrics.observe_stage('decode', decoded - start)
+        if dedup and not dedup.accept(event):
+            metrics.inc_message('duplicate')
+            return 0
+
+        device = device_hash[device_id]
+        device.set_last_event(event)
+        log.debug("\n%s\n", device)
+        rc = device.process(event)
+
+        done = time.time()
+        metrics.observe_process(device.get_raw_type(), done - decoded)
+        if event.time is not None:
+            metrics.observe_lag(device.get_raw_type(),
+                                done - event.time / 1000)
+    except Exception as e:
+        log.error(e)
+        rc = -1
+
+    if rc == 0:
+        metrics.inc_message('processed')
+    else:
+        metrics.inc_error('process')
+    return rc
+
+
+def coalesce_key_func(device_hash, exclude=DEFAULT_COALESCE_EXCLUDE):
+    """
+    Build the CoalescingQueue key function for YoLinkRawMessages.
+
+    Reports are keyed by (deviceId, event) without decoding the
+    payload, devices of an excluded type are never merged.
+
+    Args:
+        device_hash (dict): Device hash map.
+        exclude (list, optional): Raw device types (e.g. DoorSensor)
+            whose events must all be processed.
+
+    Returns:
+        callable: message -> key, or None to never merge it.
+    """
+    exclude = frozenset(exclude)
+
+    def key_func(message):
+        device = device_hash.get(message.device_id)
+        if device is None or device.get_raw_type() in exclude:
+            return None
+
+        match = EVENT_RE.search(message.payload)
+        return (message.device_id, match.group(1) if match else None)
+
+    return key_func
+
 
 class YoLinkConsumer(threading.Thread):
     """
@@ -19,63 +114,236 @@ class YoLinkConsumer(threading.Thread):
     def __init__(self, group=None, target=None, name=None,
                  args=(), kwargs=None, verbose=None):
         super(YoLinkConsumer, self).__init__()
-        self.setDaemon(True)
+        self.daemon = True
         self.target = target
         self.name = name
         self.input_q = args[0]
         self.device_hash = args[1]
+        self.dedup = (kwargs or {}).get('dedup')
 
     def run(self):
         """
         Spin up a thread to dequeue and process device data.
+
+        Blocks on the input queue until an entry (or the shutdown
+        sentinel) is available, so entries are handled as soon as
+        they are enqueued.
         """
         while True:
-            if not self.input_q.empty():
-                payload = self.input_q.get()
+            message = self.input_q.get()
+            try:
+                if message is STOP_SENTINEL:
+                    log.debug("%s received stop sentinel", self.name)
+                    return
+
                 log.debug("Pulled from the input_q")
-                log.debug(payload)
-                rc = self.process_entry(payload)
+                log.debug(message)
+                rc = self.process_entry(message)
                 if rc == 0:
-                    log.debug(
-                        ("Successfully processed entry, number "
-                         "of entries in the queue: {0}").format(
-                             self.input_q.qsize()
-                         ))
+                    log.debug("Successfully processed entry, number of "
+                              "entries in the queue: %s", self.input_q.qsize())
                 else:
-                    log.error("Failed to process entry {0}".format(
-                        rc
-                    ))
-            sleep(0.5)
+                    log.error("Failed to process entry %s", rc)
+            finally:
+                self.input_q.task_done()
 
-    def process_entry(self, payload) -> int:
+    def process_entry(self, message) -> int:
         """
         Process the device info data.
 
         Args:
-            payload (dict): Contains info about device data.
+            message (YoLinkRawMessage): Undecoded message.
 
         Returns:
             int: 0 if successful else -1.
         """
-        device_id = payload['deviceId']
+        return YoLinkProfiler.getInstance().run_profiled(
+            process_entry, self.device_hash, message, self.dedup)
+
+
+class YoLinkConsumerPool(object):
+    """
+    Pool of YoLinkConsumer workers pulling from a shared input queue.
+    """
+    def __init__(self, input_q, device_hash, workers=1, dedup=None):
+        """
+        Args:
+            input_q (OverflowQueue): Queue the MQTT client enqueues into.
+            device_hash (dict): Device hash map.
+            workers (int, optional): Number of consumer threads.
+                Defaults to 1.
+            dedup (YoLinkDedup, optional): Shared by all workers.
+        """
+        self.input_q = input_q
+        self.device_hash = device_hash
+        self.dedup = dedup
+        self.num_workers = max(1, int(workers))
+        self.workers = []
+
+    def start(self):
+        """
+        Start all consumer workers.
+        """
+        for idx in range(self.num_workers):
+            worker = YoLinkConsumer(name='consumer-{0}'.format(idx),
+                                    args=(self.input_q, self.device_hash,),
+                                    kwargs={'dedup': self.dedup})
+            worker.start()
+            self.workers.append(worker)
+
+        log.info("Started %s consumer worker(s)", self.num_workers)
+
+    def stop(self, timeout=None):
+        """
+        Drain the input queue and stop all consumer workers.
+
+        The stop sentinels are enqueued behind any pending entries,
+        so everything already queued is processed before the
+        workers exit.
+
+        Args:
+            timeout (float, optional): Seconds to wait for each worker
+                to exit. Defaults to None (wait forever).
+        """
+        log.info("Stopping consumer workers, %s entries left",
+                 self.input_q.qsize())
+        for _ in self.workers:
+            self.input_q.put_control(STOP_SENTINEL)
+
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                log.error("%s did not stop in time", worker.name)
+
+        self.workers = []
+
+
+class YoLinkShardedDispatcher(object):
+    """
+    Routes entries to a fixed shard by deviceId.
+
+    Each shard has its own queue and a single YoLinkConsumer, so the
+    events of one device are always processed in order by the same
+    worker while different devices are processed in parallel.
+    """
+    def __init__(self, device_hash, shards=1, queue_config=None,
+                 dedup=None):
+        """
+        Args:
+            device_hash (dict): Device hash map.
+            shards (int, optional): Number of shards (worker threads).
+                Defaults to 1.
+            queue_config (dict, optional): Queue section of the config
+                file, applied to every shard queue.
+            dedup (YoLinkDedup, optional): Shared by all shards.
+        """
+        self.device_hash = device_hash
+        self.dedup = dedup
+        self.num_shards = max(1, int(shards))
+        queue_config = queue_config or {}
+        key_func = coalesce_key_func(
+            device_hash,
+            queue_config.get('coalesceExclude', DEFAULT_COALESCE_EXCLUDE))
+        self.shards = [create_queue(queue_config,
+                                    suffix='.{0}'.format(idx),
+                                    key_func=key_func)
+                       for idx in range(self.num_shards)]
+        self.queue_size = self.shards[0].maxsize
+        self.high_water = int(self.queue_size * SHARD_HIGH_WATER)
+        self.workers = []
+
+    def shard_for(self, device_id: str) -> int:
+        """
+        Stable shard index for a device id.
+
+        Args:
+            device_id (str): YoLink deviceId.
+
+        Returns:
+            int: Shard index.
+        """
+        return zlib.crc32(device_id.encode('utf-8')) % self.num_shards
+
+    def put(self, message, block=True, timeout=None):
+        """
+        Enqueue an entry on its device's shard.
+
+        Args:
+            message (YoLinkRawMessage): Undecoded message.
+            block (bool, optional): Block if the shard is full.
+            timeout (float, optional): Seconds to block.
+        """
+        idx = self.shard_for(message.device_id)
+        shard = self.shards[idx]
+        shard.put(message, block, timeout)
+
+        # Only warn on the way up, not for every entry past the mark.
+        if self.high_water and shard.qsize() == self.high_water:
+            log.warning("Shard %s is %s/%s full, last device %s",
+                        idx, shard.qsize(), self.queue_size, message.device_id)
+
+    def qsize(self) -> int:
+        return sum(self.shard_depths())
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Queue counters summed over all shards.
+        """
+        stats = dict()
+        for shard in self.shards:
+            for key, value in shard.stats().items():
+                if key == 'policy':
+                    stats[key] = value
+                else:
+                    stats[key] = stats.get(key, 0) + value
+
+        return stats
+
+    def shard_depths(self) -> list:
+        """
+        Number of pending entries per shard.
+
+        Returns:
+            list: Queue depth, indexed by shard.
+        """
+        return [shard.qsize() for shard in self.shards]
 
-        if device_id not in self.device_hash:
-            log.debug(("Device ID:{0} is not "
-                       "in device hash").format(device_id))
-            return -1
+    def start(self):
+        """
+        Start one consumer worker per shard.
+        """
+        for idx, shard in enumerate(self.shards):
+            worker = YoLinkConsumer(name='shard-{0}'.format(idx),
+                                    args=(shard, self.device_hash,),
+                                    kwargs={'dedup': self.dedup})
+            worker.start()
+            self.workers.append(worker)
 
-        self.device_hash[device_id].refresh_device_data(payload)
-        device = self.device_hash[device_id]
-        log.debug("\n{0}\n".format(device))
+        log.info("Started %s shard worker(s)", self.num_shards)
+
+    def stop(self, timeout=None):
+        """
+        Drain every shard and stop its worker.
+
+        Args:
+            timeout (float, optional): Seconds to wait for each worker
+                to exit. Defaults to None (wait forever).
+        """
+        log.info("Stopping shard workers, entries left per shard %s",
+                 self.shard_depths())
+        for shard in self.shards:
+            shard.put_control(STOP_SENTINEL)
 
-        rc = 0
-        try:
-            rc = device.process()
-        except Exception as e:
-            log.error(e)
-            rc = -1
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                log.error("%s did not stop in time", worker.name)
 
-        return rc
+        self.workers = []
 
 
 class YoLinkApi(object):
@@ -94,9 +362,9 @@ class YoLinkApi(object):
         data['method'] = 'Home.getGeneralInfo'
         data['time'] = str(int(time.time()*1000))
 
-        r = requests.post(self.api_url,
-                          data=json.dumps(data),
-                          headers=headers)
+        r = HttpTransport.getInstance().post(self.api_url,
+                                             data=json.dumps(data),
+                                             headers=headers)
 
         if r.status_code != 200:
             log.error("Failed to get device list")
@@ -120,9 +388,9 @@ class YoLinkApi(object):
         data['method'] = 'Home.getDeviceList'
         data['time'] = str(int(time.time()*1000))
 
-        r = requests.post(self.api_url,
-                          data=json.dumps(data),
-                          headers=headers)
+        r = HttpTransport.getInstance().post(self.api_url,
+                                             data=json.dumps(data),
+                                             headers=headers)
 
         if r.status_code != 200:
             log.error("Failed to get device list")
@@ -0,0 +1,85 @@
+import threading
+
+from collections import OrderedDict
+
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+DEFAULT_MAX_ENTRIES = 4096
+
+
+class YoLinkDedup(object):
+    """
+    Drops redelivered and out of date YoLink events.
+
+    A bounded LRU of (deviceId, msgid) catches broker redeliveries and
+    reconnect bursts, and the time of the last applied event per
+    device rejects events older than what was already applied. Memory
+    is bounded by maxEntries plus one timestamp per known device.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Args:
+            max_entries (int, optional): Size of the msgid LRU.
+        """
+        self.max_entries = max(1, int(max_entries))
+        self.seen = OrderedDict()
+        self.last_time = dict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def accept(self, event) -> bool:
+        """
+        Check an event and record it if it is new.
+
+        Args:
+            event (YoLinkEvent): Parsed device event.
+
+        Returns:
+            bool: True if the event should be processed.
+        """
+        # Without a msgid only the time check applies, a (deviceId,
+        # None) key would match every later event of the device.
+        key = None
+        if event.msgid is not None:
+            key = (event.device_id, event.msgid)
+
+        with self.lock:
+            if key is not None and key in self.seen:
+                self.seen.move_to_end(key)
+                self.hits += 1
+                log.debug("Duplicate event %s", key)
+                return False
+
+            last_time = self.last_time.get(event.device_id)
+            if event.time is not None and last_time is not None and \
+                    event.time < last_time:
+                self.stale += 1
+                log.debug("Stale event %s, time %s older than %s",
+                          event.device_id, event.time, last_time)
+                return False
+
+            self.misses += 1
+            if key is not None:
+                self.seen[key] = None
+                if len(self.seen) > self.max_entries:
+                    self.seen.popitem(last=False)
+            if event.time is not None:
+                self.last_time[event.device_id] = event.time
+
+        return True
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: hits (duplicates), misses (new) and stale counters.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'size': len(self.seen)
+        }
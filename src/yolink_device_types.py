@@ -0,0 +1,217 @@
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+# Device types that are never created, they report nothing useful.
+DEFAULT_SKIP = ['Hub', 'Siren']
+
+# Declarative description of every supported device type:
+#   label:        Human readable type name.
+#   fields:       name -> {path, convert, states, default}
+#                   path:    Key in the payload data, dotted for nested
+#                            keys (e.g. loraInfo.signal).
+#                   convert: One of CONVERTERS.
+#                   states:  Raw value -> reported value.
+#                   default: Reported value for raw values missing
+#                            from states (else None). A field missing
+#                            from the payload is always None.
+#   sinks:        mqtt: field published to the local broker.
+#                 influxdb: fields written as influx db field set.
+#                 log: field logged with the device on every event.
+#   ignoreEvents: Event names that are discarded.
+#
+# The config file's devices.types section adds or replaces types
+# with the same structure.
+BUILTIN_DEVICE_TYPES = {
+    'DoorSensor': {
+        'label': 'Door Sensor',
+        'fields': {
+            'state': {
+                'path': 'state',
+                'states': {
+                    'open': 'DoorEvent.OPEN',
+                    'closed': 'DoorEvent.CLOSE',
+                    'normal': '-1',
+                    'error': '-1',
+                    'alert': '-1'
+                }
+            }
+        },
+        'sinks': {'mqtt': 'state'}
+    },
+    'THSensor': {
+        'label': 'Temperature Sensor',
+        'fields': {
+            'temperature': {'path': 'temperature', 'convert': 'fahrenheit'},
+            'humidity': {'path': 'humidity', 'convert': 'round2'}
+        },
+        'sinks': {'influxdb': ['temperature', 'humidity']}
+    },
+    'LeakSensor': {
+        'label': 'Leak Sensor',
+        'ignoreEvents': ['LeakSensor.setInterval'],
+        'fields': {
+            'state': {
+                'path': 'state',
+                'states': {
+                    'dry': 'LeakEvent.DRY',
+                    'full': 'LeakEvent.FULL',
+                    'normal': '-1',
+                    'error': '-1',
+                    'alert': '-1'
+                }
+            }
+        },
+        'sinks': {'log': 'state'}
+    },
+    'VibrationSensor': {
+        'label': 'Vibration Sensor',
+        'fields': {
+            'state': {
+                'path': 'state',
+                'states': {'alert': 'VibrateEvent.VIBRATE'},
+                'default': 'VibrateEvent.NO_VIBRATE'
+            }
+        },
+        'sinks': {'log': 'state', 'mqtt': 'state'}
+    }
+}
+
+CONVERTERS = {
+    'float': float,
+    'int': int,
+    'str': str,
+    'round2': lambda value: round(float(value), 2),
+    'fahrenheit': lambda value: round((float(value) * 1.8) + 32, 2)
+}
+
+
+class YoLinkDeviceType(object):
+    """
+    A device type description compiled for the hot path.
+
+    The field descriptions are turned into a single generated
+    extract() function that reads every payload field once, converts
+    and maps it, and returns the values as a dict.
+    """
+    def __init__(self, raw_type: str, spec: dict):
+        """
+        Args:
+            raw_type (str): YoLink device type, e.g. DoorSensor.
+            spec (dict): Type description, see BUILTIN_DEVICE_TYPES.
+
+        Raises:
+            ValueError: On an unknown converter or sink field.
+        """
+        self.raw_type = raw_type
+        self.label = spec.get('label', raw_type)
+        self.fields = tuple(spec.get('fields', {}))
+        self.ignore_events = frozenset(spec.get('ignoreEvents', ()))
+
+        sinks = spec.get('sinks', {})
+        self.mqtt_field = sinks.get('mqtt')
+        self.log_field = sinks.get('log')
+        self.influxdb_fields = tuple(sinks.get('influxdb', ()))
+        for field in ((self.mqtt_field, self.log_field) +
+                      self.influxdb_fields):
+            if field is not None and field not in self.fields:
+                raise ValueError("{0}: sink field {1} is not a "
+                                 "field".format(raw_type, field))
+
+        self.extract = self.compile(spec.get('fields', {}))
+
+    def compile(self, fields: dict):
+        """
+        Generate the extractor for the field descriptions.
+
+        Args:
+            fields (dict): name -> field description.
+
+        Returns:
+            callable: data dict -> {name: value}.
+        """
+        namespace = dict()
+        lines = ['def extract(data):']
+        items = []
+        for idx, (name, field) in enumerate(fields.items()):
+            path = field.get('path', name).split('.')
+            var = 'v{0}'.format(idx)
+
+            # Nested keys: walk down, stopping at the first missing one.
+            lines.append('    {0} = data.get({1!r})'.format(var, path[0]))
+            for key in path[1:]:
+                lines.append('    {0} = {0}.get({1!r}) if isinstance({0}, '
+                             'dict) else None'.format(var, key))
+
+            convert = field.get('convert')
+            if convert:
+                if convert not in CONVERTERS:
+                    raise ValueError("{0}: unknown converter {1}".format(
+                        self.raw_type, convert))
+                namespace['c{0}'.format(idx)] = CONVERTERS[convert]
+                lines.append('    if {0} is not None:'.format(var))
+                lines.append('        {0} = c{1}({0})'.format(var, idx))
+
+            if 'states' in field:
+                namespace['s{0}'.format(idx)] = dict(field['states'])
+                namespace['d{0}'.format(idx)] = field.get('default')
+                lines.append('    if {0} is not None:'.format(var))
+                lines.append('        {0} = s{1}.get({0}, d{1})'.format(
+                    var, idx))
+
+            items.append('{0!r}: {1}'.format(name, var))
+
+        lines.append('    return {' + ', '.join(items) + '}')
+        exec('\n'.join(lines), namespace)
+        return namespace['extract']
+
+
+class YoLinkDeviceRegistry(object):
+    """
+    Compiled device types by YoLink type name.
+    """
+    def __init__(self, types=None, skip=DEFAULT_SKIP):
+        """
+        Args:
+            types (dict, optional): Extra or replacement type
+                descriptions, merged over BUILTIN_DEVICE_TYPES.
+            skip (list, optional): Types that are never created.
+        """
+        specs = dict(BUILTIN_DEVICE_TYPES)
+        specs.update(types or {})
+        self.types = {raw_type: YoLinkDeviceType(raw_type, spec)
+                      for raw_type, spec in specs.items()}
+        self.skip = frozenset(skip)
+        self.unknown = set()
+
+    @classmethod
+    def from_config(cls, config=None):
+        """
+        Args:
+            config (dict, optional): The devices section of the config.
+
+        Returns:
+            YoLinkDeviceRegistry: The registry.
+        """
+        config = config or {}
+        return cls(types=config.get('types'),
+                   skip=config.get('skip', DEFAULT_SKIP))
+
+    def get(self, raw_type: str):
+        """
+        Args:
+            raw_type (str): YoLink device type.
+
+        Returns:
+            YoLinkDeviceType: The compiled type, None if skipped or
+            not described.
+        """
+        if raw_type in self.skip:
+            return None
+
+        device_type = self.types.get(raw_type)
+        if device_type is None and raw_type not in self.unknown:
+            self.unknown.add(raw_type)
+            log.warning("No description for device type %s, its devices "
+                        "are ignored", raw_type)
+
+        return device_type
@@ -1,81 +1,34 @@
 from datetime import datetime
 
-from enum import Enum
+from yolink_event import TIME_FORMAT
 from logger import Logger
 log = Logger.getInstance().getLogger()
 
 
-class DeviceType(Enum):
-    DOOR = 1
-    TEMPERATURE = 2
-    LEAK = 3
-    VIBRATION = 4
-
-
-class TempType(Enum):
-    CELSIUS = 1
-    FAHRENHEIT = 2
-
-
-class DoorEvent(Enum):
-    UNKNOWN = -1
-    OPEN = 1
-    CLOSE = 2
-
-
-class LeakEvent(Enum):
-    UNKNOWN = -1
-    DRY = 1
-    FULL = 2
-
-
-class VibrateEvent(Enum):
-    UNKNOWN = -1
-    NO_VIBRATE = 1
-    VIBRATE = 2
-
-
-DEVICE_TYPE = {
-    "DoorSensor": DeviceType.DOOR,
-    "THSensor": DeviceType.TEMPERATURE,
-    "LeakSensor": DeviceType.LEAK,
-    "VibrationSensor": DeviceType.VIBRATION
-}
-
-EVENT_STATE = {
-    "normal": -1,
-    "error": -1,
-    "alert": -1,
-    "open": DoorEvent.OPEN,
-    "closed": DoorEvent.CLOSE,
-    "dry": LeakEvent.DRY,
-    "full": LeakEvent.FULL,
-    "vibrate": VibrateEvent.VIBRATE
-}
-
-DEVICE_TYPE_TO_STR = {
-    DeviceType.DOOR: "Door Sensor",
-    DeviceType.TEMPERATURE: "Temperature Sensor",
-    DeviceType.LEAK: "Leak Sensor",
-    DeviceType.VIBRATION: "Vibration Sensor"
-}
-
-
 class YoLinkDevice(object):
     """
     Object representation for YoLink Device
+
+    What a device reports and where it goes is described by its
+    YoLinkDeviceType, see yolink_device_types.
     """
-    def __init__(self, device_info):
+    def __init__(self, device_info, device_type):
         self.id = device_info['deviceId']
         self.name = device_info['name']
-        self.type = DEVICE_TYPE[device_info['type']]
+        self.type = device_type
         self.uuid = device_info['deviceUDID']
         self.token = device_info['token']
         self.raw_type = device_info['type']
 
-        # Device data from each MQTT event received
-        # from YoLink brokers
-        self.event_payload = {}
+        self.mqtt_server = None
+        self.influxdb_client = None
+        # YoLinkFanout, hands the sink writes to per sink workers.
+        self.sinks = None
+
+        # Last YoLinkEvent applied to this device and the field values
+        # extracted from it, the last known state.
+        self.last_event = None
+        self.values = dict()
 
     def get_id(self):
         return self.id
@@ -98,25 +51,26 @@ class YoLinkDevice(object):
     def get_token(self):
         return self.token
 
-    def refresh_device_data(self, data):
-        self.event_payload = data
+    def set_last_event(self, event):
+        self.last_event = event
+
+    def get_value(self, field):
+        return self.values.get(field)
 
     def get_device_event(self):
-        return self.event_payload['event']
+        return self.last_event.event
 
     def get_device_event_time(self):
-        return datetime.fromtimestamp(
-                self.event_payload['time'] / 1000)\
-                .strftime("%Y-%m-%d %H:%M:%S")
+        return self.last_event.get_event_time()
 
     def get_current_time(self):
-        return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return datetime.now().strftime(TIME_FORMAT)
 
     def get_device_message_id(self):
-        return self.event_payload['msgid']
+        return self.last_event.msgid
 
     def get_device_data(self):
-        return self.event_payload['data']
+        return self.last_event.data
 
     def set_mqtt_server(self, mqtt_server):
         self.topic = "yolink/{0}/{1}/report".format(
@@ -128,220 +82,117 @@ class YoLinkDevice(object):
 
         self.mqtt_server = mqtt_server
 
-    def process(self):
-        raise NotImplementedError
-
-    def __str__(self):
-        to_str = ("Id: {0}\nName: {1}\nType: {2}\n"
-                  "Event: {3}\nToken: {4}\n"
-                  "Event Time: {5}\nCurrent Time: {6}\n").format(
-                      self.id,
-                      self.name,
-                      DEVICE_TYPE_TO_STR[self.type],
-                      self.get_device_event(),
-                      self.token,
-                      self.get_device_event_time(),
-                      self.get_current_time()
-        )
-        return to_str
-
-
-class YoLinkDoorDevice(YoLinkDevice):
-    """
-    Object representation for YoLink Door Sensor
-    """
-    def __init__(self, device_info):
-        super().__init__(device_info)
-
-    def is_open(self):
-        return EVENT_STATE[self.get_device_data()['state']] == DoorEvent.OPEN
-
-    def is_close(self):
-        return EVENT_STATE[self.get_device_data()['state']] == DoorEvent.CLOSE
-
-    def get_event(self):
-        if 'state' in self.get_device_data():
-            return str(EVENT_STATE[self.get_device_data()['state']])
-        return None
-
-    def __str__(self):
-        to_str = ("Event: {0} ({1}) \n").format(
-            self.get_event(),
-            self.get_device_data()['state']
-        )
-        return super().__str__() + to_str
-
-    def process(self):
-        event = self.get_event()
-        log.debug("Process event: {}".format(
-            self.get_event()
-        ))
-
-        if event:
-            return self.mqtt_server.publish(self.topic, self.get_event())
-        else:
-            log.info("Not supported event: {}".format(
-                self.get_device_data()
-            ))
-
-        return 0
-
-
-class YoLinkTempDevice(YoLinkDevice):
-    """
-    Object representation for YoLink Temperature Sensor
-    """
-    def __init__(self, device_info):
-        super().__init__(device_info)
-        self.temp = 0.0
-        self.influxdb_client = None
-
-    def get_temperature(self, type=TempType.FAHRENHEIT):
-        self.temp = float(self.get_device_data()['temperature'])
-
-        if type == TempType.FAHRENHEIT:
-            return round(((self.temp * 1.8) + 32), 2)
-
-        return round(self.temp, 2)
-
-    def get_humidity(self):
-        return round(float(self.get_device_data()['humidity']), 2)
-
     def set_influxdb_client(self, influxdb_c):
         self.influxdb_client = influxdb_c
 
-    def influxdb_write_data(self):
-        if not self.influxdb_client:
-            log.debug("InfluxDB client not configured")
-            return -1
+    def set_sinks(self, sinks):
+        self.sinks = sinks
 
-        return self.influxdb_client.write_data(
-                    ("temperature={0},humidity={1}").format(
-                        str(self.get_temperature()),
-                        str(self.get_humidity())
-                    ))
+    def process(self, event):
+        """
+        Process a device event.
 
-    def __str__(self):
-        to_str = ("Temperature (F): {0}\nHumidity: {1}\n").format(
-            self.get_temperature(),
-            self.get_humidity()
-        )
-        return super().__str__() + to_str
-
-    def process(self):
-        log.debug(("{0} {1}").format(
-            self.get_temperature(),
-            self.get_humidity()
-        ))
-
-        if self.influxdb_client:
-            return self.influxdb_write_data()
-
-        return 0
+        Args:
+            event (YoLinkEvent): Parsed event for this device.
 
+        Returns:
+            int: 0 if successful.
+        """
+        device_type = self.type
+        if event.event in device_type.ignore_events:
+            log.info("%s event, discard", event.event)
+            return 0
 
-class YoLinkLeakDevice(YoLinkDevice):
-    """
-    Object representation for a YoLink Leak Sensor
-    """
-    def __init__(self, device_info):
-        super().__init__(device_info)
-        self.curr_state = LeakEvent.FULL
-        self.influxdb_client = None
-
-    def is_water_exhausted(self):
-        return EVENT_STATE[self.get_device_data()['state']] == LeakEvent.DRY
-
-    def is_water_full(self):
-        return EVENT_STATE[self.get_device_data()['state']] == LeakEvent.FULL
-
-    def get_state(self):
-        if 'state' in self.get_device_data():
-            return EVENT_STATE[self.get_device_data()['state']]
-        return ''
-
-    def __str__(self):
-        to_str = ("Current State: {0}\n").format(
-            str(self.get_state())
-        )
-
-        return super().__str__() + to_str
-
-    def process(self):
+        values = device_type.extract(event.data)
+        self.values = values
         ret = 0
 
-        if self.get_device_event() == 'LeakSensor.setInterval':
-            log.info("Alert interval event, discard")
-            return ret
-        elif 'state' not in self.get_device_data():
-            log.info("State not in device data {0}".format(
-                self.get_device_data()
-            ))
-            return ret
+        if device_type.log_field:
+            if values[device_type.log_field] is None:
+                log.info("State not in device data %s", event.data)
+                return ret
+            log.info("%s: %s", self, values[device_type.log_field])
 
-        sensor_state = self.get_state()
-        log.info("{}: {}".format(self, sensor_state))
-        return ret
+        if self.sinks:
+            self.sinks.emit(self, event, values)
+            return ret
 
+        if device_type.mqtt_field and self.mqtt_server:
+            ret = self.publish_state(event, values)
 
-class YoLinkVibrationDevice(YoLinkDevice):
-    """
-    Object representation for a YoLink Vibration Sensor
-    """
-    def __init__(self, device_info):
-        super().__init__(device_info)
-        self.curr_state = VibrateEvent.NO_VIBRATE
+        if device_type.influxdb_fields and self.influxdb_client:
+            self.write_influxdb(event, values)
 
-    def is_vibrating(self):
-        return (self.get_device_data()['state'] == 'alert')
+        return ret
 
-    def get_state(self):
-        if 'state' in self.get_device_data():
-            if self.is_vibrating():
-                return str(VibrateEvent.VIBRATE)
-        return str(VibrateEvent.NO_VIBRATE)
+    def publish_state(self, event, values) -> int:
+        """
+        Publish the mqtt field to the local broker.
+
+        Args:
+            event (YoLinkEvent): The event the values come from.
+            values (dict): Extracted field values.
+
+        Returns:
+            int: 0 if published or nothing to publish.
+        """
+        state = values[self.type.mqtt_field]
+        log.debug("Process event: %s", state)
+        if state is None:
+            log.info("Not supported event: %s", event.data)
+            return 0
+
+        return self.mqtt_server.publish_state(self.topic, state,
+                                              self.raw_type)
+
+    def write_influxdb(self, event, values) -> int:
+        """
+        Write the influx db fields, stamped with the event time.
+
+        Args:
+            event (YoLinkEvent): The event the values come from.
+            values (dict): Extracted field values.
+
+        Returns:
+            int: 0 if written or nothing to write.
+        """
+        fields = {field: values[field]
+                  for field in self.type.influxdb_fields}
+        if self.influxdb_client.write_data(fields, event.time) < 0:
+            log.info("No influx db fields in device data %s", event.data)
+        return 0
 
     def __str__(self):
-        to_str = ("Current State: {0}\n").format(
-            self.get_state()
+        to_str = ("Id: {0}\nName: {1}\nType: {2}\n"
+                  "Event: {3}\nToken: {4}\n"
+                  "Event Time: {5}\nCurrent Time: {6}\n").format(
+                      self.id,
+                      self.name,
+                      self.type.label,
+                      self.get_device_event(),
+                      self.token,
+                      self.get_device_event_time(),
+                      self.get_current_time()
         )
-
-        return super().__str__() + to_str
-
-    def process(self):
-        ret = 0
-
-        if 'state' not in self.get_device_data():
-            log.info("State not in device data {0}".format(
-                self.get_device_data()
-            ))
-            return ret
-
-        vibrate_state = self.get_state()
-        log.info("{}: {}".format(self, vibrate_state))
-        if self.mqtt_server:
-            ret = \
-                self.mqtt_server.publish(
-                    self.topic, vibrate_state)
-        return ret
+        for field in self.type.fields:
+            to_str += "{0}: {1}\n".format(field, self.values.get(field))
+        return to_str
 
 
-def YoLinkFactory(type: str, device_info: dict) -> YoLinkDevice:
+def YoLinkFactory(registry, device_info: dict) -> YoLinkDevice:
     """
     Factory Method
 
     Args:
-        type (str): Device type.
+        registry (YoLinkDeviceRegistry): Compiled device types.
         device_info (dict): Device info.
 
     Returns:
-        YoLinkDevice: YoLink Device Object.
+        YoLinkDevice: YoLink Device Object, None if the device type is
+        skipped or not described.
     """
-    localizers = {
-        "DoorSensor": YoLinkDoorDevice,
-        "THSensor": YoLinkTempDevice,
-        "LeakSensor": YoLinkLeakDevice,
-        "VibrationSensor": YoLinkVibrationDevice,
-    }
-
-    return localizers[type](device_info=device_info)
+    device_type = registry.get(device_info['type'])
+    if device_type is None:
+        return None
+
+    return YoLinkDevice(device_info, device_type)
@@ -0,0 +1,95 @@
+from datetime import datetime
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class YoLinkEvent(object):
+    """
+    Immutable record of a single YoLink MQTT report.
+
+    The raw payload is parsed once into typed fields, devices and the
+    queue only ever see this record.
+    """
+    __slots__ = ('device_id', 'event', 'msgid', 'time', 'data')
+
+    def __init__(self, device_id, event, msgid, time, data=None):
+        """
+        Args:
+            device_id (str): YoLink deviceId.
+            event (str): Event name, e.g. THSensor.Report.
+            msgid (str): Message id.
+            time (int): Event time in ms since the epoch.
+            data (dict, optional): Raw data section of the payload.
+        """
+        init = object.__setattr__
+        init(self, 'device_id', device_id)
+        init(self, 'event', event)
+        init(self, 'msgid', msgid)
+        init(self, 'time', time)
+        init(self, 'data', data)
+
+    @classmethod
+    def from_payload(cls, payload: dict):
+        """
+        Parse a decoded YoLink MQTT payload.
+
+        Args:
+            payload (dict): Decoded MQTT payload.
+
+        Returns:
+            YoLinkEvent: The event record.
+        """
+        return cls(device_id=payload['deviceId'],
+                   event=payload.get('event'),
+                   msgid=payload.get('msgid'),
+                   time=payload.get('time'),
+                   data=payload.get('data') or {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("YoLinkEvent is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("YoLinkEvent is immutable")
+
+    def get_event_time(self) -> str:
+        return datetime.fromtimestamp(self.time / 1000)\
+            .strftime(TIME_FORMAT)
+
+    def __repr__(self):
+        return ("YoLinkEvent(device_id={0!r}, event={1!r}, msgid={2!r}, "
+                "time={3!r})").format(
+                    self.device_id,
+                    self.event,
+                    self.msgid,
+                    self.time
+                )
+
+
+class YoLinkRawMessage(object):
+    """
+    Undecoded YoLink MQTT message, as queued by the paho network
+    thread. Decoding happens in the consumer stage.
+    """
+    __slots__ = ('topic', 'payload', 'device_id', 'received_at')
+
+    def __init__(self, topic, payload, device_id, received_at):
+        """
+        Args:
+            topic (str): MQTT topic.
+            payload (bytes): Raw JSON payload.
+            device_id (str): deviceId, taken from the topic or payload
+                without decoding it.
+            received_at (float): time.time() when received.
+        """
+        self.topic = topic
+        self.payload = payload
+        self.device_id = device_id
+        self.received_at = received_at
+
+    def __repr__(self):
+        return ("YoLinkRawMessage(topic={0!r}, device_id={1!r}, "
+                "size={2})").format(
+                    self.topic,
+                    self.device_id,
+                    len(self.payload)
+                )
@@ -0,0 +1,277 @@
+import threading
+
+from yolink_cache import YoLinkCache
+from yolink_consumer import YoLinkApi
+from yolink_mqtt_client import YoLinkMqttClient, DEFAULT_HOME
+from yolink_token import YoLinkToken, YoLinkTokenRefresher
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+HOME_RETRY = 60  # seconds
+
+
+def home_configs(config) -> list:
+    """
+    The YoLink accounts/homes to ingest.
+
+    yoLink.homes lists {name, apiv2} entries, each apiv2 is merged
+    over the shared yoLink.apiv2 so only the credentials need to be
+    repeated. Without homes the yoLink.apiv2 account is the only home.
+
+    Args:
+        config (map): Config hash map.
+
+    Returns:
+        list: (name, apiv2 config) tuples.
+    """
+    yolink_config = config['yoLink']
+    shared = yolink_config.get('apiv2', {})
+    homes = yolink_config.get('homes')
+    if not homes:
+        return [(DEFAULT_HOME, shared)]
+
+    configs = []
+    for home in homes:
+        name = home['name']
+        if name in [config_name for config_name, _ in configs]:
+            raise ValueError("Duplicate YoLink home {0}".format(name))
+
+        apiv2 = dict(shared)
+        apiv2.update(home.get('apiv2', {}))
+        configs.append((name, apiv2))
+
+    return configs
+
+
+class YoLinkHome(object):
+    """
+    One YoLink account and home: its own access token lifecycle,
+    device list and broker subscription.
+
+    All homes feed the same dispatch pipeline and sinks. A home that
+    fails (e.g. refused credentials) is retried on its own, the other
+    homes keep running.
+    """
+    def __init__(self, name: str, config: dict, cache_config=None):
+        """
+        Args:
+            name (str): Home name, used in logs, metrics and the cache
+                file name.
+            config (dict): The home's apiv2 config.
+            cache_config (dict, optional): The cache section of the
+                config file.
+        """
+        self.name = name
+        self.config = config
+        self.yolink_token = \
+            YoLinkToken(url=config['tokenUrl'],
+                        ua_id=config['uaId'],
+                        sec_id=config['secId'])
+        self.yolink_api = YoLinkApi(api_url=config['apiUrl'],
+                                    access_token=None)
+        self.cache = YoLinkCache.from_config(
+            cache_config, home=None if name == DEFAULT_HOME else name)
+
+        self.warm_start = False
+        self.devices = None
+        self.home_id = None
+        # deviceIds of this home in the shared device hash.
+        self.device_ids = set()
+        self.started = False
+        self.yolink_mqtt_client = None
+        self.token_refresher = None
+        self.failures = 0
+        self.stop_event = threading.Event()
+
+    def load_cache(self):
+        """
+        Restore the token, device list and home id from the cache.
+        """
+        if self.cache and self.cache.load():
+            self.yolink_token.from_dict(self.cache.get('token'))
+            self.warm_start = not self.yolink_token.is_token_expired()
+        if self.cache:
+            self.yolink_token.cache = self.cache
+        if self.warm_start:
+            log.info("Home %s: warm start from cache %s",
+                     self.name, self.cache.fname)
+
+    def phase(self, func):
+        """
+        Wrap a startup step so that an error only fails this home.
+        The step is skipped if a step it depends on failed.
+
+        Args:
+            func (callable): Startup step, no arguments.
+
+        Returns:
+            callable: Startup graph phase, returns None on failure.
+        """
+        def run(**deps):
+            if any(dep is None for dep in deps.values()):
+                return None
+            try:
+                return func()
+            except Exception as e:
+                self.failures += 1
+                log.error("Home %s: %s failed: %s",
+                          self.name, func.__name__, e)
+                return None
+
+        return run
+
+    def get_token(self) -> str:
+        if not self.warm_start:
+            self.yolink_token.get_access_token()
+        log.debug(self.yolink_token.access_token)
+        self.yolink_api.access_token = self.yolink_token.access_token
+        return self.yolink_token.access_token
+
+    def get_devices(self) -> list:
+        if self.warm_start:
+            self.devices = self.cache.get('devices')
+        else:
+            self.devices = self.yolink_api.get_all_devices()
+        return self.devices
+
+    def get_home_id(self) -> str:
+        if self.warm_start:
+            self.home_id = self.cache.get('homeId')
+        else:
+            self.home_id = self.yolink_api.get_home_id()
+        return self.home_id
+
+    def ready(self) -> bool:
+        """
+        Check the startup steps and write a cold start to the cache.
+
+        Returns:
+            bool: True if the home can subscribe.
+        """
+        if not self.devices or not self.home_id:
+            log.error("Home %s: startup failed, retrying in %ss",
+                      self.name, HOME_RETRY)
+            return False
+
+        if self.cache and not self.warm_start:
+            self.cache.update(homeId=self.home_id, devices=self.devices)
+        self.started = True
+        return True
+
+    def start(self) -> bool:
+        """
+        Run the startup steps one after the other, for retries.
+
+        Returns:
+            bool: True if the home can subscribe.
+        """
+        for step in (self.get_token, self.get_devices, self.get_home_id):
+            if self.phase(step)() is None:
+                break
+
+        return self.ready()
+
+    def wait_ready(self) -> bool:
+        """
+        Retry the startup steps every HOME_RETRY seconds.
+
+        Returns:
+            bool: True once the home can subscribe, False if stopped
+            first.
+        """
+        while not self.stop_event.wait(HOME_RETRY):
+            self.warm_start = False
+            if self.start():
+                log.info("Home %s: started", self.name)
+                return True
+
+        return False
+
+    def create_client(self, device_hash, input_q=None) -> YoLinkMqttClient:
+        """
+        Create the broker client subscribed to this home.
+
+        Args:
+            device_hash (dict): The shared device hash map.
+            input_q (optional): The shared ingest queue.
+
+        Returns:
+            YoLinkMqttClient: The client, not yet connected.
+        """
+        mqtt_config = self.config['mqtt']
+        self.yolink_mqtt_client = \
+            YoLinkMqttClient(username=self.yolink_token.access_token,
+                             passwd=None,
+                             topic=mqtt_config['topic'].format(self.home_id),
+                             mqtt_url=mqtt_config['url'],
+                             mqtt_port=mqtt_config['port'],
+                             device_hash=device_hash,
+                             input_q=input_q,
+                             yolink_token=self.yolink_token,
+                             home=self.name)
+        return self.yolink_mqtt_client
+
+    def start_token_refresher(self, on_refresh):
+        """
+        Keep this home's token fresh.
+
+        Args:
+            on_refresh (callable): Called with the new access token.
+        """
+        self.token_refresher = YoLinkTokenRefresher(self.yolink_token,
+                                                    on_refresh=on_refresh)
+        self.token_refresher.start()
+
+    def run(self, join, input_q):
+        """
+        Threaded runtime: start (retrying until it works), join the
+        pipeline and run the broker network loop until stop().
+
+        Args:
+            join (callable): Adds the home's devices to the shared
+                device hash and creates its client, see create_client().
+            input_q: The shared ingest queue.
+        """
+        if not self.started and not self.wait_ready():
+            return
+        if self.yolink_mqtt_client is None:
+            join(self)
+
+        client = self.yolink_mqtt_client
+        client.input_q = input_q
+        self.start_token_refresher(
+            lambda token: client.request_reconnect())
+
+        while not self.stop_event.is_set():
+            try:
+                client.connect_to_broker()
+                return
+            except OSError as e:
+                self.failures += 1
+                log.error("Home %s: broker connection failed %s, retrying "
+                          "in %ss", self.name, e, HOME_RETRY)
+                self.stop_event.wait(HOME_RETRY)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.token_refresher:
+            self.token_refresher.stop()
+        if self.yolink_mqtt_client:
+            self.yolink_mqtt_client.stop()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Per home counters for logs and metrics.
+        """
+        client = self.yolink_mqtt_client
+        stats = {
+            'devices': len(self.device_ids),
+            'failures': self.failures,
+            'connected': bool(client and client.connected)
+        }
+        if client:
+            stats['received'] = client.received
+            stats['rejected'] = client.rejected
+            stats.update(client.reconnect_stats())
+        return stats
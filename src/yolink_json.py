@@ -0,0 +1,65 @@
+import json
+
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+
+def _stdlib_loads(data):
+    return json.loads(data)
+
+
+def _load_backends() -> dict:
+    """
+    Collect the JSON decoders that are importable, fastest first.
+
+    Returns:
+        dict: backend name -> loads(bytes) callable.
+    """
+    backends = dict()
+
+    try:
+        import orjson
+        backends['orjson'] = orjson.loads
+    except ImportError:
+        pass
+
+    try:
+        import ujson
+        backends['ujson'] = ujson.loads
+    except ImportError:
+        pass
+
+    backends['json'] = _stdlib_loads
+    return backends
+
+
+BACKENDS = _load_backends()
+# Default to the fastest backend installed.
+loads = next(iter(BACKENDS.values()))
+backend = next(iter(BACKENDS))
+
+
+def set_backend(name: str = 'auto') -> str:
+    """
+    Select the JSON decoder used for YoLink payloads.
+
+    Args:
+        name (str, optional): orjson, ujson, json or auto (fastest
+            installed). Defaults to auto.
+
+    Returns:
+        str: Name of the backend in use, falls back to the stdlib json
+            module if the requested one is not installed.
+    """
+    global loads, backend
+
+    if name == 'auto':
+        name = next(iter(BACKENDS))
+    elif name not in BACKENDS:
+        log.error("JSON backend %s not installed, using json", name)
+        name = 'json'
+
+    loads = BACKENDS[name]
+    backend = name
+    log.info("Using %s JSON backend", name)
+    return name
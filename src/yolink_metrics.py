@@ -0,0 +1,295 @@
+import bisect
+import threading
+
+from urllib.parse import parse_qsl, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logger import Logger, SingletonType
+log = Logger.getInstance().getLogger()
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+DEFAULT_METRICS_PORT = 9464
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, stage latencies are expected well below a second.
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Seconds, event time to sink includes device and cloud delays.
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{0}="{1}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels) + '}'
+
+
+class Histogram(object):
+    """
+    Prometheus histogram, one set of buckets per label set.
+
+    Every thread records into its own series, so observe() needs no
+    lock; the series are summed when rendered.
+    """
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # (thread id, labels) -> [bucket counts, sum, count]
+        self.series = dict()
+
+    def observe(self, value, labels=()):
+        key = (threading.get_ident(), labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series.setdefault(
+                key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def collect(self) -> dict:
+        merged = dict()
+        for (_, labels), (counts, total, count) in \
+                list(self.series.items()):
+            series = merged.setdefault(
+                labels, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            for idx, bucket in enumerate(counts):
+                series[0][idx] += bucket
+            series[1] += total
+            series[2] += count
+
+        return merged
+
+    def render(self) -> list:
+        lines = ['# HELP {0} {1}'.format(self.name, self.help),
+                 '# TYPE {0} histogram'.format(self.name)]
+        for labels, (counts, total, count) in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, format_labels(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('{0}_sum{1} {2}'.format(
+                self.name, format_labels(labels), total))
+            lines.append('{0}_count{1} {2}'.format(
+                self.name, format_labels(labels), count))
+
+        return lines
+
+
+class Counter(object):
+    """
+    Prometheus counter, one value per label set, recorded per thread
+    like Histogram.
+    """
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        # (thread id, labels) -> value
+        self.series = dict()
+
+    def inc(self, labels=(), amount=1):
+        key = (threading.get_ident(), labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = ['# HELP {0} {1}'.format(self.name, self.help),
+                 '# TYPE {0} counter'.format(self.name)]
+        merged = dict()
+        for (_, labels), value in list(self.series.items()):
+            merged[labels] = merged.get(labels, 0) + value
+        for labels, value in sorted(merged.items()):
+            lines.append('{0}{1} {2}'.format(
+                self.name, format_labels(labels), value))
+
+        return lines
+
+
+class Gauge(object):
+    """
+    Prometheus gauge (or counter kept elsewhere) read from a callback
+    at scrape time. The callback returns a number, or a dict of label
+    tuple -> number.
+    """
+    def __init__(self, name, help, func, type='gauge'):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+
+    def render(self) -> list:
+        lines = ['# HELP {0} {1}'.format(self.name, self.help),
+                 '# TYPE {0} {1}'.format(self.name, self.type)]
+        try:
+            value = self.func()
+        except Exception as e:
+            log.error("Failed to read gauge %s: %s", self.name, e)
+            return lines
+
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, val in sorted(value.items()):
+            if val is not None:
+                lines.append('{0}{1} {2}'.format(
+                    self.name, format_labels(labels), val))
+
+        return lines
+
+
+class YoLinkMetrics(object, metaclass=SingletonType):
+    """
+    Process wide metrics registry.
+
+    Pipeline stages record into it unconditionally, recording is a
+    no-op until enable() is called, so the hot path stays cheap when
+    metrics are off.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.metrics = dict()
+        self.routes = dict()
+        self.server = None
+
+        self.stage = self.add(Histogram(
+            'yolink_stage_seconds',
+            'Time spent per pipeline stage.'))
+        self.process_time = self.add(Histogram(
+            'yolink_process_seconds',
+            'YoLinkDevice.process() time per device type.'))
+        self.event_lag = self.add(Histogram(
+            'yolink_event_lag_seconds',
+            'Payload event time to hand off to the sinks.',
+            buckets=LAG_BUCKETS))
+        self.errors = self.add(Counter(
+            'yolink_errors_total',
+            'Pipeline errors per stage.'))
+        self.messages = self.add(Counter(
+            'yolink_messages_total',
+            'Messages per pipeline outcome.'))
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_gauge(self, name, help, func, type='gauge'):
+        """
+        Register a gauge read at scrape time, replacing one with the
+        same name.
+
+        Args:
+            name (str): Metric name.
+            help (str): Metric description.
+            func (callable): Returns the value(s), see Gauge.
+            type (str, optional): gauge, or counter for totals kept
+                by another object.
+        """
+        with self.lock:
+            self.add(Gauge(name, help, func, type))
+
+    def add_route(self, path, func):
+        """
+        Serve an admin endpoint next to /metrics.
+
+        Args:
+            path (str): URL path, e.g. /debug/profile.
+            func (callable): Query parameters dict -> response text.
+        """
+        self.routes[path] = func
+
+    def enable(self):
+        self.enabled = True
+
+    def observe_stage(self, stage, seconds):
+        if self.enabled:
+            self.stage.observe(seconds, (('stage', stage),))
+
+    def observe_process(self, device_type, seconds):
+        if self.enabled:
+            self.process_time.observe(seconds,
+                                      (('device_type', device_type),))
+
+    def observe_lag(self, device_type, seconds):
+        if self.enabled:
+            self.event_lag.observe(seconds,
+                                   (('device_type', device_type),))
+
+    def inc_error(self, stage, amount=1):
+        if self.enabled:
+            self.errors.inc((('stage', stage),), amount)
+
+    def inc_message(self, outcome, amount=1):
+        if self.enabled:
+            self.messages.inc((('outcome', outcome),), amount)
+
+    def render(self) -> str:
+        """
+        Returns:
+            str: All metrics in Prometheus text format.
+        """
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+    def start_server(self, config=None):
+        """
+        Enable recording and serve /metrics on a background thread.
+
+        Args:
+            config (dict, optional): The metrics section of the config.
+        """
+        config = config or {}
+        host = config.get('host', DEFAULT_METRICS_HOST)
+        port = int(config.get('port', DEFAULT_METRICS_PORT))
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == '/metrics':
+                    body = metrics.render()
+                elif url.path in metrics.routes:
+                    try:
+                        body = metrics.routes[url.path](
+                            dict(parse_qsl(url.query)))
+                    except ValueError as e:
+                        self.send_error(400, str(e))
+                        return
+                else:
+                    self.send_error(404)
+                    return
+
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.enable()
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         name='metrics', daemon=True).start()
+        log.info("Metrics on http://%s:%s/metrics",
+                 host, self.server.server_port)
+
+    def stop_server(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -1,11 +1,22 @@
-import json
 import random
+import re
 import sys
+import threading
+import time
 
 import paho.mqtt.client as mqtt
+from yolink_event import YoLinkRawMessage
+from yolink_metrics import YoLinkMetrics
 from logger import Logger
 log = Logger.getInstance().getLogger()
 
+DEFAULT_HEARTBEAT = 300  # seconds
+DEFAULT_HOME = 'default'
+DEFAULT_CLIENT_ID = __name__
+RECONNECT_MAX_DELAY = 60  # seconds
+# Fallback when the subscribed topic has no per device level.
+DEVICE_ID_RE = re.compile(rb'"deviceId"\s*:\s*"([^"]+)"')
+
 
 class YoLinkMqttClient(object):
     """
@@ -13,7 +24,8 @@ class YoLinkMqttClient(object):
     """
     def __init__(self, username: str, passwd: str, topic: str,
                  mqtt_url: str, mqtt_port: str, device_hash: str,
-                 input_q: str, yolink_token: str):
+                 input_q: str, yolink_token: str, home=DEFAULT_HOME):
+        self.home = home
         self.username = username
         self.passwd = passwd
         self.topic = topic
@@ -24,43 +36,84 @@ class YoLinkMqttClient(object):
         self.yolink_token = yolink_token
         self.client = self.get_mqtt_client()
 
-    def get_mqtt_client(self, client_id=random.randint(0, 1000)) -> mqtt:
+        # yl-home/<home id>/<device id>/report, the wildcard level
+        # of the subscription carries the deviceId.
+        levels = topic.split('/')
+        self.device_id_level = levels.index('+') if '+' in levels else None
+        self.received = 0
+        self.rejected = 0
+        self.connected = False
+
+        # In-process reconnect, see request_reconnect()
+        self.running = True
+        self.stopped = threading.Event()
+        self.reconnect_pending = False
+        # Consecutive refused CONNACKs, see refused_delay()
+        self.refused = 0
+        self.renew_on_reconnect = False
+        self.reconnect_started = None
+        self.reconnects = 0
+        self.last_reconnect_duration = None
+        self.max_reconnect_duration = 0.0
+
+    def get_mqtt_client(self, client_id=None) -> mqtt:
         """
         Initialize MQTT client.
 
         Args:
             client_id (string or int, optional): MQTT subscribes require a
-            unique client id. Defaults to random.randint(0, 1000).
+            unique client id. Defaults to random.randint(0, 1000), per
+            client so several homes on the same broker do not take
+            over each other's session.
 
         Returns:
             mqtt: MQTT Client object.
         """
-        mqtt_c = mqtt.Client(client_id=str(__name__ + str(client_id)),
+        if client_id is None:
+            client_id = random.randint(0, 1000)
+        mqtt_c = mqtt.Client(client_id="{0}{1}-{2}".format(
+                                 __name__, client_id, self.home),
                              clean_session=True, userdata=None,
                              protocol=mqtt.MQTTv311, transport="tcp")
         mqtt_c.on_connect = self.on_connect
         mqtt_c.on_message = self.on_message
+        mqtt_c.on_disconnect = self.on_disconnect
+        mqtt_c.reconnect_delay_set(min_delay=1, max_delay=RECONNECT_MAX_DELAY)
         return mqtt_c
 
     def connect_to_broker(self):
         """
         Connect to MQTT broker
         """
-        log.info("[YoLink] Connecting to broker...")
-        log.info("[YoLink] Username: {}, Password: {}".format(
-            self.username,
-            self.passwd
-        ))
+        self.connect()
+        while self.running:
+            # method blocks the program, handles reconnects, etc.
+            # Since we are listening for published messages to the
+            # YoLink broker topic, we need to run indefinitely.
+            # If you need to do other things, than call loop_start()
+            # instead.
+            self.client.loop_forever(retry_first_connection=True)
+            if not self.reconnect_pending:
+                break
+
+            # Disconnected on purpose to pick up new credentials.
+            self.reconnect_pending = False
+            if self.stopped.wait(self.refused_delay()):
+                break
+            self.prepare_reconnect()
+            self.client.connect_async(self.mqtt_url, self.mqtt_port, 10)
+
+    def connect(self):
+        """
+        Connect to MQTT broker without running the network loop.
+        """
+        log.info("[YoLink %s] Connecting to broker...", self.home)
+        log.info("[YoLink %s] Username: %s, Password: %s",
+                 self.home, self.username, self.passwd)
         self.client.username_pw_set(username=self.username,
                                     password=self.passwd)
 
         self.client.connect(self.mqtt_url, self.mqtt_port, 10)
-        # method blocks the program, handles reconnects, etc.
-        # Since we are listening for published messages to the
-        # YoLink broker topic, we need to run indefinitely.
-        # If you need to do other things, than call loop_start()
-        # instead.
-        self.client.loop_forever()
 
     def on_message(self, client, userdata, msg):
         """
@@ -71,50 +124,161 @@ class YoLinkMqttClient(object):
             userdata (): MQTT client metadata.
             msg (json): JSON payload containing MQTT data.
         """
-        payload = json.loads(msg.payload.decode("utf-8"))
-        self.input_q.put(payload)
+        # Runs on the paho network thread, only queue the raw bytes.
+        received_at = time.time()
+        device_id = self.get_device_id(msg)
+        if device_id not in self.device_hash:
+            self.rejected += 1
+            log.debug("Rejected message for unknown device %s", device_id)
+            return
+
+        self.received += 1
+
+        self.input_q.put(YoLinkRawMessage(topic=msg.topic,
+                                          payload=msg.payload,
+                                          device_id=device_id,
+                                          received_at=received_at))
+        YoLinkMetrics.getInstance().observe_stage(
+            'receive', time.time() - received_at)
+
+    def get_device_id(self, msg) -> str:
+        """
+        Get the deviceId of a message without decoding the payload.
+
+        Args:
+            msg (MQTTMessage): Message received from the broker.
+
+        Returns:
+            str: deviceId, None if not found.
+        """
+        if self.device_id_level is not None:
+            levels = msg.topic.split('/')
+            if len(levels) > self.device_id_level:
+                return levels[self.device_id_level]
+
+        match = DEVICE_ID_RE.search(msg.payload)
+        if match:
+            return match.group(1).decode('utf-8')
+
+        return None
 
     def on_connect(self, client, userdata, flags, rc):
         """
         Callback for connection to broker.
         """
-        log.info("[YoLink] Connected with result code %s" % rc)
+        log.info("[YoLink %s] Connected with result code %s", self.home, rc)
 
         if (rc == 0):
-            log.info(("[YoLink] Successfully connected to broker {}").format(
-                self.mqtt_url
-            ))
+            log.info("[YoLink %s] Successfully connected to broker %s",
+                     self.home, self.mqtt_url)
+            self.connected = True
+            self.refused = 0
         else:
-            log.error("[YoLink] Connection with result code %s" % rc)
+            log.error("[YoLink %s] Connection with result code %s",
+                      self.home, rc)
+            self.refused += 1
             self.restart_mqtt()
+            return
 
         self.client.subscribe(self.topic)
 
+        if self.reconnect_started is not None:
+            duration = time.time() - self.reconnect_started
+            self.reconnect_started = None
+            self.reconnects += 1
+            self.last_reconnect_duration = duration
+            self.max_reconnect_duration = \
+                max(self.max_reconnect_duration, duration)
+            log.info("[YoLink %s] Reconnected in %.3fs", self.home, duration)
+
+    def on_disconnect(self, client, userdata, rc):
+        """
+        Callback for broker disconnect, paho reconnects on its own
+        unless the disconnect was requested.
+        """
+        self.connected = False
+        if rc != 0:
+            log.error("[YoLink %s] Connection lost with result code %s",
+                      self.home, rc)
+            if self.reconnect_started is None:
+                self.reconnect_started = time.time()
+
     def restart_mqtt(self):
         """
-        Obtain a new refresh token and restart MQTT connection.
-        """
-        # TODO: It seems like reconnect does not work
-        #       or is not reliable most of the time.
-        #       In that case, just exit and the docker container will
-        #       restart the application.
-        # Workaround for now
-        log.info("Connection lost, restart app")
-        raise SystemExit(1)
-
-        # log.info("Attempting to reconnect with fresh token")
-        # self.client.disconnect()
-        # self.client.loop_stop()
-        # log.info("Disconnected yolink MQTT client")
-        # sleep(2)
-        # log.info("Initializing new yolink MQTT client...")
-        # self.client = self.get_mqtt_client()
-        # log.info("Initialized new yolink MQTT client.")
-        # self.username = self.yolink_token.renew_token()
-        # log.info("Renewed yolink token.")
-        # log.info("Reconnecting to YoLink MQTT broker")
-        # self.connect_to_broker()
-        # sleep(2)
+        Obtain a new access token and restart MQTT connection.
+        """
+        log.info("[YoLink %s] Connection refused, reconnecting with a "
+                 "fresh token", self.home)
+        self.request_reconnect(renew=True)
+
+    def request_reconnect(self, renew=False):
+        """
+        Disconnect and reconnect with the current (or, if renew, a
+        freshly renewed) access token. The network loop picks the
+        reconnect up, the consumers and sinks keep running.
+
+        Args:
+            renew (bool, optional): Force a token renewal before
+                reconnecting. Defaults to False.
+        """
+        if self.reconnect_started is None:
+            self.reconnect_started = time.time()
+        self.renew_on_reconnect = renew
+        self.reconnect_pending = True
+        self.client.disconnect()
+
+    def refused_delay(self) -> float:
+        """
+        Seconds to wait before reconnecting after refused CONNACKs,
+        doubled per refusal up to RECONNECT_MAX_DELAY, so a broker
+        that keeps refusing is not hammered.
+
+        Returns:
+            float: 0 unless the last connect was refused.
+        """
+        if not self.refused:
+            return 0
+        delay = min(RECONNECT_MAX_DELAY, 2 ** (self.refused - 1))
+        log.info("[YoLink %s] Connection refused %s times, reconnecting "
+                 "in %ss", self.home, self.refused, delay)
+        return delay
+
+    def prepare_reconnect(self):
+        """
+        Apply the current access token, renewing it first if it
+        expired or the broker refused it.
+        """
+        renew = self.renew_on_reconnect
+        self.renew_on_reconnect = False
+        try:
+            if renew or self.yolink_token.is_token_expired():
+                self.yolink_token.renew_token(force=True)
+        except Exception as e:
+            log.error("[YoLink %s] Failed to renew token %s", self.home, e)
+
+        self.username = self.yolink_token.access_token
+        self.client.username_pw_set(username=self.username,
+                                    password=self.passwd)
+
+    def stop(self):
+        """
+        Leave the network loop for good.
+        """
+        self.running = False
+        self.stopped.set()
+        self.reconnect_pending = False
+        self.client.disconnect()
+
+    def reconnect_stats(self) -> dict:
+        """
+        Returns:
+            dict: Reconnect count and durations in seconds.
+        """
+        return {
+            'reconnects': self.reconnects,
+            'lastDuration': self.last_reconnect_duration,
+            'maxDuration': self.max_reconnect_duration
+        }
 
 
 class MqttClient(object):
@@ -127,46 +291,173 @@ class MqttClient(object):
         self.host = config['host']
         self.port = config['port']
 
-        self.client = mqtt.Client(client_id=__name__, clean_session=True,
+        self.client = mqtt.Client(client_id=config.get('clientId',
+                                                       DEFAULT_CLIENT_ID),
+                                  clean_session=True,
                                   userdata=None, protocol=mqtt.MQTTv311,
                                   transport="tcp")
         self.client.username_pw_set(config['user'], config['pasw'])
         self.client.on_connect = self.on_connect
 
+        # Change only publishing, see publish_state()
+        self.change_only = config.get('changeOnly', False)
+        self.heartbeat = float(config.get('heartbeat', DEFAULT_HEARTBEAT))
+        self.device_types = config.get('deviceTypes', {})
+        self.last_state = dict()
+        self.state_lock = threading.Lock()
+        self.suppressed = 0
+        self.heartbeat_timer = None
+        # Set on CONNACK, see wait_connected()
+        self.connected = threading.Event()
+
     def connect_to_broker(self):
         """
         Connect to MQTT broker
         """
-        log.info("Connecting to broker...")
-        self.client.connect(self.host, self.port, 10)
+        self.connect()
         # Spins a thread that will call the loop method at
         # regualr intervals and handle re-connects.
         self.client.loop_start()
+        if self.change_only:
+            self.schedule_heartbeat()
+
+    def connect(self):
+        """
+        Connect to MQTT broker without running the network loop.
+        """
+        log.info("Connecting to broker...")
+        self.client.connect(self.host, self.port, 10)
 
     def on_connect(self, client, userdata, flags, rc):
         """
         Callback for broker connection event
         """
-        log.info("Connected with result code %s" % rc)
+        log.info("Connected with result code %s", rc)
 
         if (rc == 0):
-            log.info("Successfully connected to broker %s" % self.host)
+            log.info("Successfully connected to broker %s", self.host)
+            self.connected.set()
         else:
-            log.error("Connection with result code %s" % rc)
+            log.error("Connection with result code %s", rc)
             sys.exit(2)
 
-    def publish(self, topic, data):
+    def wait_connected(self, timeout=None) -> bool:
+        """
+        Wait for the broker to accept the connection.
+
+        Args:
+            timeout (float, optional): Seconds to wait, None to wait
+                forever.
+
+        Returns:
+            bool: True if connected.
+        """
+        return self.connected.wait(timeout)
+
+    def publish(self, topic, data, qos=0, retain=False):
         """
         Publish events to topic
         """
-        rc = self.client.publish(str(topic), data)
+        start = time.time()
+        rc = self.client.publish(str(topic), data, qos=qos, retain=retain)
+        metrics = YoLinkMetrics.getInstance()
+        metrics.observe_stage('mqtt_publish', time.time() - start)
         if rc[0] == 0:
-            log.debug("Successfully published event to topic {0}".format(
-                topic
-            ))
+            log.debug("Successfully published event to topic %s", topic)
         else:
-            log.error("Failed to publish {0} to topic {1}".format(
-                data, topic
-            ))
+            metrics.inc_error('mqtt_publish')
+            log.error("Failed to publish %s to topic %s", data, topic)
 
         return rc[0]
+
+    def get_publish_options(self, device_type: str) -> tuple:
+        """
+        QoS and retain flag configured for a device type.
+
+        Args:
+            device_type (str): Raw YoLink device type, e.g. DoorSensor.
+
+        Returns:
+            tuple: (qos, retain)
+        """
+        options = self.device_types.get(device_type, {})
+        return (int(options.get('qos', 0)),
+                bool(options.get('retain', False)))
+
+    def publish_state(self, topic, data, device_type=None):
+        """
+        Publish a device state to topic.
+
+        In changeOnly mode the state is only sent when it differs from
+        the last one published on that topic, the heartbeat resends
+        unchanged states periodically.
+
+        Args:
+            topic (str): Topic to publish to.
+            data (str): Device state.
+            device_type (str, optional): Raw YoLink device type, picks
+                the QoS and retain flag.
+
+        Returns:
+            int: 0 if published or suppressed, else paho error code.
+        """
+        qos, retain = self.get_publish_options(device_type)
+        if not self.change_only:
+            return self.publish(topic, data, qos, retain)
+
+        now = time.time()
+        with self.state_lock:
+            last = self.last_state.get(topic)
+            if last is not None and last[0] == data:
+                self.suppressed += 1
+                return 0
+
+            entry = self.last_state[topic] = [data, now, qos, retain]
+
+        rc = self.publish(topic, data, qos, retain)
+        if rc != 0:
+            # Not sent, a retry of the same state must not be
+            # suppressed.
+            with self.state_lock:
+                if self.last_state.get(topic) is entry:
+                    if last is None:
+                        del self.last_state[topic]
+                    else:
+                        self.last_state[topic] = last
+        return rc
+
+    def send_heartbeats(self):
+        """
+        Resend every state that was not published for a heartbeat
+        interval.
+
+        Published under state_lock, so a newer state cannot be sent
+        between reading a state and resending it.
+        """
+        now = time.time()
+        with self.state_lock:
+            stale = [(topic, state) for topic, state
+                     in self.last_state.items()
+                     if now - state[1] >= self.heartbeat]
+            for topic, state in stale:
+                state[1] = now
+                data, _, qos, retain = state
+                self.publish(topic, data, qos, retain)
+
+        if stale:
+            log.debug("Sent %s heartbeat(s), %s publishes suppressed so far",
+                      len(stale), self.suppressed)
+
+    def schedule_heartbeat(self):
+        """
+        Run send_heartbeats() every heartbeat interval on a timer
+        thread (threaded runtime).
+        """
+        self.heartbeat_timer = \
+            threading.Timer(self.heartbeat, self.run_heartbeat)
+        self.heartbeat_timer.daemon = True
+        self.heartbeat_timer.start()
+
+    def run_heartbeat(self):
+        self.send_heartbeats()
+        self.schedule_heartbeat()
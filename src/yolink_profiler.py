@@ -0,0 +1,287 @@
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+from collections import Counter
+from logger import Logger, SingletonType
+log = Logger.getInstance().getLogger()
+
+DEFAULT_PROFILE_DIR = 'profiles'
+DEFAULT_DURATION = 30  # seconds
+DEFAULT_SAMPLE_INTERVAL = 0.005  # seconds
+DEFAULT_TOP = 25
+DEFAULT_TRACE_FRAMES = 10
+# Threads that run YoLinkDevice.process() in the threaded runtime.
+CONSUMER_THREAD_PREFIXES = ('consumer-', 'shard-')
+
+MODE_CPROFILE = 'cprofile'
+MODE_SAMPLE = 'sample'
+MODES = (MODE_CPROFILE, MODE_SAMPLE)
+
+
+class YoLinkProfiler(object, metaclass=SingletonType):
+    """
+    On demand CPU and memory profiling of the running service.
+
+    CPU profiles cover the consumer stage for a number of seconds:
+        cprofile: deterministic, every process_entry() call is run
+                  under a per thread cProfile.Profile, merged on dump.
+        sample:   statistical, the consumer threads' stacks are sampled
+                  every few ms, written as collapsed stacks that
+                  flamegraph tools read.
+    Memory snapshots use tracemalloc, each snapshot is diffed against
+    the previous one to show the top growing allocation sites.
+
+    Results are written to the profile directory, triggered by
+    signals or the admin endpoints on the metrics server.
+    """
+    def __init__(self):
+        self.directory = DEFAULT_PROFILE_DIR
+        self.duration = DEFAULT_DURATION
+        self.top = DEFAULT_TOP
+        self.trace_frames = DEFAULT_TRACE_FRAMES
+        self.lock = threading.Lock()
+
+        # Checked on every process_entry() call, keep it a plain bool.
+        self.cprofile_active = False
+        self.profiles = dict()
+        # Calls run without a profile, see run_profiled().
+        self.unprofiled = 0
+        self.busy = False
+        self.snapshot = None
+
+    def configure(self, config=None):
+        """
+        Args:
+            config (dict, optional): The profiling section of the
+                config file.
+        """
+        config = config or {}
+        self.directory = config.get('directory', DEFAULT_PROFILE_DIR)
+        self.duration = float(config.get('duration', DEFAULT_DURATION))
+        self.top = int(config.get('top', DEFAULT_TOP))
+        self.trace_frames = int(config.get('traceFrames',
+                                           DEFAULT_TRACE_FRAMES))
+        os.makedirs(self.directory, exist_ok=True)
+
+        if config.get('traceMallocOnStart', False):
+            # Baseline from boot, so the first diff shows all growth.
+            self.memory_snapshot()
+
+        cpu_signal = config.get('cpuSignal', 'SIGUSR1')
+        memory_signal = config.get('memorySignal', 'SIGUSR2')
+        mode = config.get('mode', MODE_SAMPLE)
+        if cpu_signal:
+            signal.signal(getattr(signal, cpu_signal),
+                          lambda signum, frame: self.start_cpu_profile(mode))
+        if memory_signal:
+            signal.signal(getattr(signal, memory_signal),
+                          lambda signum, frame: threading.Thread(
+                              target=self.memory_snapshot,
+                              daemon=True).start())
+
+    def path(self, kind: str, suffix: str) -> str:
+        return os.path.join(self.directory, "{0}-{1}.{2}".format(
+            kind, time.strftime("%Y%m%d-%H%M%S"), suffix))
+
+    def run_profiled(self, func, *args):
+        """
+        Run func, under this thread's cProfile.Profile while a
+        cprofile capture is active.
+
+        Python 3.12+ allows one active profiler per process, a call
+        that cannot enable its profile (another consumer thread's or
+        another tool's is active) runs unprofiled.
+        """
+        if not self.cprofile_active:
+            return func(*args)
+
+        ident = threading.get_ident()
+        profile = self.profiles.get(ident)
+        if profile is None:
+            with self.lock:
+                profile = self.profiles.setdefault(ident,
+                                                   cProfile.Profile())
+
+        try:
+            profile.enable()
+        except ValueError:
+            self.unprofiled += 1
+            return func(*args)
+
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+
+    def start_cpu_profile(self, mode=MODE_SAMPLE, duration=None) -> str:
+        """
+        Start a CPU profile capture in the background.
+
+        Args:
+            mode (str, optional): cprofile or sample.
+            duration (float, optional): Seconds to capture, defaults
+                to the configured duration.
+
+        Returns:
+            str: Status message.
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown profile mode {0}".format(mode))
+        duration = self.duration if duration is None else float(duration)
+
+        with self.lock:
+            if self.busy:
+                return "CPU profile already running\n"
+            self.busy = True
+
+        target = self.cprofile if mode == MODE_CPROFILE else self.sample
+        threading.Thread(target=target, args=(duration,), name='profiler',
+                         daemon=True).start()
+        log.info("Started %s CPU profile for %ss", mode, duration)
+        return "Started {0} CPU profile for {1}s\n".format(mode, duration)
+
+    def cprofile(self, duration: float):
+        try:
+            self.profiles = dict()
+            self.unprofiled = 0
+            self.cprofile_active = True
+            time.sleep(duration)
+            self.cprofile_active = False
+            if self.unprofiled:
+                log.info("%s calls ran unprofiled, another profiler was "
+                         "active", self.unprofiled)
+
+            profiles = [profile for profile in self.profiles.values()
+                        if profile.getstats()]
+            if not profiles:
+                log.info("No consumer activity while profiling")
+                return
+
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+
+            fname = self.path('cpu', 'prof')
+            stats.dump_stats(fname)
+
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(self.top)
+            with open(self.path('cpu', 'txt'), 'w') as fp:
+                fp.write(out.getvalue())
+            log.info("CPU profile written to %s", fname)
+        finally:
+            self.cprofile_active = False
+            self.profiles = dict()
+            self.busy = False
+
+    def sample(self, duration: float, interval=DEFAULT_SAMPLE_INTERVAL):
+        try:
+            stacks = Counter()
+            samples = 0
+            deadline = time.time() + duration
+            while time.time() < deadline:
+                idents = {thread.ident for thread in threading.enumerate()
+                          if thread.name.startswith(
+                              CONSUMER_THREAD_PREFIXES)}
+                if not idents:
+                    # asyncio runtime, consumers run on the main thread.
+                    idents = {threading.main_thread().ident}
+
+                for ident, frame in sys._current_frames().items():
+                    if ident not in idents:
+                        continue
+
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append("{0}:{1}:{2}".format(
+                            os.path.basename(code.co_filename),
+                            code.co_name,
+                            frame.f_lineno))
+                        frame = frame.f_back
+                    stacks[';'.join(reversed(stack))] += 1
+                    samples += 1
+
+                time.sleep(interval)
+
+            fname = self.path('cpu', 'folded')
+            with open(fname, 'w') as fp:
+                for stack, count in stacks.most_common():
+                    fp.write("{0} {1}\n".format(stack, count))
+
+            # Self time per function, the leaf of each stack.
+            leaves = Counter()
+            for stack, count in stacks.items():
+                leaves[stack.rsplit(';', 1)[-1].rsplit(':', 1)[0]] += count
+            with open(self.path('cpu', 'txt'), 'w') as fp:
+                fp.write("{0} samples\n".format(samples))
+                for func, count in leaves.most_common(self.top):
+                    fp.write("{0:6.2f}% {1}\n".format(
+                        100.0 * count / max(1, samples), func))
+            log.info("CPU samples written to %s", fname)
+        finally:
+            self.busy = False
+
+    def memory_snapshot(self) -> str:
+        """
+        Take a tracemalloc snapshot and write the top allocation
+        sites, and the growth since the previous snapshot.
+
+        The first call only starts tracing, there is nothing to
+        compare against yet.
+
+        Returns:
+            str: The report, or a status message.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace_frames)
+            self.snapshot = tracemalloc.take_snapshot()
+            log.info("Started tracemalloc, next snapshot shows the "
+                     "growth from now")
+            return "Started tracemalloc\n"
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+
+        out = io.StringIO()
+        out.write("Traced {0} KiB, peak {1} KiB\n\n".format(
+            current // 1024, peak // 1024))
+        out.write("Top growth since last snapshot:\n")
+        if self.snapshot:
+            for stat in snapshot.compare_to(self.snapshot,
+                                            'lineno')[:self.top]:
+                out.write("{0}\n".format(stat))
+        out.write("\nTop allocation sites:\n")
+        for stat in snapshot.statistics('lineno')[:self.top]:
+            out.write("{0}\n".format(stat))
+
+        self.snapshot = snapshot
+        report = out.getvalue()
+        fname = self.path('memory', 'txt')
+        with open(fname, 'w') as fp:
+            fp.write(report)
+        log.info("Memory snapshot written to %s", fname)
+        return report
+
+    def register_routes(self, metrics):
+        """
+        Add the admin endpoints to the metrics server:
+            /debug/profile?mode=sample&seconds=30
+            /debug/memory
+        """
+        metrics.add_route('/debug/profile', lambda params:
+                          self.start_cpu_profile(
+                              params.get('mode', MODE_SAMPLE),
+                              params.get('seconds')))
+        metrics.add_route('/debug/memory',
+                          lambda params: self.memory_snapshot())
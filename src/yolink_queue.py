@@ -0,0 +1,318 @@
+import os
+import pickle
+import queue
+import threading
+
+from collections import deque
+
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_PUT_TIMEOUT = 5.0  # seconds
+DEFAULT_SPILL_FILE = 'yolink_spill.dat'
+# Log every Nth drop so a stalled sink does not flood the log.
+DROP_LOG_EVERY = 100
+
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'dropOldest'
+POLICY_DROP_NEWEST = 'dropNewest'
+POLICY_SPILL = 'spill'
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST,
+            POLICY_DROP_NEWEST, POLICY_SPILL)
+
+# Alarm type devices must never lose an event to coalescing.
+DEFAULT_COALESCE_EXCLUDE = ['DoorSensor', 'LeakSensor', 'VibrationSensor']
+
+
+class OverflowQueue(queue.Queue):
+    """
+    Bounded queue with a configurable policy for when it is full.
+
+        block:      wait up to timeout seconds, then drop the new entry.
+        dropOldest: ring buffer, evict the oldest entry.
+        dropNewest: drop the new entry.
+        spill:      append to a file on disk, entries are moved back
+                    into memory in order as the consumer catches up.
+                    Entries still in the spill file at exit are
+                    replayed on the next start (at least once).
+    """
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=POLICY_BLOCK,
+                 timeout=DEFAULT_PUT_TIMEOUT, spill_file=DEFAULT_SPILL_FILE):
+        """
+        Args:
+            maxsize (int, optional): Max entries kept in memory.
+            policy (str, optional): One of POLICIES.
+            timeout (float, optional): Seconds to wait with the block
+                policy, None to wait forever.
+            spill_file (str, optional): File used by the spill policy.
+        """
+        super(OverflowQueue, self).__init__(maxsize=maxsize)
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy {0}".format(policy))
+
+        self.policy = policy
+        self.timeout = timeout
+        self.dropped = 0
+        self.spilled = 0
+
+        self.spill_file = spill_file
+        self.spill_count = 0
+        self.spill_lock = threading.Lock()
+        self.spill_w = None
+        self.spill_r = None
+        # Set once a stop sentinel is queued, see put_control().
+        self.stopping = False
+        if policy == POLICY_SPILL:
+            self.open_spill()
+
+    @classmethod
+    def from_config(cls, config=None, suffix='', *args):
+        """
+        Create a queue from the queue section of the config file.
+
+        Args:
+            config (dict, optional): Queue config.
+            suffix (str, optional): Appended to the spill file name,
+                so several queues do not share one file.
+            args: Extra positional arguments for the subclass.
+
+        Returns:
+            OverflowQueue: The queue.
+        """
+        config = config or {}
+        return cls(*args,
+                   maxsize=int(config.get('size', DEFAULT_QUEUE_SIZE)),
+                   policy=config.get('policy', POLICY_BLOCK),
+                   timeout=config.get('timeout', DEFAULT_PUT_TIMEOUT),
+                   spill_file=config.get('spillFile',
+                                         DEFAULT_SPILL_FILE) + suffix)
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Enqueue an entry, applying the overflow policy when full.
+
+        block and timeout are accepted for queue.Queue compatibility,
+        the policy decides what happens when the queue is full.
+        """
+        if self.policy == POLICY_BLOCK:
+            try:
+                super(OverflowQueue, self).put(item, True, self.timeout)
+            except queue.Full:
+                self.drop()
+        elif self.policy == POLICY_DROP_NEWEST:
+            try:
+                super(OverflowQueue, self).put(item, False)
+            except queue.Full:
+                self.drop()
+        elif self.policy == POLICY_DROP_OLDEST:
+            self.put_evict(item)
+        else:
+            self.put_spill(item)
+
+    def put_control(self, item):
+        """
+        Enqueue a stop sentinel, bypassing the overflow policy. Blocks
+        until there is room.
+
+        Spilled entries are no longer moved back into memory, they
+        would land behind the sentinel and be lost when the consumer
+        stops. They stay in the spill file for the next start.
+        """
+        with self.spill_lock:
+            self.stopping = True
+        super(OverflowQueue, self).put(item)
+
+    def get(self, block=True, timeout=None):
+        item = super(OverflowQueue, self).get(block, timeout)
+        if self.spill_count:
+            self.refill()
+        return item
+
+    def drop(self):
+        self.dropped += 1
+        if self.dropped % DROP_LOG_EVERY == 1:
+            log.warning("Queue full (%s policy), dropped %s entries so far",
+                        self.policy, self.dropped)
+
+    def put_evict(self, item):
+        """
+        Ring buffer put, evicts the oldest entry when full. Once a
+        stop sentinel is queued the new entry is dropped instead, the
+        sentinel must not be evicted.
+        """
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                if self.stopping:
+                    self.drop()
+                    return
+                self._get()
+                self.unfinished_tasks -= 1
+                if self.unfinished_tasks == 0:
+                    self.all_tasks_done.notify_all()
+                self.drop()
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def put_spill(self, item):
+        """
+        Put in memory if possible, else append to the spill file.
+        Once anything is spilled, new entries go to the file too so
+        FIFO order is kept.
+        """
+        with self.spill_lock:
+            if self.spill_count == 0:
+                try:
+                    super(OverflowQueue, self).put(item, False)
+                    return
+                except queue.Full:
+                    pass
+
+            pickle.dump(item, self.spill_w)
+            self.spill_w.flush()
+            self.spill_count += 1
+            self.spilled += 1
+            if self.spill_count == 1:
+                log.warning("Queue full, spilling to %s", self.spill_file)
+
+    def refill(self):
+        """
+        Move spilled entries back into memory while there is room.
+        """
+        with self.spill_lock:
+            while self.spill_count and not self.stopping and \
+                    not self.full():
+                item = pickle.load(self.spill_r)
+                self.spill_count -= 1
+                super(OverflowQueue, self).put(item, False)
+
+            if self.spill_count == 0 and self.spill_w.tell():
+                self.spill_w.seek(0)
+                self.spill_w.truncate()
+                self.spill_r.seek(0)
+                log.info("Spill file %s drained", self.spill_file)
+
+    def open_spill(self):
+        """
+        Open the spill file, counting entries left by a previous run.
+        """
+        self.spill_w = open(self.spill_file, 'ab')
+        self.spill_r = open(self.spill_file, 'rb')
+
+        good = 0
+        while True:
+            try:
+                pickle.load(self.spill_r)
+                self.spill_count += 1
+                good = self.spill_r.tell()
+            except EOFError:
+                break
+            except (pickle.UnpicklingError, ValueError, AttributeError):
+                log.error("Corrupt entry in spill file %s", self.spill_file)
+                break
+
+        # Cut off a torn write from a crash, keep what was readable.
+        self.spill_w.truncate(good)
+        self.spill_r.seek(0)
+        if self.spill_count:
+            log.info("Replaying %s spilled entries from %s",
+                     self.spill_count, os.path.abspath(self.spill_file))
+            self.refill()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Policy, depth and dropped/spilled counters.
+        """
+        return {
+            'policy': self.policy,
+            'size': self.qsize(),
+            'spillDepth': self.spill_count,
+            'dropped': self.dropped,
+            'spilled': self.spilled
+        }
+
+
+class CoalescingQueue(OverflowQueue):
+    """
+    Latest-value OverflowQueue.
+
+    Entries with the same key replace each other while pending: the
+    newer entry takes the place of the older one, so the consumer
+    only sees the freshest value and keeps the original position in
+    line. Entries whose key is None are never merged.
+    """
+    def __init__(self, key_func, **kwargs):
+        """
+        Args:
+            key_func (callable): entry -> hashable key, or None for
+                entries that must not be merged.
+            kwargs: OverflowQueue arguments.
+        """
+        self.key_func = key_func
+        self.merged = 0
+        super(CoalescingQueue, self).__init__(**kwargs)
+
+    # Internal storage holds (key, [entry]) pairs, the one element
+    # list lets a newer entry be swapped in without moving it.
+    def _init(self, maxsize):
+        self.queue = deque()
+        self.pending = dict()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        key, box = item
+        if key is not None:
+            self.pending[key] = box
+        self.queue.append(item)
+
+    def _get(self):
+        key, box = self.queue.popleft()
+        if key is not None and self.pending.get(key) is box:
+            del self.pending[key]
+        return box[0]
+
+    def put(self, item, block=True, timeout=None):
+        key = self.key_func(item)
+        if key is not None:
+            with self.mutex:
+                box = self.pending.get(key)
+                if box is not None:
+                    box[0] = item
+                    self.merged += 1
+                    return
+
+        super(CoalescingQueue, self).put((key, [item]), block, timeout)
+
+    def put_control(self, item):
+        super(CoalescingQueue, self).put_control((None, [item]))
+
+    def stats(self) -> dict:
+        stats = super(CoalescingQueue, self).stats()
+        stats['merged'] = self.merged
+        return stats
+
+
+def create_queue(config=None, suffix='', key_func=None):
+    """
+    Create the ingest queue described by the queue section of the
+    config file.
+
+    Args:
+        config (dict, optional): Queue config.
+        suffix (str, optional): Appended to the spill file name.
+        key_func (callable, optional): Coalescing key, used when
+            queue.coalesce is enabled.
+
+    Returns:
+        OverflowQueue: A CoalescingQueue if coalescing is enabled.
+    """
+    config = config or {}
+    if config.get('coalesce', False) and key_func:
+        return CoalescingQueue.from_config(config, suffix, key_func)
+
+    return OverflowQueue.from_config(config, suffix)
@@ -0,0 +1,157 @@
+from influxdb_downsample import InfluxDbDownsampler, DEFAULT_WINDOW
+from influxdb_interface import InfluxDbClient, InfluxDbWriter
+from influxdb_spool import InfluxDbSpool
+from yolink_dedup import YoLinkDedup, DEFAULT_MAX_ENTRIES
+from yolink_mqtt_client import MqttClient
+from yolink_sinks import YoLinkFanout
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+LOCAL_MQTT_TIMEOUT = 10  # seconds
+
+
+def create_influxdb_writer(config, start=True, ping=False):
+    """
+    Create the shared influx db writer.
+
+    Args:
+        config (map): Config hash map.
+        start (bool, optional): Start the writer's flush thread.
+            Defaults to True.
+        ping (bool, optional): Check that influx db is reachable.
+            Defaults to False.
+
+    Returns:
+        InfluxDbWriter: The writer, None if no sensors.
+    """
+    influxdb_info = config['influxdb']
+    if len(influxdb_info['sensors']) == 0:
+        log.debug("No sensors are configured for influx db")
+        return None
+
+    spool = None
+    spool_config = influxdb_info.get('spool', {})
+    if spool_config.get('enabled', False):
+        spool = InfluxDbSpool.from_config(spool_config)
+
+    downsampler = None
+    downsample_config = influxdb_info.get('downsample', {})
+    if downsample_config.get('enabled', False):
+        downsampler = InfluxDbDownsampler.from_config(downsample_config)
+        log.info("Downsampling influx db points, %ss windows%s",
+                 downsample_config.get('window', DEFAULT_WINDOW),
+                 '' if downsampler.vectorized else ' (without NumPy)')
+
+    writer = InfluxDbWriter(config=influxdb_info, spool=spool,
+                            downsampler=downsampler)
+    if ping and not writer.ping():
+        log.warning("Influx db not reachable at startup, points are "
+                    "kept until it is")
+
+    if start:
+        writer.start()
+    return writer
+
+
+def attach_influxdb_clients(device_hash, config, writer):
+    """
+    Give every configured influx db sensor a client on the writer.
+
+    Args:
+        device_hash (map): Device hash map.
+        config (map): Config hash map.
+        writer (InfluxDbWriter): The shared writer.
+    """
+    for sensor in config['influxdb']['sensors']:
+        device_id = sensor['deviceId']
+        if device_id in device_hash:
+            client = \
+                InfluxDbClient(writer=writer,
+                               measurement=sensor['measurement'],
+                               tag_set=sensor.get('tagSet'),
+                               tags=sensor.get('tags'),
+                               raw=sensor.get('raw', False))
+            device_hash[device_id].set_influxdb_client(client)
+
+
+def create_local_mqtt_server(config, connect=True, timeout=None):
+    """
+    Create the local broker client.
+
+    Args:
+        config (map): Config hash map.
+        connect (bool, optional): Connect and start the network
+            loop thread. Defaults to True.
+        timeout (float, optional): With connect, seconds to wait for
+            the broker to accept the connection. Defaults to None
+            (do not wait).
+
+    Returns:
+        MqttClient: The local broker client.
+    """
+    mqtt_server = \
+        MqttClient(config=config['mqttBroker'])
+
+    if connect:
+        mqtt_server.connect_to_broker()
+        if timeout is not None and \
+                not mqtt_server.wait_connected(timeout):
+            log.warning("Local broker did not accept the connection within "
+                        "%ss", timeout)
+
+    return mqtt_server
+
+
+def create_dedup(config):
+    """
+    Args:
+        config (map): Config hash map.
+
+    Returns:
+        YoLinkDedup: The filter, None if disabled.
+    """
+    dedup_config = config.get('dedup', {})
+    if not dedup_config.get('enabled', False):
+        return None
+
+    return YoLinkDedup(max_entries=dedup_config.get(
+        'maxEntries', DEFAULT_MAX_ENTRIES))
+
+
+def create_sinks(config, influxdb_writer=None, mqtt_server=None):
+    """
+    Args:
+        config (map): Config hash map.
+        influxdb_writer (InfluxDbWriter, optional): Shared writer.
+        mqtt_server (MqttClient, optional): Local broker client.
+
+    Returns:
+        YoLinkFanout: The started sinks, None if disabled (devices
+        then write to their sinks inline).
+    """
+    sinks_config = config.get('sinks', {})
+    if not sinks_config.get('enabled', False):
+        return None
+
+    sinks = YoLinkFanout.from_config(sinks_config, influxdb_writer,
+                                     mqtt_server)
+    if not sinks.sinks:
+        return None
+
+    sinks.start()
+    return sinks
+
+
+def attach_sinks(devices, mqtt_server=None, sinks=None):
+    """
+    Attach the local broker and the sink fan-out to devices.
+
+    Args:
+        devices (iterable): YoLinkDevice objects.
+        mqtt_server (MqttClient, optional): Local broker client.
+        sinks (YoLinkFanout, optional): Per sink queues and workers.
+    """
+    for device in devices:
+        if mqtt_server:
+            device.set_mqtt_server(mqtt_server)
+        device.set_sinks(sinks)
@@ -0,0 +1,346 @@
+import json
+import threading
+import time
+
+from http_transport import HttpTransport
+from yolink_consumer import STOP_SENTINEL
+from yolink_metrics import YoLinkMetrics
+from yolink_queue import OverflowQueue, POLICY_DROP_OLDEST, POLICY_SPILL, \
+    DEFAULT_PUT_TIMEOUT
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+DEFAULT_SINK_QUEUE_SIZE = 1024
+DEFAULT_RETRY_DELAY = 1.0  # seconds, doubled per retry
+DEFAULT_EVENTS_FILE = 'yolink_events.jsonl'
+
+
+def event_record(device, event, values) -> dict:
+    """
+    JSON friendly record of a processed event, for the file and
+    webhook sinks.
+
+    Args:
+        device (YoLinkDevice): The device.
+        event (YoLinkEvent): The event.
+        values (dict): Extracted field values.
+
+    Returns:
+        dict: The record.
+    """
+    return {
+        'time': event.time,
+        'deviceId': device.get_id(),
+        'name': device.get_name(),
+        'type': device.get_raw_type(),
+        'event': event.event,
+        'values': values
+    }
+
+
+class YoLinkSink(object):
+    """
+    A destination for processed device events.
+
+    Every sink has its own bounded queue and worker thread, so a slow
+    or failing sink only fills (and, by its policy, drops from) its
+    own queue and never holds up the consumers or the other sinks.
+    A failed write is retried with backoff on the sink's thread.
+    """
+    name = 'sink'
+
+    def __init__(self, config=None):
+        """
+        Args:
+            config (dict, optional): The sink's section of the sinks
+                config: queueSize, policy (block, dropOldest or
+                dropNewest), timeout, retries, retryDelay and
+                deviceTypes (raw types to send, default all).
+
+        Raises:
+            ValueError: On the spill policy, sink entries hold live
+                device objects.
+        """
+        config = config or {}
+        policy = config.get('policy', POLICY_DROP_OLDEST)
+        if policy == POLICY_SPILL:
+            raise ValueError("{0} sink: spill policy not supported".format(
+                self.name))
+
+        self.queue = OverflowQueue.from_config({
+            'size': config.get('queueSize', DEFAULT_SINK_QUEUE_SIZE),
+            'policy': policy,
+            'timeout': config.get('timeout', DEFAULT_PUT_TIMEOUT)
+        })
+        self.retries = int(config.get('retries', 0))
+        self.retry_delay = float(config.get('retryDelay',
+                                            DEFAULT_RETRY_DELAY))
+        device_types = config.get('deviceTypes')
+        self.device_types = \
+            None if device_types is None else frozenset(device_types)
+        self.written = 0
+        self.failed = 0
+        self.thread = None
+
+    def accepts(self, device) -> bool:
+        """
+        Args:
+            device (YoLinkDevice): The device.
+
+        Returns:
+            bool: True if the device's events go to this sink.
+        """
+        return self.device_types is None or \
+            device.get_raw_type() in self.device_types
+
+    def put(self, device, event, values):
+        self.queue.put((device, event, values))
+
+    def write(self, device, event, values) -> int:
+        """
+        Deliver one event, runs on the sink's thread.
+
+        Returns:
+            int: 0 if successful.
+        """
+        raise NotImplementedError
+
+    def deliver(self, entry):
+        """
+        Write an entry, retrying with backoff.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                rc = self.write(*entry)
+            except Exception as e:
+                log.error("%s sink: %s", self.name, e)
+                rc = -1
+
+            if rc == 0:
+                self.written += 1
+                return
+            if attempt < self.retries:
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+        self.failed += 1
+        YoLinkMetrics.getInstance().inc_error('sink_' + self.name)
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                if entry is STOP_SENTINEL:
+                    break
+                self.deliver(entry)
+            finally:
+                self.queue.task_done()
+
+        self.close()
+
+    def close(self):
+        """
+        Release the sink's resources, called on its thread after the
+        queue is drained.
+        """
+        pass
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='sink-' + self.name,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Drain the queue and stop the worker.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the worker.
+        """
+        self.queue.put_control(STOP_SENTINEL)
+        if self.thread:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                log.error("%s sink did not drain in time, %s entries "
+                          "left", self.name, self.queue.qsize())
+            self.thread = None
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Written/failed counters and queue stats.
+        """
+        stats = self.queue.stats()
+        stats['written'] = self.written
+        stats['failed'] = self.failed
+        return stats
+
+
+class MqttSink(YoLinkSink):
+    """
+    Publishes the mqtt field of devices attached to the local broker.
+    """
+    name = 'mqtt'
+
+    def accepts(self, device) -> bool:
+        return device.type.mqtt_field is not None and \
+            device.mqtt_server is not None and \
+            super(MqttSink, self).accepts(device)
+
+    def write(self, device, event, values) -> int:
+        return device.publish_state(event, values)
+
+
+class InfluxDbSink(YoLinkSink):
+    """
+    Writes the influx db fields of devices with an influx db client.
+    """
+    name = 'influxdb'
+
+    def accepts(self, device) -> bool:
+        return bool(device.type.influxdb_fields) and \
+            device.influxdb_client is not None and \
+            super(InfluxDbSink, self).accepts(device)
+
+    def write(self, device, event, values) -> int:
+        return device.write_influxdb(event, values)
+
+
+class FileSink(YoLinkSink):
+    """
+    Appends every event as one JSON object per line.
+    """
+    name = 'file'
+
+    def __init__(self, config=None):
+        """
+        Args:
+            config (dict, optional): path (events file) and the
+                YoLinkSink settings.
+        """
+        super(FileSink, self).__init__(config)
+        self.path = (config or {}).get('path', DEFAULT_EVENTS_FILE)
+        self.fp = open(self.path, 'a')
+
+    def write(self, device, event, values) -> int:
+        self.fp.write(json.dumps(event_record(device, event, values)))
+        self.fp.write('\n')
+        # One flush per burst, not per event.
+        if self.queue.empty():
+            self.fp.flush()
+        return 0
+
+    def close(self):
+        self.fp.close()
+
+
+class WebhookSink(YoLinkSink):
+    """
+    POSTs every event as JSON to a url.
+    """
+    name = 'webhook'
+
+    def __init__(self, config):
+        """
+        Args:
+            config (dict): url, headers (optional) and the YoLinkSink
+                settings.
+        """
+        super(WebhookSink, self).__init__(config)
+        self.url = config['url']
+        self.headers = config.get('headers', {})
+
+    def write(self, device, event, values) -> int:
+        response = HttpTransport.getInstance().post(
+            self.url,
+            json=event_record(device, event, values),
+            headers=self.headers)
+        if not response.ok:
+            log.error("Webhook %s returned %s", self.url,
+                      response.status_code)
+            return -1
+        return 0
+
+
+class YoLinkFanout(object):
+    """
+    Hands every processed event to each sink that takes the device.
+
+    Only puts on the sinks' queues, the consumer moves on to the next
+    entry right away.
+    """
+    def __init__(self, sinks):
+        """
+        Args:
+            sinks (list): YoLinkSink objects.
+        """
+        self.sinks = list(sinks)
+
+    @classmethod
+    def from_config(cls, config=None, influxdb_writer=None,
+                    mqtt_server=None):
+        """
+        Args:
+            config (dict, optional): The sinks section of the config.
+            influxdb_writer (InfluxDbWriter, optional): Adds the influx
+                db sink.
+            mqtt_server (MqttClient, optional): Adds the local MQTT
+                sink.
+
+        Returns:
+            YoLinkFanout: The fan-out, sinks not yet started.
+        """
+        config = config or {}
+
+        def sink_config(name):
+            # Shared queue settings, overridden per sink.
+            merged = {key: value for key, value in config.items()
+                      if not isinstance(value, dict)}
+            merged.update(config.get(name, {}))
+            return merged
+
+        sinks = []
+        if mqtt_server:
+            sinks.append(MqttSink(sink_config('mqtt')))
+        if influxdb_writer:
+            sinks.append(InfluxDbSink(sink_config('influxdb')))
+        for name, sink_cls in (('file', FileSink),
+                               ('webhook', WebhookSink)):
+            if config.get(name, {}).get('enabled', False):
+                sinks.append(sink_cls(sink_config(name)))
+
+        return cls(sinks)
+
+    def emit(self, device, event, values):
+        """
+        Queue an event for every sink that takes the device.
+
+        Args:
+            device (YoLinkDevice): The device.
+            event (YoLinkEvent): The event.
+            values (dict): Extracted field values.
+        """
+        for sink in self.sinks:
+            if sink.accepts(device):
+                sink.put(device, event, values)
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+        log.info("Started sinks: %s",
+                 ', '.join(sink.name for sink in self.sinks))
+
+    def stop(self, timeout=None):
+        """
+        Drain and stop every sink.
+        """
+        for sink in self.sinks:
+            sink.stop(timeout)
+        log.info("Sink stats: %s", self.stats())
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: sink name -> stats.
+        """
+        return {sink.name: sink.stats() for sink in self.sinks}
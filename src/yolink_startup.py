@@ -0,0 +1,88 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+DEFAULT_STARTUP_WORKERS = 4
+
+
+class StartupGraph(object):
+    """
+    Startup steps with dependencies between them.
+
+    Each phase starts as soon as the phases it depends on are done,
+    independent phases (e.g. cloud lookups and sink connections) run
+    concurrently. A phase is called with the results of its
+    dependencies as keyword arguments.
+    """
+    def __init__(self, workers=DEFAULT_STARTUP_WORKERS):
+        """
+        Args:
+            workers (int, optional): Max phases running at once.
+        """
+        self.workers = workers
+        self.phases = dict()
+        self.timings = dict()
+
+    def add(self, name: str, func, deps=()):
+        """
+        Add a phase.
+
+        Args:
+            name (str): Phase name, also the keyword its result is
+                passed under.
+            func (callable): Phase body.
+            deps (tuple, optional): Names of the phases it needs.
+        """
+        self.phases[name] = (func, tuple(deps))
+
+    def run(self) -> dict:
+        """
+        Run all phases, raising the first phase error.
+
+        Returns:
+            dict: Phase name -> result.
+        """
+        for name, (_, deps) in self.phases.items():
+            for dep in deps:
+                if dep not in self.phases:
+                    raise ValueError("Startup phase {0} depends on "
+                                     "unknown phase {1}".format(name, dep))
+
+        results = dict()
+        running = dict()
+        started = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix='startup') as executor:
+            while len(results) < len(self.phases):
+                for name, (func, deps) in self.phases.items():
+                    if name in results or name in running.values():
+                        continue
+                    if all(dep in results for dep in deps):
+                        kwargs = {dep: results[dep] for dep in deps}
+                        future = executor.submit(self.timed, name, func,
+                                                 kwargs)
+                        running[future] = name
+
+                if not running:
+                    raise ValueError("Startup phases have a dependency "
+                                     "cycle")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+
+        log.info("Startup finished in %.3fs", time.time() - started)
+        return results
+
+    def timed(self, name, func, kwargs):
+        started = time.time()
+        try:
+            return func(**kwargs)
+        finally:
+            self.timings[name] = time.time() - started
+            log.info("Startup phase %s took %.3fs", name, self.timings[name])
@@ -1,9 +1,11 @@
-import requests
+import threading
 import time
 
+from http_transport import HttpTransport
 from logger import Logger
 log = Logger.getInstance().getLogger()
 EXPIRES_IN_BUFFER = 60 * 10
+REFRESH_RETRY = 60  # seconds
 
 
 class YoLinkToken(object):
@@ -21,16 +23,22 @@ class YoLinkToken(object):
         self.refresh_token = None
         self.scope = None
         self.access_token_t = None
+        # YoLinkCache kept in sync with every new token.
+        self.cache = None
 
-    def renew_token(self) -> str:
+    def renew_token(self, force=False) -> str:
         """
         Renew access token if expired.
 
+        Args:
+            force (bool, optional): Renew even if not expired.
+                Defaults to False.
+
         Returns:
             str: access_token
         """
 
-        if not self.is_token_expired():
+        if not force and not self.is_token_expired():
             log.info("Access token is not expired")
             return self.access_token
 
@@ -40,15 +48,16 @@ class YoLinkToken(object):
             'refresh_token': self.refresh_token
         }
 
-        response = requests.post(
+        response = HttpTransport.getInstance().post(
             self.url,
             data=data
         )
 
         if response.status_code != 200:
-            log.error(("Failed to get access token! Status code {}").format(
-                response.status_code
-            ))
+            log.error("Failed to refresh access token! Status code %s",
+                      response.status_code)
+            # The refresh token may be gone too, start over.
+            return self.get_access_token()
 
         self.set_yolink_token(response=response)
         return self.access_token
@@ -64,16 +73,15 @@ class YoLinkToken(object):
             'grant_type': 'client_credentials'
         }
 
-        response = requests.post(
+        response = HttpTransport.getInstance().post(
             self.url,
             data=data,
             auth=(self.ua_id, self.sec_id)
         )
 
         if response.status_code != 200:
-            log.error(("Failed to get access token! Status code {}").format(
-                response.status_code
-            ))
+            log.error("Failed to get access token! Status code %s",
+                      response.status_code)
 
         self.set_yolink_token(response=response)
         return self.access_token
@@ -93,6 +101,47 @@ class YoLinkToken(object):
 
         self.access_token_t = time.time()
         log.info("Successfully got yolink access_token!")
+        if self.cache:
+            self.cache.update(token=self.to_dict())
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+            dict: Token state, see from_dict().
+        """
+        return {
+            'accessToken': self.access_token,
+            'tokenType': self.token_type,
+            'expiresIn': self.expires_in,
+            'refreshToken': self.refresh_token,
+            'scope': self.scope,
+            'accessTokenTime': self.access_token_t
+        }
+
+    def from_dict(self, data: dict) -> None:
+        """
+        Restore a token saved with to_dict().
+
+        Args:
+            data (dict): Token state.
+        """
+        self.access_token = data['accessToken']
+        self.token_type = data.get('tokenType')
+        self.expires_in = data['expiresIn']
+        self.refresh_token = data.get('refreshToken')
+        self.scope = data.get('scope')
+        self.access_token_t = data['accessTokenTime']
+
+    def expires_at(self) -> float:
+        """
+        Returns:
+            float: time.time() at which the token should be renewed,
+            EXPIRES_IN_BUFFER before it actually expires.
+        """
+        if self.access_token_t is None:
+            return 0.0
+
+        return self.access_token_t + self.expires_in
 
     def is_token_expired(self) -> bool:
         """
@@ -121,3 +170,44 @@ class YoLinkToken(object):
                     self.expires_in,
                     self.refresh_token
                 )
+
+
+class YoLinkTokenRefresher(threading.Thread):
+    """
+    Renews the access token ahead of expiry, so the broker connection
+    is moved to the new token before the old one is refused.
+    """
+    def __init__(self, yolink_token, on_refresh=None):
+        """
+        Args:
+            yolink_token (YoLinkToken): Token to keep fresh.
+            on_refresh (callable, optional): Called with the new
+                access token after each renewal.
+        """
+        super(YoLinkTokenRefresher, self).__init__(daemon=True)
+        self.yolink_token = yolink_token
+        self.on_refresh = on_refresh
+        self.stop_event = threading.Event()
+        self.refreshes = 0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            delay = max(0.0, self.yolink_token.expires_at() - time.time())
+            if self.stop_event.wait(delay):
+                break
+
+            try:
+                access_token = self.yolink_token.renew_token(force=True)
+            except Exception as e:
+                log.error("Failed to renew access token %s, retrying in %ss",
+                          e, REFRESH_RETRY)
+                self.stop_event.wait(REFRESH_RETRY)
+                continue
+
+            self.refreshes += 1
+            log.info("Access token renewed ahead of expiry")
+            if self.on_refresh:
+                self.on_refresh(access_token)
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,385 @@
+import copy
+import multiprocessing
+import queue
+import signal
+import threading
+import yolink_json
+import zlib
+
+from http_transport import HttpTransport
+from yolink_consumer import process_entry, STOP_SENTINEL, \
+    coalesce_key_func
+from yolink_device_types import YoLinkDeviceRegistry
+from yolink_devices import YoLinkFactory
+from yolink_event import YoLinkRawMessage
+from yolink_mqtt_client import DEFAULT_CLIENT_ID
+from influxdb_spool import DEFAULT_SPOOL_DIR
+from yolink_queue import create_queue, DEFAULT_COALESCE_EXCLUDE
+from yolink_setup import LOCAL_MQTT_TIMEOUT, attach_influxdb_clients, \
+    attach_sinks, create_dedup, create_influxdb_writer, \
+    create_local_mqtt_server, create_sinks
+from logger import Logger
+log = Logger.getInstance().getLogger()
+
+# Messages sent to a worker process per pipe write.
+DEFAULT_BATCH_SIZE = 256
+# Workers start from a fresh interpreter, forking a process that runs
+# paho and logging threads is not safe.
+START_METHOD = 'spawn'
+# Per worker slots in the shared counter array.
+COUNTERS = ('processed', 'failed')
+
+
+def device_info(device) -> dict:
+    """
+    The device info a YoLinkDevice was created from, sent to the
+    worker that owns the device.
+
+    Args:
+        device (YoLinkDevice): Device in the parent's device hash.
+
+    Returns:
+        dict: Device info as returned by get_all_devices().
+    """
+    return {
+        'deviceId': device.get_id(),
+        'name': device.get_name(),
+        'type': device.get_raw_type(),
+        'deviceUDID': device.get_uuid(),
+        'token': device.get_token()
+    }
+
+
+def worker_config(config, idx) -> dict:
+    """
+    Copy of the config for one worker process. Every worker owns its
+    sinks, so each gets its own influx db spool directory and local
+    MQTT client id.
+
+    Args:
+        config (map): Config hash map.
+        idx (int): Worker index.
+
+    Returns:
+        dict: The worker's config.
+    """
+    config = copy.deepcopy(config)
+    spool_config = config.get('influxdb', {}).get('spool')
+    if spool_config:
+        spool_config['directory'] = "{0}.{1}".format(
+            spool_config.get('directory', DEFAULT_SPOOL_DIR), idx)
+
+    mqtt_config = config.get('mqttBroker')
+    if mqtt_config:
+        mqtt_config['clientId'] = "{0}-worker-{1}".format(
+            mqtt_config.get('clientId', DEFAULT_CLIENT_ID), idx)
+
+    return config
+
+
+def run_worker(idx, conn, config, counters, level, log_queue):
+    """
+    Worker process: decode and process the batches received on conn
+    with its own devices and sinks, until the parent sends None.
+
+    Args:
+        idx (int): Worker index.
+        conn (Connection): Receiving end of the worker's pipe.
+        config (map): The worker's config, see worker_config().
+        counters (Array): Shared counters, COUNTERS per worker.
+        level (int): Log level of the parent.
+        log_queue (Queue): Log records go to the parent, which owns
+            the log file.
+    """
+    # The parent drains and stops the workers through the pipe.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    Logger.getInstance().forward(log_queue)
+    log.setLevel(level)
+    Logger.getInstance().configure(config.get('logging'))
+    HttpTransport.getInstance(config=config.get('http'))
+    yolink_json.set_backend(
+        config.get('consumer', {}).get('jsonBackend', 'auto'))
+
+    features = config.get('features', {})
+    registry = YoLinkDeviceRegistry.from_config(config.get('devices'))
+    influxdb_writer = None
+    if features.get('influxDB', False):
+        influxdb_writer = create_influxdb_writer(config)
+    mqtt_server = None
+    if features.get('localMQTT', False):
+        mqtt_server = create_local_mqtt_server(config,
+                                               timeout=LOCAL_MQTT_TIMEOUT)
+    dedup = create_dedup(config)
+    sinks = create_sinks(config, influxdb_writer, mqtt_server)
+
+    device_hash = dict()
+    processed = idx * len(COUNTERS)
+    failed = processed + 1
+    log.info("Worker %s started", idx)
+    try:
+        while True:
+            try:
+                batch = conn.recv()
+            except EOFError:
+                log.error("Worker %s lost its parent", idx)
+                break
+            if batch is None:
+                break
+
+            for item in batch:
+                if isinstance(item, dict):
+                    device = YoLinkFactory(registry, item)
+                    if device is None:
+                        continue
+                    fresh = {device.get_id(): device}
+                    if influxdb_writer:
+                        attach_influxdb_clients(fresh, config,
+                                                influxdb_writer)
+                    attach_sinks((device,), mqtt_server, sinks)
+                    device_hash.update(fresh)
+                    continue
+
+                if process_entry(device_hash, YoLinkRawMessage(*item),
+                                 dedup) == 0:
+                    counters[processed] += 1
+                else:
+                    counters[failed] += 1
+    finally:
+        if sinks:
+            sinks.stop()
+        if influxdb_writer:
+            influxdb_writer.stop()
+        if mqtt_server:
+            mqtt_server.client.loop_stop()
+            mqtt_server.client.disconnect()
+        if dedup:
+            log.info("Worker %s dedup stats: %s", idx, dedup.stats())
+        log.info("Worker %s stopped", idx)
+
+
+class YoLinkProcessDispatcher(object):
+    """
+    Routes entries by deviceId to a pool of worker processes, so
+    decoding, device processing and sink formatting scale past one
+    core.
+
+    Each worker has a local bounded queue (with the configured
+    overflow policy) and a sender thread that hands raw payloads to
+    the worker process over a pipe, in batches. A device always goes
+    to the same worker, which keeps its events in order and its
+    dedup/changeOnly state in one place. The sender puts the device
+    info in front of the first entry for a device, so devices added
+    after startup (late homes, cache revalidation) reach the workers
+    too. Worker log records are written by the parent.
+    """
+    def __init__(self, device_hash, config, workers=1,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Args:
+            device_hash (dict): The parent's device hash map.
+            config (map): Config hash map, passed on to the workers.
+            workers (int, optional): Number of worker processes.
+            batch_size (int, optional): Max entries per pipe write.
+        """
+        self.device_hash = device_hash
+        self.config = config
+        self.num_workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        queue_config = config.get('queue', {})
+        key_func = coalesce_key_func(
+            device_hash,
+            queue_config.get('coalesceExclude', DEFAULT_COALESCE_EXCLUDE))
+        self.queues = [create_queue(queue_config,
+                                    suffix='.w{0}'.format(idx),
+                                    key_func=key_func)
+                       for idx in range(self.num_workers)]
+
+        self.context = multiprocessing.get_context(START_METHOD)
+        self.counters = self.context.Array(
+            'q', self.num_workers * len(COUNTERS), lock=False)
+        self.lost = [0] * self.num_workers
+        # Devices whose info was sent to their worker.
+        self.sent = set()
+        self.lock = threading.Lock()
+        self.processes = [None] * self.num_workers
+        self.pipes = [None] * self.num_workers
+        self.senders = []
+        self.log_queue = self.context.Queue()
+        self.log_listener = None
+
+    def shard_for(self, device_id: str) -> int:
+        """
+        Stable worker index for a device id.
+
+        Args:
+            device_id (str): YoLink deviceId.
+
+        Returns:
+            int: Worker index.
+        """
+        return zlib.crc32(device_id.encode('utf-8')) % self.num_workers
+
+    def put(self, message, block=True, timeout=None):
+        """
+        Enqueue an entry for its device's worker.
+
+        Args:
+            message (YoLinkRawMessage): Undecoded message.
+            block (bool, optional): Block if the queue is full.
+            timeout (float, optional): Seconds to block.
+        """
+        idx = self.shard_for(message.device_id)
+        self.queues[idx].put(message, block, timeout)
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Queue counters summed over all workers.
+        """
+        stats = dict()
+        for q in self.queues:
+            for key, value in q.stats().items():
+                if key == 'policy':
+                    stats[key] = value
+                else:
+                    stats[key] = stats.get(key, 0) + value
+
+        return stats
+
+    def worker_stats(self) -> list:
+        """
+        Returns:
+            list: Per worker processed/failed counts, entries lost to
+            a crashed worker and local queue depth.
+        """
+        stats = []
+        for idx in range(self.num_workers):
+            base = idx * len(COUNTERS)
+            worker = {name: self.counters[base + offset]
+                      for offset, name in enumerate(COUNTERS)}
+            worker['lost'] = self.lost[idx]
+            worker['backlog'] = self.queues[idx].qsize()
+            stats.append(worker)
+        return stats
+
+    def start_worker(self, idx):
+        conn, worker_conn = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=run_worker,
+            args=(idx, conn, worker_config(self.config, idx),
+                  self.counters, log.getEffectiveLevel(), self.log_queue),
+            name='yolink-worker-{0}'.format(idx),
+            daemon=True)
+        process.start()
+        # Only the worker reads, so it sees EOF if the parent dies.
+        conn.close()
+        self.processes[idx] = process
+        self.pipes[idx] = worker_conn
+
+    def restart_worker(self, idx):
+        """
+        Replace a crashed worker and send it the devices it owns.
+        """
+        log.error("Worker %s exited with %s, restarting", idx,
+                  self.processes[idx].exitcode)
+        self.pipes[idx].close()
+        self.start_worker(idx)
+        with self.lock:
+            infos = [device_info(self.device_hash[device_id])
+                     for device_id in self.sent
+                     if device_id in self.device_hash and
+                     self.shard_for(device_id) == idx]
+        self.pipes[idx].send(infos)
+
+    def send(self, idx):
+        """
+        Sender thread: move entries from the local queue to the
+        worker process, batching whatever is already queued.
+        """
+        local_q = self.queues[idx]
+        stopping = False
+        while not stopping:
+            batch = []
+            item = local_q.get()
+            while True:
+                local_q.task_done()
+                if item is STOP_SENTINEL:
+                    stopping = True
+                    break
+                if item.device_id not in self.sent:
+                    device = self.device_hash.get(item.device_id)
+                    if device is not None:
+                        batch.append(device_info(device))
+                        with self.lock:
+                            self.sent.add(item.device_id)
+                batch.append((item.topic, item.payload, item.device_id,
+                              item.received_at))
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = local_q.get(False)
+                except queue.Empty:
+                    break
+
+            if not batch:
+                continue
+            try:
+                self.pipes[idx].send(batch)
+            except OSError:
+                self.lost[idx] += len(batch)
+                self.restart_worker(idx)
+
+        try:
+            self.pipes[idx].send(None)
+        except OSError:
+            log.error("Worker %s is gone, could not stop it", idx)
+
+    def start(self):
+        """
+        Start the worker processes and their sender threads.
+        """
+        self.log_listener = Logger.getInstance().listen(self.log_queue)
+        for idx in range(self.num_workers):
+            self.start_worker(idx)
+            sender = threading.Thread(target=self.send, args=(idx,),
+                                      name='sender-{0}'.format(idx),
+                                      daemon=True)
+            sender.start()
+            self.senders.append(sender)
+
+        log.info("Started %s worker process(es)", self.num_workers)
+
+    def stop(self, timeout=None):
+        """
+        Drain every worker queue and stop the worker processes, each
+        flushes its own sinks on the way out.
+
+        Args:
+            timeout (float, optional): Seconds to wait for each worker
+                to exit. Defaults to None (wait forever).
+        """
+        log.info("Stopping worker processes, %s entries left", self.qsize())
+        for local_q in self.queues:
+            local_q.put_control(STOP_SENTINEL)
+
+        for sender in self.senders:
+            sender.join(timeout)
+        for idx, process in enumerate(self.processes):
+            process.join(timeout)
+            if process.is_alive():
+                log.error("Worker %s did not stop in time", idx)
+                process.terminate()
+            self.pipes[idx].close()
+
+        if self.log_listener:
+            self.log_listener.stop()
+            self.log_listener = None
+        log.info("Worker stats: %s", self.worker_stats())
+        self.senders = []
@@ -0,0 +1,44 @@
+import os
+import sys
+
+# The modules live flat in src/ and import each other top level.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logger import Logger  # noqa: E402
+
+# Create the process wide logger before any module does, without the
+# yolinkv2.log file.
+Logger.getInstance(fname=os.devnull)
+
+import pytest  # noqa: E402
+
+from yolink_mqtt_client import MqttClient  # noqa: E402
+
+
+class FakePahoClient(object):
+    """
+    Records publishes, fails the ones listed in rcs.
+    """
+    def __init__(self, rcs=()):
+        self.rcs = list(rcs)
+        self.published = []
+
+    def publish(self, topic, data, qos=0, retain=False):
+        rc = self.rcs.pop(0) if self.rcs else 0
+        if rc == 0:
+            self.published.append((topic, data))
+        return (rc, 1)
+
+
+@pytest.fixture
+def mqtt_server():
+    """
+    Factory of changeOnly MqttClients publishing to a FakePahoClient.
+    """
+    def create(rcs=()):
+        server = MqttClient({'host': 'localhost', 'port': 1883,
+                             'user': '', 'pasw': '', 'changeOnly': True})
+        server.client = FakePahoClient(rcs)
+        return server
+
+    return create
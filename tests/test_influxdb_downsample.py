@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from influxdb_downsample import InfluxDbDownsampler
+from influxdb_line_protocol import line_prefix
+
+
+def downsample(vectorized, samples, now):
+    downsampler = InfluxDbDownsampler(window=60, lateness=10,
+                                      vectorized=vectorized)
+    for prefix, fields, timestamp in samples:
+        downsampler.add(prefix, fields, timestamp)
+    # Closed windows first, then the still open ones on shutdown.
+    return (downsampler.flush(now=now), downsampler.flush(force=True),
+            downsampler.stats())
+
+
+def random_samples(count=2000, seed=7):
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(count):
+        # Quarter steps add up exactly, so both paths give the same
+        # mean bit for bit. Duplicate times check the last value.
+        fields = {'temperature': rng.randrange(-400, 400) / 4.0,
+                  'battery': rng.randrange(0, 5)}
+        prefix = line_prefix('th', {'device': rng.randrange(5)})
+        samples.append((prefix, fields, rng.randrange(0, 600) * 1000))
+    return samples
+
+
+def test_python_downsample_aggregates():
+    prefix = line_prefix('th', {'device': 'd1'})
+    lines, rest, stats = downsample(
+        False, [(prefix, {'t': 1.0, 'state': 'open'}, 1000),
+                (prefix, {'t': 3.5}, 3000),
+                (prefix, {'t': 0.5}, 2000),
+                (prefix, {'t': 9.0}, 61000)], now=75000)
+    assert lines == ['th,device=d1 t_min=0.5,t_max=3.5,t_mean=1.6666666666'
+                     '666667,t_last=3.5 0']
+    assert rest == ['th,device=d1 t_min=9.0,t_max=9.0,t_mean=9.0,'
+                    't_last=9.0 60000']
+    assert stats['points'] == 2
+
+
+def test_numpy_matches_python():
+    pytest.importorskip('numpy')
+    samples = random_samples()
+    vectorized = downsample(True, samples, now=300000)
+    python = downsample(False, samples, now=300000)
+
+    assert vectorized[2]['vectorized'] and not python[2]['vectorized']
+    assert vectorized[0] == python[0]
+    assert vectorized[1] == python[1]
+    assert vectorized[0] and vectorized[1]
@@ -0,0 +1,16 @@
+from influxdb_line_protocol import encode_line, line_prefix
+
+
+def test_escapes_special_characters():
+    prefix = line_prefix('my weather', {'room,name': 'a=b c'})
+    assert prefix == 'my\\ weather,room\\,name=a\\=b\\ c '
+    assert encode_line(prefix, {'state': 'say "hi"'}, 1000) == \
+        prefix + 'state="say \\"hi\\"" 1000'
+
+
+def test_newlines_are_replaced():
+    prefix = line_prefix('weather\n', {'location': 'guest\r\nroom'})
+    line = encode_line(prefix, {'field\n': 'two\nlines'})
+    assert '\n' not in line and '\r' not in line and '\\n' not in line
+    assert line == \
+        'weather\\ ,location=guest\\ \\ room field\\ ="two lines"'
@@ -0,0 +1,70 @@
+from influxdb_interface import InfluxDbBatchResult
+from influxdb_spool import InfluxDbSpool
+
+
+class FakeSend(object):
+    """
+    Records sent batches, answers with the given status codes, then
+    204.
+    """
+    def __init__(self, status_codes=()):
+        self.status_codes = list(status_codes)
+        self.batches = []
+
+    def __call__(self, lines):
+        status_code = self.status_codes.pop(0) if self.status_codes else 204
+        if status_code == 204:
+            self.batches.append(lines)
+        return InfluxDbBatchResult(len(lines), status_code)
+
+
+def points(count, start=0):
+    return ['m v={0}i'.format(idx) for idx in range(start, start + count)]
+
+
+def test_replay_sends_and_deletes(tmp_path):
+    spool = InfluxDbSpool(str(tmp_path))
+    spool.append(points(5))
+    send = FakeSend()
+    assert spool.replay(send, 2) == 5
+    assert sum(send.batches, []) == points(5)
+    assert spool.depth()['points'] == 0
+
+
+def test_replay_stops_on_retryable_error(tmp_path):
+    spool = InfluxDbSpool(str(tmp_path))
+    spool.append(points(4))
+    assert spool.replay(FakeSend([204, 503]), 2) == 2
+    assert spool.depth()['points'] == 2
+
+
+def test_replay_drops_rejected_batch(tmp_path):
+    spool = InfluxDbSpool(str(tmp_path))
+    spool.append(points(4))
+    send = FakeSend([400])
+    assert spool.replay(send, 2) == 2
+    assert send.batches == [points(2, 2)]
+    assert spool.depth()['points'] == 0
+
+
+def test_restart_resumes_at_replay_offset(tmp_path):
+    spool = InfluxDbSpool(str(tmp_path))
+    spool.append(points(4))
+    spool.replay(FakeSend([204, -1]), 2)
+    spool.close()
+
+    spool = InfluxDbSpool(str(tmp_path))
+    assert spool.depth()['points'] == 2
+    send = FakeSend()
+    assert spool.replay(send, 2) == 2
+    assert send.batches == [points(2, 2)]
+
+
+def test_load_skips_torn_line_and_foreign_files(tmp_path):
+    (tmp_path / '000000000001.lp').write_bytes(b'm v=1i\nm v=2i\nm v=')
+    (tmp_path / 'notes.lp').write_bytes(b'm v=3i\n')
+    spool = InfluxDbSpool(str(tmp_path))
+    assert spool.depth()['points'] == 2
+    send = FakeSend()
+    spool.replay(send, 10)
+    assert send.batches == [['m v=1i', 'm v=2i']]
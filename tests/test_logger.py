@@ -0,0 +1,26 @@
+import logging
+
+from logger import SamplingFilter
+
+
+def record(msg, lineno=10, level=logging.INFO):
+    return logging.LogRecord('YoLinkv2', level, 'main.py', lineno, msg,
+                             None, None)
+
+
+def test_sampling_passes_first_and_every_nth():
+    sampler = SamplingFilter(3)
+    passed = [sampler.filter(record('event %s')) for _ in range(7)]
+    assert passed == [True, False, False, True, False, False, True]
+    assert sampler.filter(record('failed', level=logging.ERROR))
+
+
+def test_sampling_counts_per_call_site():
+    sampler = SamplingFilter(2)
+    # A dict message, e.g. log.info(info).
+    assert sampler.filter(record({'homeId': 'h'}, lineno=1))
+    assert not sampler.filter(record({'homeId': 'h'}, lineno=1))
+
+    for idx in range(100):
+        sampler.filter(record('device {0}'.format(idx), lineno=2))
+    assert len(sampler.counts) == 2
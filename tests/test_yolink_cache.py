@@ -0,0 +1,70 @@
+import json
+import os
+import stat
+
+from yolink_cache import YoLinkCache, CACHE_VERSION
+
+DEVICES = [{'deviceId': 'd1', 'type': 'DoorSensor'}]
+
+
+def test_cold_start_without_file(tmp_path):
+    cache = YoLinkCache(str(tmp_path / 'cache.json'))
+    assert not cache.load()
+
+
+def test_update_then_load(tmp_path):
+    fname = str(tmp_path / 'cache.json')
+    YoLinkCache(fname).update(token={'accessToken': 'a'}, homeId='h',
+                              devices=DEVICES)
+
+    cache = YoLinkCache(fname)
+    assert cache.load()
+    assert cache.get('homeId') == 'h'
+    assert cache.get('devices') == DEVICES
+    assert cache.get('version') == CACHE_VERSION
+
+
+def test_incomplete_or_unreadable_cache_is_ignored(tmp_path):
+    fname = str(tmp_path / 'cache.json')
+    YoLinkCache(fname).update(token={'accessToken': 'a'})
+    assert not YoLinkCache(fname).load()
+
+    with open(fname, 'w') as fp:
+        fp.write('{"version": 1, "tok')
+    assert not YoLinkCache(fname).load()
+
+    with open(fname, 'w') as fp:
+        json.dump({'version': CACHE_VERSION + 1, 'token': {'a': 1},
+                   'homeId': 'h', 'devices': DEVICES}, fp)
+    assert not YoLinkCache(fname).load()
+
+
+def test_update_rewrites_atomically_owner_only(tmp_path):
+    fname = str(tmp_path / 'cache.json')
+    cache = YoLinkCache(fname)
+    cache.update(homeId='h')
+    cache.update(devices=DEVICES)
+
+    assert os.listdir(str(tmp_path)) == ['cache.json']
+    assert stat.S_IMODE(os.stat(fname).st_mode) == 0o600
+    with open(fname) as fp:
+        assert json.load(fp) == {'homeId': 'h', 'devices': DEVICES,
+                                 'version': CACHE_VERSION}
+
+
+def test_failed_rewrite_keeps_previous_file(tmp_path):
+    fname = str(tmp_path / 'cache.json')
+    cache = YoLinkCache(fname)
+    cache.update(homeId='h')
+    os.mkdir(fname + '.tmp')
+
+    cache.update(homeId='other')
+    with open(fname) as fp:
+        assert json.load(fp)['homeId'] == 'h'
+
+
+def test_from_config_per_home_file():
+    assert YoLinkCache.from_config({'enabled': False}) is None
+    cache = YoLinkCache.from_config({'enabled': True,
+                                     'file': 'cache.json'}, 'cabin')
+    assert cache.fname == 'cache-cabin.json'
@@ -0,0 +1,29 @@
+from yolink_dedup import YoLinkDedup
+from yolink_event import YoLinkEvent
+
+
+def event(msgid, time, device_id='d1'):
+    return YoLinkEvent(device_id, 'THSensor.Report', msgid, time)
+
+
+def test_redelivery_is_dropped():
+    dedup = YoLinkDedup()
+    assert dedup.accept(event('m1', 1000))
+    assert not dedup.accept(event('m1', 1000))
+    assert dedup.stats()['hits'] == 1
+
+
+def test_older_event_is_dropped():
+    dedup = YoLinkDedup()
+    assert dedup.accept(event('m2', 2000))
+    assert not dedup.accept(event('m1', 1000))
+    assert dedup.stats()['stale'] == 1
+
+
+def test_missing_msgid_only_checks_time():
+    dedup = YoLinkDedup()
+    assert dedup.accept(event(None, 1000))
+    assert dedup.accept(event(None, 2000))
+    assert dedup.accept(event(None, 2000))
+    assert not dedup.accept(event(None, 1500))
+    assert dedup.stats() == {'hits': 0, 'misses': 3, 'stale': 1, 'size': 0}
@@ -0,0 +1,63 @@
+import pytest
+
+import yolink_device_types
+from yolink_device_types import YoLinkDeviceRegistry, YoLinkDeviceType
+
+
+def test_door_and_leak_states():
+    registry = YoLinkDeviceRegistry()
+    door = registry.get('DoorSensor').extract
+    assert door({'state': 'open'}) == {'state': 'DoorEvent.OPEN'}
+    assert door({'state': 'closed'}) == {'state': 'DoorEvent.CLOSE'}
+    assert door({'state': 'error'}) == {'state': '-1'}
+    assert door({'state': 'ajar'}) == {'state': None}
+    assert door({}) == {'state': None}
+
+    leak = registry.get('LeakSensor')
+    assert leak.extract({'state': 'full'}) == {'state': 'LeakEvent.FULL'}
+    assert leak.extract({'state': 'dry'}) == {'state': 'LeakEvent.DRY'}
+    assert 'LeakSensor.setInterval' in leak.ignore_events
+
+
+def test_th_sensor_conversions():
+    th = YoLinkDeviceRegistry().get('THSensor')
+    assert th.extract({'temperature': 21.5, 'humidity': '48.456'}) == \
+        {'temperature': 70.7, 'humidity': 48.46}
+    assert th.extract({'humidity': 50}) == \
+        {'temperature': None, 'humidity': 50.0}
+    assert th.influxdb_fields == ('temperature', 'humidity')
+
+
+def test_nested_path_and_default():
+    device_type = YoLinkDeviceType('Motion', {
+        'fields': {
+            'state': {'states': {'alert': 'MOTION'}, 'default': 'NONE'},
+            'signal': {'path': 'loraInfo.signal', 'convert': 'int'}
+        }})
+    assert device_type.extract({'state': 'normal',
+                                'loraInfo': {'signal': '-70'}}) == \
+        {'state': 'NONE', 'signal': -70}
+    assert device_type.extract({'loraInfo': 3}) == \
+        {'state': None, 'signal': None}
+
+
+def test_bad_descriptions_are_rejected():
+    with pytest.raises(ValueError):
+        YoLinkDeviceType('X', {'fields': {'v': {'convert': 'hex'}}})
+    with pytest.raises(ValueError):
+        YoLinkDeviceType('X', {'fields': {}, 'sinks': {'mqtt': 'v'}})
+
+
+def test_skip_and_unknown_logged_once(monkeypatch):
+    warnings = []
+    monkeypatch.setattr(yolink_device_types.log, 'warning',
+                        lambda *args: warnings.append(args))
+    assert YoLinkDeviceRegistry.from_config().get('Hub') is None
+    assert warnings == []
+
+    registry = YoLinkDeviceRegistry.from_config({'skip': ['DoorSensor']})
+    assert registry.get('DoorSensor') is None
+    assert registry.get('Thermostat') is None
+    assert registry.get('Thermostat') is None
+    assert len(warnings) == 1
+    assert registry.unknown == {'Thermostat'}
@@ -0,0 +1,60 @@
+import threading
+
+from yolink_mqtt_client import YoLinkMqttClient, RECONNECT_MAX_DELAY
+
+
+def test_change_only_suppresses_unchanged_state(mqtt_server):
+    server = mqtt_server()
+    assert server.publish_state('t', 'open') == 0
+    assert server.publish_state('t', 'open') == 0
+    assert server.client.published == [('t', 'open')]
+    assert server.suppressed == 1
+
+
+def test_failed_publish_is_not_suppressed_on_retry(mqtt_server):
+    server = mqtt_server(rcs=[0, 4])
+    assert server.publish_state('t', 'open') == 0
+    assert server.publish_state('t', 'closed') == 4
+    assert server.publish_state('t', 'closed') == 0
+    assert server.client.published == [('t', 'open'), ('t', 'closed')]
+    assert server.suppressed == 0
+
+
+def test_heartbeat_does_not_resend_over_newer_state(mqtt_server):
+    server = mqtt_server()
+    server.publish_state('t', 'open')
+    server.last_state['t'][1] = 0
+    newer = threading.Thread(target=server.publish_state,
+                             args=('t', 'closed'))
+    publish = server.client.publish
+
+    def heartbeat_publish(topic, data, qos=0, retain=False):
+        # A new state arrives while the heartbeat is resending.
+        if not newer.is_alive():
+            newer.start()
+            newer.join(0.2)
+        return publish(topic, data, qos, retain)
+
+    server.client.publish = heartbeat_publish
+    server.send_heartbeats()
+    newer.join()
+    assert server.client.published == [('t', 'open'), ('t', 'open'),
+                                       ('t', 'closed')]
+
+
+def test_refused_connect_backs_off_until_accepted():
+    client = YoLinkMqttClient('token', '', 'yl-home/h/+/report',
+                              'localhost', 1883, {}, None, None)
+    assert client.refused_delay() == 0
+
+    delays = []
+    for _ in range(8):
+        client.on_connect(client.client, None, {}, 5)
+        delays.append(client.refused_delay())
+    assert delays == [1, 2, 4, 8, 16, 32, RECONNECT_MAX_DELAY,
+                      RECONNECT_MAX_DELAY]
+    assert client.reconnect_pending
+
+    client.client.subscribe = lambda topic: None
+    client.on_connect(client.client, None, {}, 0)
+    assert client.refused_delay() == 0
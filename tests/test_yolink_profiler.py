@@ -0,0 +1,12 @@
+import pytest
+
+from yolink_profiler import YoLinkProfiler
+
+
+def test_bad_duration_does_not_leave_profiler_busy():
+    profiler = YoLinkProfiler.getInstance()
+    with pytest.raises(ValueError):
+        profiler.start_cpu_profile('sample', 'soon')
+    with pytest.raises(ValueError):
+        profiler.start_cpu_profile('trace', '1')
+    assert not profiler.busy
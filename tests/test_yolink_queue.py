@@ -0,0 +1,79 @@
+from yolink_consumer import STOP_SENTINEL, coalesce_key_func
+from yolink_event import YoLinkRawMessage
+from yolink_queue import CoalescingQueue, OverflowQueue, POLICY_DROP_OLDEST
+
+
+class FakeDevice(object):
+    def __init__(self, raw_type):
+        self.raw_type = raw_type
+
+    def get_raw_type(self):
+        return self.raw_type
+
+
+def message(device_id, state):
+    payload = ('{{"event": "THSensor.Report", "deviceId": "{0}", '
+               '"data": {{"state": "{1}"}}}}').format(device_id, state)
+    return YoLinkRawMessage('topic', payload.encode(), device_id, 0.0)
+
+
+def coalescing_queue(**kwargs):
+    device_hash = {'th': FakeDevice('THSensor'),
+                   'door': FakeDevice('DoorSensor')}
+    return CoalescingQueue(coalesce_key_func(device_hash, ['DoorSensor']),
+                           **kwargs)
+
+
+def test_drop_oldest_keeps_stop_sentinel():
+    q = OverflowQueue(maxsize=2, policy=POLICY_DROP_OLDEST)
+    q.put(1)
+    q.put_control(STOP_SENTINEL)
+    q.put(2)
+    assert [q.get(), q.get()] == [1, STOP_SENTINEL]
+    assert q.stats()['dropped'] == 1
+
+
+def test_drop_oldest_evicts_oldest():
+    q = OverflowQueue(maxsize=2, policy=POLICY_DROP_OLDEST)
+    for item in range(3):
+        q.put(item)
+    assert [q.get(), q.get()] == [1, 2]
+
+
+def test_coalesce_merges_in_place():
+    q = coalescing_queue()
+    first = message('th', 1)
+    other = message('door', 'open')
+    latest = message('th', 2)
+    for item in (first, other, latest):
+        q.put(item)
+    assert [q.get(), q.get()] == [latest, other]
+    assert q.stats()['merged'] == 1
+
+
+def test_coalesce_exclude_keeps_every_entry():
+    q = coalescing_queue()
+    entries = [message('door', state) for state in ('open', 'closed')]
+    for item in entries:
+        q.put(item)
+    assert [q.get(), q.get()] == entries
+    assert q.stats()['merged'] == 0
+
+
+def test_coalesce_new_entry_after_get():
+    q = coalescing_queue()
+    q.put(message('th', 1))
+    q.get()
+    latest = message('th', 2)
+    q.put(latest)
+    assert q.get() is latest
+    assert q.stats()['merged'] == 0
+
+
+def test_coalesce_stop_sentinel_keeps_order():
+    q = coalescing_queue()
+    first, latest = message('th', 1), message('th', 2)
+    q.put(first)
+    q.put_control(STOP_SENTINEL)
+    q.put(latest)
+    assert [q.get(), q.get()] == [latest, STOP_SENTINEL]
@@ -0,0 +1,23 @@
+from yolink_event import YoLinkEvent
+from yolink_sinks import MqttSink
+
+
+class FakeDevice(object):
+    def __init__(self, server):
+        self.server = server
+
+    def publish_state(self, event, values):
+        return self.server.publish_state('yolink/door', values['state'],
+                                         'DoorSensor')
+
+
+def test_mqtt_sink_retry_resends_failed_publish(mqtt_server):
+    server = mqtt_server(rcs=[4])
+    sink = MqttSink({'retries': 2, 'retryDelay': 0})
+    event = YoLinkEvent('d1', 'DoorSensor.Alert', 'm1', 1000)
+
+    sink.deliver((FakeDevice(server), event, {'state': 'open'}))
+
+    assert server.client.published == [('yolink/door', 'open')]
+    assert sink.stats()['written'] == 1
+    assert sink.stats()['failed'] == 0
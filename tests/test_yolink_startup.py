@@ -0,0 +1,57 @@
+import threading
+
+import pytest
+
+from yolink_startup import StartupGraph
+
+
+def test_phases_get_their_dependency_results():
+    graph = StartupGraph()
+    graph.add('token', lambda: 'tok')
+    graph.add('home', lambda token: token + '/home', deps=('token',))
+    graph.add('devices', lambda token, home: [token, home],
+              deps=('token', 'home'))
+
+    results = graph.run()
+    assert results['devices'] == ['tok', 'tok/home']
+    assert set(graph.timings) == {'token', 'home', 'devices'}
+
+
+def test_independent_phases_run_concurrently():
+    # Each phase waits for the other, so they only finish if both
+    # run at once.
+    barrier = threading.Barrier(2, timeout=5)
+    graph = StartupGraph(workers=2)
+    graph.add('cloud', barrier.wait)
+    graph.add('sinks', barrier.wait)
+    graph.add('done', lambda cloud, sinks: True, deps=('cloud', 'sinks'))
+    assert graph.run()['done']
+
+
+def test_phase_error_is_raised_and_stops_dependents():
+    ran = []
+
+    def fail():
+        raise RuntimeError('no token')
+
+    graph = StartupGraph()
+    graph.add('token', fail)
+    graph.add('home', lambda token: ran.append('home'), deps=('token',))
+    with pytest.raises(RuntimeError, match='no token'):
+        graph.run()
+    assert ran == []
+
+
+def test_unknown_dependency_is_rejected():
+    graph = StartupGraph()
+    graph.add('home', lambda token: None, deps=('token',))
+    with pytest.raises(ValueError, match='unknown phase token'):
+        graph.run()
+
+
+def test_dependency_cycle_is_rejected():
+    graph = StartupGraph()
+    graph.add('a', lambda b: None, deps=('b',))
+    graph.add('b', lambda a: None, deps=('a',))
+    with pytest.raises(ValueError, match='cycle'):
+        graph.run()
@@ -0,0 +1,93 @@
+import time
+
+import yolink_token
+from yolink_token import YoLinkToken, YoLinkTokenRefresher, \
+    EXPIRES_IN_BUFFER
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def token_body(access_token):
+    return {'access_token': access_token, 'token_type': 'bearer',
+            'expires_in': 7200, 'refresh_token': 'refresh',
+            'scope': ['create']}
+
+
+class FakeTransport(object):
+    """
+    Refuses refresh_token grants, answers client_credentials ones.
+    """
+    def __init__(self):
+        self.grants = []
+
+    def post(self, url, data=None, auth=None):
+        self.grants.append(data['grant_type'])
+        if data['grant_type'] == 'refresh_token':
+            return FakeResponse(401)
+        return FakeResponse(200, token_body('new'))
+
+
+def fake_transport(monkeypatch):
+    transport = FakeTransport()
+    monkeypatch.setattr(yolink_token.HttpTransport, 'getInstance',
+                        lambda: transport)
+    return transport
+
+
+def test_token_expiry():
+    token = YoLinkToken('url', 'ua', 'sec')
+    assert token.is_token_expired()
+    assert token.expires_at() == 0.0
+
+    now = time.time()
+    token.from_dict({'accessToken': 'a', 'expiresIn': 100,
+                     'accessTokenTime': now})
+    assert not token.is_token_expired()
+    assert token.expires_at() == now + 100
+
+    token.access_token_t = now - 200
+    assert token.is_token_expired()
+
+
+def test_set_token_keeps_expiry_buffer():
+    token = YoLinkToken('url', 'ua', 'sec')
+    token.set_yolink_token(FakeResponse(200, token_body('a')))
+    assert token.expires_in == 7200 - EXPIRES_IN_BUFFER
+    assert token.to_dict()['accessToken'] == 'a'
+
+
+def test_renew_falls_back_to_client_credentials(monkeypatch):
+    transport = fake_transport(monkeypatch)
+    token = YoLinkToken('url', 'ua', 'sec')
+    token.set_yolink_token(FakeResponse(200, token_body('old')))
+
+    assert token.renew_token() == 'old'
+    assert transport.grants == []
+    assert token.renew_token(force=True) == 'new'
+    assert transport.grants == ['refresh_token', 'client_credentials']
+
+
+def test_refresher_renews_expired_token(monkeypatch):
+    transport = fake_transport(monkeypatch)
+    token = YoLinkToken('url', 'ua', 'sec')
+    refreshed = []
+
+    def on_refresh(access_token):
+        refreshed.append(access_token)
+        refresher.stop()
+
+    refresher = YoLinkTokenRefresher(token, on_refresh)
+    refresher.start()
+    refresher.join(5)
+
+    assert not refresher.is_alive()
+    assert refreshed == ['new']
+    assert refresher.refreshes == 1
+    assert transport.grants == ['refresh_token', 'client_credentials']